@@ -6,36 +6,121 @@ import sys, os
 if sys.hexversion < 0x2070000:
     raise ImportError('Python >= 2.7 is required')
 
+import time
+# it's used by --profile-startup
+STARTUP_TIME = time.time()
+
+# Modules which are needed only for some commands (email, smtplib, re, json and etc)
+# are imported where they are used to have fast start for interactive commands
+import threading
 import traceback
 import argparse
 import subprocess
 import logging, logging.handlers
-import smtplib
 from copy import deepcopy
-from collections import defaultdict
-from email.mime.text import MIMEText
-from distutils.spawn import find_executable
+from contextlib import contextmanager
+from collections import defaultdict, deque
+
+IMPORT_DURATION = time.time() - STARTUP_TIME
 
 PY2 = sys.version_info[0] == 2
 PY3 = sys.version_info[0] >= 3
 
 if PY3:
     string_types = str
+    from shlex import quote as shellQuote
 else:
     string_types = basestring
+    from pipes import quote as shellQuote
 
 # Avoid writing .pyc files
 sys.dont_write_bytecode = True
 
 ALLOWED_PREFIXES = ('borg', 'rclone', 'shell')
 
-BORG_BIN   = find_executable('borg')
-RCLONE_BIN = find_executable('rclone')
-
 LOG_FORMATTER = logging.Formatter(
     "%(asctime)s [%(levelname)s] %(message)s", datefmt='%Y-%m-%d %H:%M:%S')
 LOG_DEFAULT_LEVEL = logging.INFO
 
+# Settings of streaming of tool output, see STREAM_OUTPUT in config_test.py
+OUTPUT_TAIL_LINES     = 1000
+OUTPUT_BATCH_LINES    = 50
+OUTPUT_BATCH_INTERVAL = 1.0 # seconds
+
+# Options of running of tool processes, they can be set in 'borg', 'rclone' and shell
+# sections and for each command in 'commands-options', see config_test.py
+EXEC_OPTIONS = ('timeout', 'idle-timeout', 'nice', 'ionice-class', 'ionice-level',
+                'cpu-quota', 'memory-max', 'min-interval')
+
+IONICE_CLASSES = { 'realtime' : 1, 'best-effort' : 2, 'idle' : 3 }
+
+# Seconds between SIGTERM and SIGKILL for process killed by timeout
+KILL_GRACE_PERIOD = 10
+
+# Directory for files with state between runs, see STATE_DIR in config_test.py
+STATE_DIR = '~/.backup-o-matic'
+
+# Number of threads to scan source trees, see 'skip-unchanged' in config_test.py
+SCAN_THREADS = 4
+
+# Schedule of archives in daemon mode, see SCHEDULE in config_test.py
+DEFAULT_SCHEDULE = { 'interval' : 24 * 3600 }
+
+# Seconds to wait before next try to run jobs of config locked by other process (daemon mode)
+DAEMON_LOCK_RETRY = 60
+
+# Ranges of fields of cron expression: minute, hour, day of month, month, day of week
+CRON_RANGES = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+# Seconds between progress log lines of long commands, see PROGRESS in config_test.py
+PROGRESS_INTERVAL = 60
+
+# Run history and regression alerts, see HISTORY_DB in config_test.py. Baseline is
+# median of last successful runs, it's used when there are HISTORY_MIN_RUNS of them.
+# Durations shorter than HISTORY_MIN_DURATION seconds are not compared.
+HISTORY_BASELINE_RUNS = 10
+HISTORY_ALERT_FACTOR  = 2.0
+HISTORY_MIN_RUNS      = 3
+HISTORY_MIN_DURATION  = 60
+
+# Compression 'auto', see 'compression' in config_test.py. Candidates are borg specs in
+# order of increasing strength, only ones which can be measured here are benchmarked:
+# 'lz4' and 'zstd' need python modules 'lz4' and 'zstandard', 'zlib' and 'lzma' are
+# the same libraries as borg uses.
+AUTO_COMPRESSION_CANDIDATES = ('lz4', 'zstd,3', 'zlib,6', 'zstd,10', 'lzma,6')
+AUTO_COMPRESSION_SAMPLE_FILES = 128
+AUTO_COMPRESSION_CHUNK_SIZE   = 64 * 1024
+AUTO_COMPRESSION_MAX_DIRS     = 2000
+# Stronger candidate is chosen if it makes data smaller by this ratio at least
+AUTO_COMPRESSION_MIN_GAIN     = 0.9
+
+# Methods of snapshot of repository for rclone, see 'with-lock' in config_test.py
+SNAPSHOT_METHODS = ('btrfs', 'reflink', 'hardlink')
+# Line printed by command of 'borg with-lock' when the lock is taken, see _holdBorgLock
+BORG_LOCKED_MARK = 'backup-o-matic-repository-is-locked'
+
+# Action 'borg:analyze': number of reported paths in each list, depth of reported
+# subtrees below roots of sources and known junk: directories and files by name
+# patterns, directories with CACHEDIR.TAG are junk too (borg option --exclude-caches)
+ANALYZE_TOP = 10
+ANALYZE_DEPTH = 3
+ANALYZE_JUNK_DIRS = ('node_modules', '__pycache__')
+ANALYZE_JUNK_FILES = ('*.qcow2', )
+CACHEDIR_TAG_SIGNATURE = b'Signature: 8a477f597d28d172789f06886806bc55'
+
+# Sharding of sources, see 'shards' in config_test.py. Weight of directory is its size
+# plus this number of bytes per file: borg spends time on each file as on such data.
+SHARD_FILE_COST = 64 * 1024
+# Directories are moved between shards only if the heaviest shard is heavier than
+# average one by this ratio
+SHARD_MAX_IMBALANCE = 1.25
+
+# Default limits of email report, see 'max-size' and 'max-record-size' in config_common.py
+EMAIL_MAX_SIZE        = 2 * 1024 * 1024
+EMAIL_MAX_RECORD_SIZE = 256 * 1024
+# Number of kept spill files of email report which were not attached to sent email
+EMAIL_SPILL_KEEP      = 10
+
 def setupDefaultLogger():
     logger = logging.getLogger(__name__)
     ch = logging.StreamHandler(sys.stdout)
@@ -57,12 +142,244 @@ def makeDir(path):
         return
     os.makedirs(path)
 
+# Found executables, see findExecutable
+EXECUTABLES = {}
+
+def findExecutable(name):
+    # Full path of executable from PATH or None, result is cached.
+    # shutil.which doesn't exist in python 2, distutils doesn't exist since python 3.12
+    if name in EXECUTABLES:
+        return EXECUTABLES[name]
+    path = None
+    try:
+        from shutil import which
+        path = which(name)
+    except ImportError:
+        for directory in os.environ.get('PATH', os.defpath).split(os.pathsep):
+            candidate = os.path.join(directory, name)
+            if os.path.isfile(candidate) and os.access(candidate, os.X_OK):
+                path = candidate
+                break
+    EXECUTABLES[name] = path
+    return path
+
+def callQuietly(args):
+    # Returns exit code of command, its output is dropped
+    with open(os.devnull, 'w') as devnull:
+        return subprocess.call(args, stdout = devnull, stderr = subprocess.STDOUT)
+
+def makeEnv(*envVarsList):
+    # Environment for tool processes: copy of current one updated with all given dicts.
+    # It's computed once per archive and section in Backupper._prepare and must not be
+    # changed later, so it's shared between all commands of the section.
+    env = os.environ.copy()
+    for envVars in envVarsList:
+        env.update(envVars)
+    return env
+
+def expandVars(text, env):
+    # Expand $VAR and ${VAR} with values from 'env', unknown variables are left unchanged
+    # as os.path.expandvars does
+    if '$' not in text:
+        return text
+    import re
+    return re.sub(r'\$(\w+|\{[^}]*\})',
+                lambda m: env.get(m.group(1).strip('{}'), m.group(0)), text)
+
+def splitArgs(text, env):
+    # Split string into list of arguments as shell does and expand env variables
+    import shlex
+    return [expandVars(arg, env) for arg in shlex.split(text)]
+
+def expandPath(path, env):
+    # Expansion of source path as shell did it: variables, '~' and wildcards
+    path = os.path.expanduser(expandVars(path, env))
+    if any(c in path for c in '*?['):
+        import glob
+        paths = sorted(glob.glob(path))
+        if paths:
+            return paths
+    return [path]
+
+def formatArgs(args):
+    # Command line for logging
+    if isinstance(args, string_types):
+        return args
+    return ' '.join(shellQuote(arg) for arg in args)
+
+def runInThreads(tasks, maxWorkers, stopOnError = False, failOnFalse = False):
+    # Run callables from the list 'tasks' using no more than 'maxWorkers' threads at once.
+    # Returns list of tuples (result, exc_info) in the same order as 'tasks'.
+    # Tasks which were not started because of 'stopOnError' have None instead of tuple.
+    # With 'failOnFalse' task which returned false value is failed as raised one.
+    results  = [None] * len(tasks)
+    lock     = threading.Lock()
+    state    = { 'next' : 0, 'failed' : False }
+
+    def worker():
+        while True:
+            with lock:
+                idx = state['next']
+                if idx >= len(tasks) or (stopOnError and state['failed']):
+                    return
+                state['next'] += 1
+            try:
+                results[idx] = (tasks[idx](), None)
+                failed = failOnFalse and not results[idx][0]
+            except Exception:
+                results[idx] = (None, sys.exc_info())
+                failed = True
+            if failed:
+                with lock:
+                    state['failed'] = True
+
+    threads = [threading.Thread(target = worker) for _ in range(min(maxWorkers, len(tasks)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return results
+
+class ReportBuilder(object):
+    # Collects formatted log records for the email report with limited size.
+    # Records longer than 'maxRecordSize' are cut in the middle and when the whole
+    # report is bigger than 'maxSize' only its beginning and ending are kept.
+    # Everything cut is written to the gzipped spill file in 'spillDir' or to the
+    # spill file of 'spillTo' report, so reports of archives share the main one.
+    # Only 'spillKeep' last spill files are kept in 'spillDir'.
+
+    SEPARATOR = "\r\n"
+
+    def __init__(self, maxSize, maxRecordSize, spillDir, name = 'report', spillTo = None,
+                spillKeep = EMAIL_SPILL_KEEP):
+        self.maxSize       = maxSize
+        self.maxRecordSize = min(maxRecordSize, maxSize // 2)
+        self.spillDir      = spillDir
+        self.name          = name
+        self.spillTo       = spillTo
+        self.spillKeep     = spillKeep
+        self.spillPath     = None
+        self._spillFile    = None
+        self._lock         = threading.RLock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._head        = []
+            self._headSize    = 0
+            self._tail        = deque()
+            self._tailSize    = 0
+            self._omitted     = 0
+            self._omittedSize = 0
+
+    def __len__(self):
+        return len(self._head) + len(self._tail) + self._omitted
+
+    def add(self, text):
+        with self._lock:
+            self._add(text)
+
+    def extend(self, texts):
+        # texts are added together, records of other threads don't get between them
+        with self._lock:
+            for text in texts:
+                self._add(text)
+
+    def _add(self, text):
+        if len(text) > self.maxRecordSize:
+            self._spill(text)
+            half = self.maxRecordSize // 2
+            text = "%s\n[... %d chars omitted, full text in %s ...]\n%s" % \
+                    (text[:half], len(text) - 2 * half, self.spillPath, text[-half:])
+
+        size = len(text) + len(self.SEPARATOR)
+        if not self._tail and self._headSize + size <= self.maxSize // 2:
+            self._head.append(text)
+            self._headSize += size
+            return
+
+        self._tail.append(text)
+        self._tailSize += size
+        while self._tailSize > self.maxSize // 2 and len(self._tail) > 1:
+            dropped = self._tail.popleft()
+            self._tailSize -= len(dropped) + len(self.SEPARATOR)
+            self._omitted += 1
+            self._omittedSize += len(dropped)
+            self._spill(dropped)
+
+    def parts(self):
+        # Kept records and the note about omitted ones
+        with self._lock:
+            parts = list(self._head)
+            if self._omitted:
+                parts.append("[... %d records (%d chars) omitted, full text in %s ...]" % \
+                            (self._omitted, self._omittedSize, self.spillPath))
+            parts.extend(self._tail)
+            return parts
+
+    def build(self):
+        return self.SEPARATOR.join(self.parts() + [''])
+
+    def closeSpill(self):
+        with self._lock:
+            if self._spillFile:
+                self._spillFile.close()
+                self._spillFile = None
+
+    def removeSpill(self):
+        # Spill file is removed when it's not needed anymore, for example it's sent
+        with self._lock:
+            self.closeSpill()
+            if self.spillPath and os.path.exists(self.spillPath):
+                os.remove(self.spillPath)
+            self.spillPath = None
+
+    def _spill(self, text):
+        if self.spillTo is not None:
+            with self.spillTo._lock:
+                self.spillTo._spill(text)
+                self.spillPath = self.spillTo.spillPath
+            return
+        if not self._spillFile:
+            import gzip
+            spillDir = self.spillDir
+            if not spillDir:
+                import tempfile
+                spillDir = tempfile.gettempdir()
+            makeDir(spillDir)
+            spillDir = os.path.realpath(os.path.expanduser(spillDir))
+            self._rotateSpills(spillDir)
+            self.spillPath = os.path.join(spillDir,
+                    '%s-%s-%d.log.gz' % (self.name, time.strftime('%Y%m%d-%H%M%S'), os.getpid()))
+            self._spillFile = gzip.open(self.spillPath, 'wb')
+        self._spillFile.write((text + '\n').encode('utf-8'))
+
+    def _rotateSpills(self, spillDir):
+        # Old spill files of the report are removed before the new one is created
+        import re
+        pattern = re.compile(re.escape(self.name) + r'-\d{8}-\d{6}-\d+\.log\.gz$')
+        names = sorted(name for name in os.listdir(spillDir) if pattern.match(name))
+        for name in names[:max(0, len(names) - max(0, self.spillKeep - 1))]:
+            try:
+                os.remove(os.path.join(spillDir, name))
+            except OSError:
+                pass
+
 class BufferingSMTPHandler(logging.handlers.BufferingHandler):
 
-    def __init__(self, emailConf):
-        # capacity here is number of the log records
-        super(BufferingSMTPHandler, self).__init__(capacity = 2000)
+    def __init__(self, emailConf, name = 'report'):
+        # capacity is not used, size of report is limited by ReportBuilder
+        super(BufferingSMTPHandler, self).__init__(capacity = 0)
+        self.report = ReportBuilder(emailConf.get('max-size', EMAIL_MAX_SIZE),
+                                    emailConf.get('max-record-size', EMAIL_MAX_RECORD_SIZE),
+                                    emailConf.get('spill-dir'), name,
+                                    spillKeep = emailConf.get('spill-keep', EMAIL_SPILL_KEEP))
+        self.attachSpill = emailConf.get('attach-spill', False)
         self.emailConf = defaultdict(str, emailConf)
+        # marks like '[REGRESSION]' for subject of next email, see UnitLogger.markSubject
+        self.subjectMarks = set()
 
         if 'to' not in emailConf:
             raise KeyError("Field 'to' not found in email config")
@@ -82,34 +399,67 @@ class BufferingSMTPHandler(logging.handlers.BufferingHandler):
             if 'password' not in smtpConf:
                 self.emailConf['smtp']['password'] = ''
 
+    def shouldFlush(self, record):
+        return False
+
+    def emit(self, record):
+        try:
+            self.report.add(self.format(record))
+        except Exception:
+            self.handleError(record)
+
+    def _makeMessage(self, body):
+        from email.mime.text import MIMEText
+        #msg = MIMEText(body.encode('utf-8'), _charset="utf-8")
+        msg = MIMEText(body, _charset="utf-8")
+        spillPath = self.report.spillPath
+        if not self.attachSpill or not spillPath or \
+                os.path.getsize(spillPath) + len(body) > self.report.maxSize:
+            return msg
+
+        from email.mime.multipart import MIMEMultipart
+        from email.mime.application import MIMEApplication
+        multipart = MIMEMultipart()
+        multipart.attach(msg)
+        with open(spillPath, 'rb') as f:
+            attachment = MIMEApplication(f.read(), 'gzip')
+        attachment.add_header('Content-Disposition', 'attachment',
+                                filename = os.path.basename(spillPath))
+        multipart.attach(attachment)
+        return multipart
+
     def flush(self):
 
         log = logging.getLogger(__name__)
 
+        self.acquire()
         try:
-            if not self.buffer:
+            if not len(self.report):
                 return
 
-            body = ""
-            for record in self.buffer:
-                body = body + self.format(record) + "\r\n"
+            body = self.report.build()
+            self.report.closeSpill()
 
-            #msg = MIMEText(body.encode('utf-8'), _charset="utf-8")
-            msg = MIMEText(body, _charset="utf-8")
+            msg = self._makeMessage(body)
             msg['Subject'] = self.emailConf['subject']
             msg['From']    = self.emailConf['from']
             msg['To']      = self.emailConf['to']
 
             if self.level >= logging.ERROR:
                 msg['Subject'] += ' [A PROBLEM]'
+            for mark in sorted(self.subjectMarks):
+                msg['Subject'] += ' [%s]' % mark
 
             if self.useSendmail:
-                sendmail = find_executable('sendmail')
+                sendmail = findExecutable('sendmail')
+                if not sendmail:
+                    raise IOError("Tool 'sendmail' not found")
                 p = subprocess.Popen([sendmail, "-t", "-oi"],
                         stdin = subprocess.PIPE, universal_newlines = True)
                 p.communicate(msg.as_string())
 
             else:
+                import smtplib
                 smtpConf = self.emailConf['smtp']
                 smtp = smtplib.SMTP(smtpConf['host'], smtpConf['port'])
                 if smtpConf['useSTARTTLS']:
@@ -121,9 +471,17 @@ class BufferingSMTPHandler(logging.handlers.BufferingHandler):
                 smtp.quit()
 
             log.info('Email was sent')
-            self.buffer = []
+            self.report.reset()
+            if msg.is_multipart():
+                # spill file is attached, so it's not needed anymore
+                self.report.removeSpill()
+            else:
+                self.report.spillPath = None
+            self.subjectMarks.clear()
         except Exception as exc:
             log.error("Error during mail sending:\n%s", exc)
+        finally:
+            self.release()
 
 class UnitLogger(object):
 
@@ -134,9 +492,13 @@ class UnitLogger(object):
         emailLogLevel = config.EMAIL_LOG_LEVEL \
                             if hasattr(config, 'EMAIL_LOG_LEVEL') else commonLogLevel
 
-        # get ready to use default logger
-        self.consoleLog = logging.getLogger(__name__)
+        # Each config has own child of default logger to have own log levels,
+        # messages go to handlers of default logger
+        unitName = getattr(config, '__name__', 'config')
+        self.consoleLog = logging.getLogger('%s.%s' % (__name__, unitName))
         self.consoleLog.setLevel(consoleLogLevel)
+        # it's used to distinguish output of configs processed at the same time
+        self.consolePrefix = ''
 
         # setup mail logger
         self.mailLog = None
@@ -144,56 +506,1380 @@ class UnitLogger(object):
         if useMail and 'use' in config.email:
             useMail = config.email['use']
         if useMail:
-            self.mailLog = logging.getLogger('mail')
+            self.mailLog = logging.getLogger('mail.%s' % unitName)
+            self.mailLog.propagate = False
             self.mailLog.setLevel(emailLogLevel)
-            smtpHandler = BufferingSMTPHandler(config.email)
+            smtpHandler = BufferingSMTPHandler(config.email, 'report-%s' % unitName)
             smtpHandler.setLevel(emailLogLevel)
             smtpHandler.setFormatter(LOG_FORMATTER)
             self.mailLog.addHandler(smtpHandler)
+        self._mailHandler = smtpHandler if useMail else None
 
         self.enableMail = True
 
+        # per thread context, see archiveContext
+        self._local = threading.local()
+
+    @contextmanager
+    def archiveContext(self, prefix, parentReport = None):
+        # All messages from current thread are prefixed and mail records are
+        # collected to own report and added to the mail report together at the end,
+        # so output for different archives processed in parallel doesn't interleave
+        # in reports. Report of archive is limited as the mail report is.
+        # With 'parentReport' (see contextReport) records are added to context
+        # of other thread instead of the mail report.
+        report = None
+        if self._mailHandler:
+            main = self._mailHandler.report
+            report = ReportBuilder(main.maxSize, main.maxRecordSize, main.spillDir,
+                                    main.name, spillTo = main, spillKeep = main.spillKeep)
+        self._local.prefix = prefix
+        self._local.mailReport = report
+        try:
+            yield
+        finally:
+            self._local.prefix = ''
+            self._local.mailReport = None
+            if report is not None and len(report):
+                target = parentReport if parentReport is not None else main
+                target.extend(report.parts())
+
+    def markSubject(self, mark):
+        # Mark is added to subject of next email report
+        if self.mailLog:
+            for handler in self.mailLog.handlers:
+                handler.subjectMarks.add(mark)
+
+    def contextReport(self):
+        # Mail report of archiveContext of current thread or None
+        return getattr(self._local, 'mailReport', None)
+
+    def _log(self, level, msg, *args, **kw):
+        toMail = kw.pop('toMail', True)
+        prefix = getattr(self._local, 'prefix', '')
+        if prefix:
+            msg = (prefix.replace('%', '%%') if args else prefix) + msg
+        consolePrefix = self.consolePrefix
+        if consolePrefix and args:
+            consolePrefix = consolePrefix.replace('%', '%%')
+        self.consoleLog.log(level, consolePrefix + msg, *args, **kw)
+        if not toMail or not self.enableMail or not self.mailLog:
+            return
+        report = getattr(self._local, 'mailReport', None)
+        if report is None:
+            self.mailLog.log(level, msg, *args, **kw)
+        elif self.mailLog.isEnabledFor(level) and level >= self._mailHandler.level:
+            record = self.mailLog.makeRecord(self.mailLog.name, level,
+                                    '(unknown file)', 0, msg, args, None)
+            try:
+                report.add(self._mailHandler.format(record))
+            except Exception:
+                self._mailHandler.handleError(record)
+
+    def flushMail(self):
+        if self.mailLog:
+            for handler in self.mailLog.handlers:
+                handler.flush()
+
+    def close(self):
+        # Send buffered email and detach handler, it's used when config is reloaded
+        # in daemon mode to have only one handler for the same mail logger
+        if self.mailLog:
+            for handler in list(self.mailLog.handlers):
+                handler.flush()
+                self.mailLog.removeHandler(handler)
+                handler.close()
+
     def debug(self, *k, **kw):
-        self.consoleLog.debug(*k, **kw)
-        if self.enableMail and self.mailLog:
-            self.mailLog.debug(*k, **kw)
+        self._log(logging.DEBUG, *k, **kw)
+
+    def progress(self, *k):
+        # progress lines go only to console, they are useless in email report
+        self._log(logging.INFO, *k, **{ 'toMail' : False })
 
     def info(self, *k, **kw):
-        self.consoleLog.info(*k, **kw)
-        if self.enableMail and self.mailLog:
-            self.mailLog.info(*k, **kw)
+        self._log(logging.INFO, *k, **kw)
 
     def warning(self, *k, **kw):
-        self.consoleLog.warning(*k, **kw)
-        if self.enableMail and self.mailLog:
-            self.mailLog.warning(*k, **kw)
+        self._log(logging.WARNING, *k, **kw)
 
     def error(self, *k, **kw):
-        self.consoleLog.error(*k, **kw)
-        if self.enableMail and self.mailLog:
-            self.mailLog.error(*k, **kw)
+        self._log(logging.ERROR, *k, **kw)
 
     def critical(self, *k, **kw):
-        self.consoleLog.critical(*k, **kw)
-        if self.enableMail and self.mailLog:
-            self.mailLog.critical(*k, **kw)
+        self._log(logging.CRITICAL, *k, **kw)
+
+def formatSize(size):
+    for unit in ('B', 'kB', 'MB', 'GB', 'TB'):
+        if abs(size) < 1000 or unit == 'TB':
+            break
+        size = size / 1000.0
+    return '%.2f %s' % (size, unit) if unit != 'B' else '%d B' % size
+
+def formatDuration(seconds):
+    seconds = int(seconds)
+    return '%d:%02d:%02d' % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+def writeFileAtomic(path, text):
+    path = os.path.realpath(os.path.expanduser(path))
+    makeDir(os.path.dirname(path))
+    tmpPath = '%s.tmp%d' % (path, os.getpid())
+    with open(tmpPath, 'w') as f:
+        f.write(text)
+    os.rename(tmpPath, path)
+
+def loadJsonFile(path, default = None):
+    import json
+    path = os.path.realpath(os.path.expanduser(path))
+    if not os.path.exists(path):
+        return default
+    with open(path) as f:
+        return json.load(f)
+
+def saveJsonFile(path, data):
+    import json
+    writeFileAtomic(path, json.dumps(data, indent = 1, sort_keys = True))
+
+def repoFileName(name, repo):
+    # Safe and unique name of file or directory of repository
+    import re, hashlib
+    safeRepo = re.sub(r'[^A-Za-z0-9._-]+', '_', repo).strip('_')[-60:]
+    digest = hashlib.sha1(repo.encode('utf-8') if PY3 else repo).hexdigest()[:10]
+    return '%s-%s-%s' % (name, safeRepo, digest)
+
+def stateFileName(name, repo):
+    # Safe and unique name of file with state of repository
+    return repoFileName(name, repo) + '.json'
+
+def listDirEntries(path):
+    # Returns list of tuples (path, lstat result, is directory) for entries of directory
+    entries = []
+    if hasattr(os, 'scandir'):
+        for entry in os.scandir(path):
+            isDir = entry.is_dir(follow_symlinks = False)
+            entries.append((entry.path, entry.stat(follow_symlinks = False), isDir))
+    else:
+        import stat
+        for name in os.listdir(path):
+            entryPath = os.path.join(path, name)
+            st = os.lstat(entryPath)
+            entries.append((entryPath, st, stat.S_ISDIR(st.st_mode)))
+    return entries
+
+def treeUsage(path, excluded = None):
+    # Returns tuple (bytes, files) of the tree without 'excluded' paths, symlinks are
+    # not followed
+    size = files = 0
+    stack = [path]
+    while stack:
+        try:
+            entries = listDirEntries(stack.pop())
+        except OSError:
+            continue
+        for entryPath, st, isDir in entries:
+            if excluded and excluded(entryPath):
+                continue
+            if isDir:
+                stack.append(entryPath)
+            else:
+                size += st.st_size
+                files += 1
+    return size, files
+
+def shardWeight(size, files):
+    return size + files * SHARD_FILE_COST
+
+def scanShardUnits(roots, excluded = None, threads = SCAN_THREADS):
+    # Units of sharding are top level subdirectories of roots, they are scanned in
+    # parallel. Returns tuple (dict path -> weight, weight of other entries of roots),
+    # other entries are always backed up by shard 0. Paths matched by 'excluded' are
+    # not units and they are not counted.
+    excluded = excluded or (lambda path: False)
+    units = []
+    rootWeight = 0
+    for root in roots:
+        if excluded(root):
+            continue
+        if not os.path.isdir(root) or os.path.islink(root):
+            if os.path.lexists(root):
+                rootWeight += shardWeight(os.lstat(root).st_size, 1)
+            continue
+        for entryPath, st, isDir in listDirEntries(root):
+            if excluded(entryPath):
+                continue
+            if isDir:
+                units.append(entryPath)
+            else:
+                rootWeight += shardWeight(st.st_size, 1)
+
+    results = runInThreads([lambda path = path: treeUsage(path, excluded) for path in units],
+                            threads)
+    weights = {}
+    for path, (usage, excInfo) in zip(units, results):
+        if excInfo:
+            raise excInfo[1]
+        weights[path] = shardWeight(*usage)
+    return weights, rootWeight
+
+def assignShards(weights, rootWeight, count, previous, maxImbalance = SHARD_MAX_IMBALANCE):
+    # Assign units with 'weights' to 'count' shards. Units keep their shards from
+    # 'previous' assignment to keep deduplication, new units go to the lightest shard.
+    # Units are moved only while the heaviest shard is heavier than 'maxImbalance'
+    # of average one. Returns tuple (dict path -> shard, loads of shards, moved units).
+    loads = [0] * count
+    loads[0] = rootWeight
+    units = {}
+    for path, index in previous.items():
+        if path in weights and 0 <= index < count:
+            units[path] = index
+            loads[index] += weights[path]
+    for path in sorted((path for path in weights if path not in units),
+                        key = lambda path: (-weights[path], path)):
+        index = loads.index(min(loads))
+        units[path] = index
+        loads[index] += weights[path]
+
+    moved = 0
+    average = float(sum(loads)) / count
+    for _ in range(len(units)):
+        heavy = loads.index(max(loads))
+        light = loads.index(min(loads))
+        if loads[heavy] <= average * maxImbalance:
+            break
+        # unit closest to half of difference makes both shards closer to average
+        gap = loads[heavy] - loads[light]
+        candidates = [path for path, index in units.items()
+                        if index == heavy and 0 < weights[path] < gap]
+        if not candidates:
+            break
+        path = min(candidates, key = lambda path: (abs(weights[path] - gap / 2.0), path))
+        units[path] = light
+        loads[heavy] -= weights[path]
+        loads[light] += weights[path]
+        moved += 1
+    return units, loads, moved
+
+def shardDestination(destination, name):
+    # rclone destination of shard: each shard is uploaded to own directory
+    if isinstance(destination, string_types):
+        return '%s.%s' % (destination, name)
+    if isinstance(destination, dict):
+        if not destination.get('remote'):
+            return destination
+        return dict(destination, remote = '%s.%s' % (destination['remote'], name))
+    if destination:
+        return tuple(shardDestination(dest, name) for dest in destination)
+    return destination
+
+def borgPath(path):
+    # Path as borg matches it with patterns: normalized and without leading slash
+    return os.path.normpath(path).lstrip('/')
+
+def shellPatternRegex(pattern):
+    # Regular expression for borg pattern of style 'sh:' which matches path or its
+    # parents as borg does: '*' and '?' don't match '/', '**/' matches any number of
+    # directories (also none).
+    import re
+    pattern = pattern.rstrip('/') + '/**/'
+    regex = ''
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        i += 1
+        if c == '*':
+            if pattern[i:i + 2] == '*/':
+                regex += '(?:[^/]*/)*'
+                i += 2
+            else:
+                regex += '[^/]*'
+        elif c == '?':
+            regex += '[^/]'
+        elif c == '[':
+            end = i + 1 if pattern[i:i + 1] == '!' else i
+            end = pattern.find(']', end + 1 if pattern[end:end + 1] == ']' else end)
+            if end < 0:
+                regex += '\\['
+                continue
+            chars = pattern[i:end].replace('\\', '\\\\')
+            i = end + 1
+            if chars.startswith('!'):
+                chars = '^' + chars[1:]
+            elif chars.startswith('^'):
+                chars = '\\' + chars
+            regex += '[%s]' % chars
+        else:
+            regex += re.escape(c)
+    return re.compile('(?ms)' + regex + '\\Z')
+
+def excludeMatcher(patterns):
+    # Returns function which checks if path is excluded by borg patterns: shell patterns
+    # ('fm:' is default style, 'sh:') match path or its parents, 'pp:' is prefix of
+    # path, 'pf:' is the whole path and 're:' is regular expression. In 'fm:' patterns '*'
+    # matches also '/', see shellPatternRegex about 'sh:'. Path should be given as borg
+    # gets it: source as it is in config joined with names of entries.
+    import re, fnmatch
+    checks = []
+    for pattern in patterns:
+        match = re.match(r'^(fm|sh|pp|pf|re):(.*)$', pattern)
+        style, pattern = match.groups() if match else ('fm', pattern)
+        if style == 're':
+            regex = re.compile(pattern)
+            checks.append(lambda path, regex = regex: bool(regex.search(path)))
+            continue
+        pattern = borgPath(pattern)
+        if style == 'pp':
+            prefix = pattern.rstrip('/') + '/'
+            checks.append(lambda path, pattern = pattern, prefix = prefix:
+                            path == pattern or path.startswith(prefix))
+        elif style == 'pf':
+            checks.append(lambda path, pattern = pattern: path == pattern)
+        elif style == 'sh':
+            regex = shellPatternRegex(pattern)
+            checks.append(lambda path, regex = regex: bool(regex.match(path + '/')))
+        else:
+            checks.append(lambda path, pattern = pattern: fnmatch.fnmatch(path, pattern) or
+                            fnmatch.fnmatch(path, pattern + '/*'))
+    if not checks:
+        return lambda path: False
+    return lambda path: any(check(borgPath(path)) for check in checks)
+
+def isCacheDir(path):
+    # Directory with CACHEDIR.TAG, see http://www.bford.info/cachedir/
+    try:
+        with open(os.path.join(path, 'CACHEDIR.TAG'), 'rb') as f:
+            return f.read(len(CACHEDIR_TAG_SIGNATURE)) == CACHEDIR_TAG_SIGNATURE
+    except (IOError, OSError):
+        return False
+
+def analyzeTree(path, level, excluded, since, depth = ANALYZE_DEPTH, recursive = True):
+    # Walks the tree 'path' which is 'level' levels below root of sources (only the
+    # directory itself without 'recursive'), paths for which 'excluded' returns True
+    # are skipped. Returns tuple (subtrees, junk):
+    # 'subtrees' is dict path -> [bytes, files, changed bytes, changed files], files deeper
+    # than 'depth' levels are counted for their parent of that level, files are changed
+    # if their mtime or ctime is newer than 'since'; 'junk' is dict path -> [reason, bytes,
+    # files], see ANALYZE_JUNK_DIRS.
+    import fnmatch
+    subtrees = {}
+    junk = {}
+    name = os.path.basename(path)
+    stack = [(path, level, path, path if name in ANALYZE_JUNK_DIRS else None)]
+    if stack[0][3]:
+        junk[path] = [name, 0, 0]
+    while stack:
+        dirPath, dirLevel, key, junkPath = stack.pop()
+        try:
+            entries = listDirEntries(dirPath)
+        except OSError:
+            continue
+        if not junkPath and any(os.path.basename(entry[0]) == 'CACHEDIR.TAG'
+                                for entry in entries) and isCacheDir(dirPath):
+            junkPath = dirPath
+            junk[dirPath] = ['CACHEDIR.TAG', 0, 0]
+        counters = subtrees.setdefault(key, [0, 0, 0, 0])
+        for entryPath, st, isDir in entries:
+            if excluded(entryPath):
+                continue
+            name = os.path.basename(entryPath)
+            if isDir:
+                if not recursive:
+                    continue
+                entryJunk = junkPath
+                if not entryJunk and name in ANALYZE_JUNK_DIRS:
+                    entryJunk = entryPath
+                    junk[entryPath] = [name, 0, 0]
+                stack.append((entryPath, dirLevel + 1,
+                            entryPath if dirLevel < depth else key, entryJunk))
+                continue
+            counters[0] += st.st_size
+            counters[1] += 1
+            if max(st.st_mtime, st.st_ctime) > since:
+                counters[2] += st.st_size
+                counters[3] += 1
+            fileJunk = junkPath
+            if not fileJunk:
+                pattern = next((pattern for pattern in ANALYZE_JUNK_FILES
+                                if fnmatch.fnmatch(name, pattern)), None)
+                if pattern:
+                    fileJunk = entryPath
+                    junk[entryPath] = [pattern, 0, 0]
+            if fileJunk:
+                junk[fileJunk][1] += st.st_size
+                junk[fileJunk][2] += 1
+    return subtrees, junk
+
+def sampleFiles(sources, excludes, maxFiles = AUTO_COMPRESSION_SAMPLE_FILES,
+                chunkSize = AUTO_COMPRESSION_CHUNK_SIZE, maxDirs = AUTO_COMPRESSION_MAX_DIRS):
+    # Returns list of chunks of data from no more than 'maxFiles' files of sources.
+    # Directories are walked breadth-first (no more than 'maxDirs' of them), files are
+    # taken evenly from found ones, each file gives one chunk from its middle.
+    # Patterns 'excludes' are borg patterns, see excludeMatcher.
+    import stat
+    excluded = excludeMatcher(excludes)
+
+    files = []
+    dirs = deque()
+    for source in sources:
+        source = os.path.normpath(source)
+        if os.path.isdir(source):
+            dirs.append(source)
+        elif os.path.isfile(source) and not excluded(source):
+            files.append((source, os.path.getsize(source)))
+    visited = 0
+    while dirs and visited < maxDirs and len(files) < maxFiles * 10:
+        visited += 1
+        try:
+            entries = listDirEntries(dirs.popleft())
+        except OSError:
+            continue
+        for path, st, isDir in entries:
+            if excluded(path):
+                continue
+            if isDir:
+                dirs.append(path)
+            elif stat.S_ISREG(st.st_mode) and st.st_size > 0:
+                files.append((path, st.st_size))
+
+    step = max(1, len(files) // maxFiles)
+    chunks = []
+    for path, size in files[::step][:maxFiles]:
+        try:
+            with open(path, 'rb') as f:
+                f.seek(max(0, size // 2 - chunkSize // 2))
+                chunks.append(f.read(chunkSize))
+        except (IOError, OSError):
+            continue
+    return chunks
+
+def compressionCodec(spec):
+    # Returns compress function for candidate of compression 'auto' or None if
+    # the algorithm is not available in python
+    name, level = (spec.split(',') + ['0'])[:2]
+    try:
+        if name == 'lz4':
+            import lz4.frame
+            return lz4.frame.compress
+        if name == 'zstd':
+            import zstandard
+            return zstandard.ZstdCompressor(level = int(level)).compress
+        if name == 'zlib':
+            import zlib
+            return lambda data: zlib.compress(data, int(level))
+        if name == 'lzma':
+            import lzma
+            return lambda data: lzma.compress(data, preset = int(level))
+    except ImportError:
+        pass
+    return None
+
+def benchmarkCompression(chunks):
+    # Returns dict spec -> { 'ratio', 'speed' in MB/s } for candidates of compression
+    # 'auto' which can be measured
+    total = sum(len(chunk) for chunk in chunks)
+    results = {}
+    for spec in AUTO_COMPRESSION_CANDIDATES:
+        compress = compressionCodec(spec)
+        if not compress:
+            continue
+        start = time.time()
+        size = sum(len(compress(chunk)) for chunk in chunks)
+        duration = max(time.time() - start, 1e-6)
+        results[spec] = {
+            'ratio' : float(size) / total if total else 1.0,
+            'speed' : total / duration / 1e6,
+        }
+    return results
+
+def chooseCompression(results, minSpeed):
+    # The strongest measured candidate which is fast enough and makes data noticeably
+    # smaller than the previous chosen one, 'lz4' (borg default) if none of them is.
+    # 'auto' makes borg skip compression of incompressible chunks.
+    chosen = None
+    for spec in AUTO_COMPRESSION_CANDIDATES:
+        if spec not in results or results[spec]['speed'] < minSpeed:
+            continue
+        if chosen is None or \
+                results[spec]['ratio'] <= results[chosen]['ratio'] * AUTO_COMPRESSION_MIN_GAIN:
+            chosen = spec
+    return 'auto,' + chosen if chosen and chosen != 'lz4' else 'lz4'
+
+def statSignature(st):
+    return '%o\0%d\0%d\0%r\0%r' % (st.st_mode, st.st_size, st.st_ino, st.st_mtime, st.st_ctime)
+
+def treeSignature(path, recursive = True, st = None):
+    # Digest of paths, types, sizes, inodes, mtimes and ctimes of all entries in the tree,
+    # without 'recursive' only entries of the directory itself which are not directories.
+    # Stat 'st' of the directory itself is included if it's given.
+    import hashlib
+    digest = hashlib.sha1()
+    if st:
+        digest.update(statSignature(st).encode('utf-8'))
+    stack = [path]
+    while stack:
+        dirPath = stack.pop()
+        try:
+            entries = sorted(listDirEntries(dirPath))
+        except OSError as exc:
+            # it will be reported by borg, just make signature different
+            digest.update(('%s\0error %s\n' % (dirPath, exc.errno)).encode('utf-8'))
+            continue
+        for entryPath, st, isDir in entries:
+            if isDir and not recursive:
+                continue
+            line = '%s\0%s\n' % (entryPath, statSignature(st))
+            digest.update(line.encode('utf-8', 'surrogateescape') if PY3 else line)
+            if isDir and recursive:
+                stack.append(entryPath)
+    return digest.hexdigest()
+
+def scanSourceSignatures(sources, threads = SCAN_THREADS):
+    # Signatures of 'sources': dict of source -> signature of its root entries and
+    # path of top level directory -> signature of its tree. Directories are scanned
+    # in parallel.
+    parts = []
+    for source in sources:
+        root = os.path.realpath(os.path.expanduser(source))
+        if not os.path.isdir(root):
+            parts.append((source, lambda root = root: statSignature(os.lstat(root)) \
+                                    if os.path.lexists(root) else 'none'))
+            continue
+        # files of the root and each subdirectory with its own entry separately, so
+        # signatures can be divided between shards
+        parts.append((source, lambda root = root: treeSignature(root, False)))
+        for entryPath, st, isDir in listDirEntries(root):
+            if isDir:
+                parts.append((os.path.join(source, os.path.basename(entryPath)),
+                            lambda entryPath = entryPath, st = st:
+                                treeSignature(entryPath, st = st)))
+
+    results = runInThreads([func for _, func in parts], threads)
+    signatures = {}
+    for (name, _), (signature, excInfo) in zip(parts, results):
+        if excInfo:
+            raise excInfo[1]
+        signatures[name] = signature
+    return signatures
+
+class SourcesIndex(object):
+    # Signatures of source trees of archive saved between runs to find out
+    # that nothing was changed since last 'borg create', see 'skip-unchanged'.
+    # Signatures can be set by owner instead of scan, see _shardSignatures.
+
+    def __init__(self, path, sources, threads = SCAN_THREADS):
+        self.path       = path
+        self.sources    = sources
+        self.threads    = threads
+        self.signatures = None
+
+    def scan(self):
+        self.signatures = scanSourceSignatures(self.sources, self.threads)
+        return self.signatures
+
+    def unchangedAge(self):
+        # Age of last saved index in seconds if sources are not changed or None
+        saved = loadJsonFile(self.path, {})
+        if not saved or saved.get('signatures') != self.signatures:
+            return None
+        return time.time() - saved.get('created', 0)
+
+    def save(self):
+        saveJsonFile(self.path, { 'created' : time.time(), 'signatures' : self.signatures })
+
+def fileHash(path):
+    import hashlib
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+class UploadManifest(object):
+    # Files of local repository which were already uploaded by rclone, see 'incremental'
+    # in config_test.py. Each file is [size, mtime, sha256 or None], hashes are used only
+    # with 'useHash' to not upload files with changed mtime but the same content.
+
+    def __init__(self, path, source, useHash = False):
+        self.path    = path
+        self.source  = source
+        self.useHash = useHash
+        saved = loadJsonFile(path, {})
+        self.lastFullSync = saved.get('last-full-sync', 0)
+        self.files        = saved.get('files', {})
+        self.current      = None
+
+    def isFullSyncDue(self, interval):
+        return time.time() - self.lastFullSync >= interval
+
+    def scan(self):
+        self.root = os.path.realpath(os.path.expanduser(self.source))
+        self.current = {}
+        stack = ['']
+        while stack:
+            relDir = stack.pop()
+            for entryPath, st, isDir in listDirEntries(os.path.join(self.root, relDir)):
+                relPath = os.path.join(relDir, os.path.basename(entryPath))
+                if isDir:
+                    stack.append(relPath)
+                else:
+                    self.current[relPath] = [st.st_size, st.st_mtime, None]
+        return self.current
+
+    def changedFiles(self):
+        changed = []
+        for relPath, info in self.current.items():
+            uploaded = self.files.get(relPath)
+            if uploaded and uploaded[:2] == info[:2]:
+                info[2] = uploaded[2]
+                continue
+            if self.useHash:
+                info[2] = fileHash(os.path.join(self.root, relPath))
+                if uploaded and uploaded[2] == info[2]:
+                    continue
+            changed.append(relPath)
+        return sorted(changed)
+
+    def save(self, uploaded = None, fullSync = False):
+        # 'uploaded' is list of uploaded files, all current files if it is None
+        if uploaded is None:
+            self.files = dict(self.current)
+        else:
+            for relPath in uploaded:
+                self.files[relPath] = self.current[relPath]
+        if fullSync:
+            self.lastFullSync = time.time()
+        saveJsonFile(self.path, { 'last-full-sync' : self.lastFullSync, 'files' : self.files })
+
+def readRepoId(repo):
+    # Id of local borg repository from its config file or None
+    path = os.path.join(os.path.realpath(os.path.expanduser(repo)), 'config')
+    try:
+        with open(path) as f:
+            for line in f:
+                name, _, value = line.partition('=')
+                if name.strip() == 'id':
+                    return value.strip()
+    except (IOError, OSError):
+        pass
+    return None
+
+class RepoState(object):
+    # Persistent state of repository between runs: if it's initialized, its id and
+    # times of last successful actions. See USE_REPO_STATE in config_test.py
+
+    def __init__(self, path):
+        self.path  = path
+        self.data  = loadJsonFile(path, {})
+        self._lock = threading.Lock()
+
+    def get(self, name, default = None):
+        with self._lock:
+            return self.data.get(name, default)
+
+    def set(self, **values):
+        self.update(values)
+
+    def update(self, values):
+        with self._lock:
+            self.data.update(values)
+            saveJsonFile(self.path, self.data)
+
+    def lastDone(self, action):
+        return self.get('last-done', {}).get(action)
+
+    def markDone(self, action):
+        with self._lock:
+            self.data.setdefault('last-done', {})[action] = time.time()
+            saveJsonFile(self.path, self.data)
+
+    def totals(self, action):
+        # Totals of last successful run of the action, see ProgressTracker
+        return self.get('totals', {}).get(action)
+
+    def setTotals(self, action, totals):
+        with self._lock:
+            self.data.setdefault('totals', {})[action] = totals
+            saveJsonFile(self.path, self.data)
+
+    def isInitialized(self, repo):
+        # Id of local repository is checked to notice recreated or removed repository
+        if not self.get('initialized'):
+            return False
+        if repo.find('@') != -1:
+            return True
+        repoId = readRepoId(repo)
+        if repoId and repoId == self.get('repo-id'):
+            return True
+        self.update({ 'initialized' : False, 'repo-id' : repoId, 'last-done' : {} })
+        return False
+
+class CheckBudget(object):
+    # Time budget of scheduled 'borg check' for one run shared between repositories,
+    # see CHECK_TIME_BUDGET in config_test.py
+
+    MIN_SHARE = 60
+
+    def __init__(self, total, parts):
+        self.remaining = total
+        self.parts     = parts
+        self._lock     = threading.Lock()
+
+    def take(self):
+        # Returns seconds for next repository or 0 if budget is exhausted, the share is
+        # reserved until it's returned by settle()
+        with self._lock:
+            share = int(self.remaining / max(self.parts, 1))
+            self.parts = max(self.parts - 1, 0)
+            if share < self.MIN_SHARE:
+                return 0
+            self.remaining -= share
+            return share
+
+    def settle(self, reserved, spent):
+        # Returns unused part of reserved share or charges time spent over it
+        with self._lock:
+            self.remaining += reserved - spent
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+def findRegressions(current, previous, factor, minDuration = HISTORY_MIN_DURATION):
+    # Compare duration and numeric stats of action with median of 'previous' ones.
+    # Returns list of tuples (metric, value, baseline) which differ more than 'factor'
+    # times in any direction.
+    if len(previous) < HISTORY_MIN_RUNS:
+        return []
+    metrics = dict(current['stats'])
+    metrics['duration'] = current['duration']
+    result = []
+    for name in sorted(metrics):
+        value = metrics[name]
+        values = [item['duration'] if name == 'duration' else item['stats'].get(name)
+                    for item in previous]
+        values = [v for v in values if isinstance(v, (int, float))]
+        if not isinstance(value, (int, float)) or len(values) < HISTORY_MIN_RUNS:
+            continue
+        base = median(values)
+        if name == 'duration' and max(value, base) < minDuration:
+            continue
+        if base <= 0:
+            continue
+        if value > base * factor or value * factor < base:
+            result.append((name, value, base))
+    return result
+
+class RunHistory(object):
+    # History of runs and actions in sqlite database, see HISTORY_DB in config_test.py.
+    # Records are only added. One connection is shared by all threads of the process.
+
+    def __init__(self, path):
+        import sqlite3
+        self.path  = path
+        self._lock = threading.Lock()
+        self._db   = sqlite3.connect(path, timeout = 60, check_same_thread = False)
+        with self._lock:
+            self._db.executescript('''
+                CREATE TABLE IF NOT EXISTS runs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT, config TEXT, pid INTEGER,
+                    start REAL, end REAL, ok INTEGER);
+                CREATE TABLE IF NOT EXISTS actions (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT, run INTEGER, repository TEXT,
+                    action TEXT, start REAL, end REAL, rc INTEGER, output_bytes INTEGER,
+                    stats TEXT, alerts TEXT, skipped INTEGER DEFAULT 0);
+                CREATE INDEX IF NOT EXISTS actions_by_repo
+                    ON actions (repository, action, start);
+            ''')
+            # database of previous version has no column 'skipped'
+            columns = [row[1] for row in self._db.execute('PRAGMA table_info(actions)')]
+            if 'skipped' not in columns:
+                self._db.execute('ALTER TABLE actions ADD COLUMN skipped INTEGER DEFAULT 0')
+            self._db.commit()
+
+    def close(self):
+        self._db.close()
+
+    def _insert(self, sql, values):
+        with self._lock:
+            cursor = self._db.execute(sql, values)
+            self._db.commit()
+            return cursor.lastrowid
+
+    def startRun(self, config):
+        return self._insert('INSERT INTO runs (config, pid, start) VALUES (?, ?, ?)',
+                            (config, os.getpid(), time.time()))
+
+    def finishRun(self, runId, ok):
+        with self._lock:
+            self._db.execute('UPDATE runs SET end = ?, ok = ? WHERE id = ?',
+                            (time.time(), int(bool(ok)), runId))
+            self._db.commit()
+
+    def addAction(self, runId, item, alerts):
+        import json
+        self._insert('INSERT INTO actions (run, repository, action, start, end, rc, '
+                    'output_bytes, stats, alerts, skipped) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (runId, item['repository'], item['action'], item['start'], item['end'],
+                    item['rc'], item['output-bytes'], json.dumps(item['stats']),
+                    json.dumps(alerts) if alerts else None, int(item.get('skipped', False))))
+
+    def actions(self, repo, action, limit, onlyOk = False):
+        # Last actions from new to old ones as dicts like item of addAction,
+        # skipped actions are not included
+        import json
+        sql = 'SELECT start, end, rc, output_bytes, stats FROM actions ' \
+                'WHERE repository = ? AND action = ? AND NOT skipped'
+        if onlyOk:
+            sql += ' AND rc = 0'
+        sql += ' ORDER BY start DESC LIMIT ?'
+        with self._lock:
+            rows = self._db.execute(sql, (repo, action, limit)).fetchall()
+        return [{ 'repository' : repo, 'action' : action, 'start' : start, 'end' : end,
+                'duration' : end - start, 'rc' : rc, 'output-bytes' : outputBytes,
+                'stats' : json.loads(stats) if stats else {} }
+                for start, end, rc, outputBytes, stats in rows]
+
+    def summary(self, config, pattern = ''):
+        # Tuples (repository, action, runs, failed runs, skipped runs) of actions of
+        # runs of config, skipped ones are not counted in runs
+        sql = 'SELECT repository, action, SUM(NOT skipped), SUM(rc != 0), SUM(skipped) ' \
+                'FROM actions ' \
+                'WHERE run IN (SELECT id FROM runs WHERE config = ?) ' \
+                'AND (repository LIKE ? OR action LIKE ?) ' \
+                'GROUP BY repository, action ORDER BY repository, action'
+        like = '%' + pattern + '%'
+        with self._lock:
+            return self._db.execute(sql, (config, like, like)).fetchall()
+
+def printHistory(config, pattern, out = sys.stdout):
+    # Trends of actions of config, see option --history
+    if not getattr(config, 'HISTORY_DB', None):
+        out.write("There is no HISTORY_DB in config '%s'\n" % config.__name__)
+        return False
+    baselineRuns = config.HISTORY_BASELINE_RUNS \
+                    if hasattr(config, 'HISTORY_BASELINE_RUNS') else HISTORY_BASELINE_RUNS
+    history = RunHistory(os.path.expanduser(config.HISTORY_DB))
+    out.write("History of config '%s':\n" % config.__name__)
+    out.write('%-40s %-16s %5s %6s %7s %-16s %9s %9s %10s %10s\n' % ('REPOSITORY', 'ACTION',
+                'RUNS', 'FAILED', 'SKIPPED', 'LAST RUN', 'DURATION', 'BASELINE', 'SIZE',
+                'BASELINE'))
+    for repo, action, runs, failed, skipped in history.summary(config.__name__, pattern):
+        items = history.actions(repo, action, baselineRuns + 1, onlyOk = True)
+        last, previous = (items[0], items[1:]) if items else (None, [])
+        sizeName = None
+        if last:
+            sizeName = next((name for name in ('original_size', 'bytes')
+                            if name in last['stats']), None)
+        def baseline(name):
+            values = [item['duration'] if name == 'duration' else item['stats'].get(name)
+                        for item in previous]
+            values = [value for value in values if value is not None]
+            return median(values) if values else None
+        baseDuration = baseline('duration')
+        baseSize = baseline(sizeName) if sizeName else None
+        out.write('%-40s %-16s %5d %6d %7d %-16s %9s %9s %10s %10s\n' % (repo[-40:],
+                action[:16], runs or 0, failed or 0, skipped or 0,
+                time.strftime('%Y-%m-%d %H:%M', time.localtime(last['start'])) if last else '-',
+                formatDuration(last['duration']) if last else '-',
+                formatDuration(baseDuration) if baseDuration is not None else '-',
+                formatSize(last['stats'][sizeName]) if sizeName else '-',
+                formatSize(baseSize) if baseSize is not None else '-'))
+    history.close()
+    return True
+
+def acquireLockFile(path):
+    # Returns tuple (opened locked file, None) or (None, pid of owner) if the file
+    # is locked by another process. Lock is released when the file is closed.
+    import fcntl
+    makeDir(os.path.dirname(path))
+    lockFile = open(path, 'a+')
+    try:
+        fcntl.flock(lockFile.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+        lockFile.seek(0)
+        owner = lockFile.read().strip()
+        lockFile.close()
+        return (None, owner or '?')
+    lockFile.seek(0)
+    lockFile.truncate()
+    lockFile.write('%d\n' % os.getpid())
+    lockFile.flush()
+    return (lockFile, None)
+
+def parseCron(expr):
+    # Parse cron expression 'minute hour day-of-month month day-of-week'.
+    # Each field can be '*', number, range 'a-b' with optional step '/n' or list of them.
+    # Returns tuple (list of sets of values, any day of month, any day of week)
+    fields = expr.split()
+    if len(fields) != 5:
+        raise KeyError("Wrong cron expression '%s', it should have 5 fields" % expr)
+    result = []
+    for field, (low, high) in zip(fields, CRON_RANGES):
+        values = set()
+        try:
+            for part in field.split(','):
+                rng, _, step = part.partition('/')
+                if rng == '*':
+                    start, end = low, high
+                elif '-' in rng:
+                    start, end = [int(x) for x in rng.split('-', 1)]
+                else:
+                    start = end = int(rng)
+                    if step:
+                        end = high
+                values.update(range(start, end + 1, int(step) if step else 1))
+        except ValueError:
+            values = set()
+        if not values or min(values) < low or max(values) > high:
+            raise KeyError("Wrong field '%s' in cron expression '%s'" % (field, expr))
+        result.append(values)
+    # both 0 and 7 are Sunday
+    if 7 in result[4]:
+        result[4] = (result[4] - set([7])) | set([0])
+    return (result, fields[2] == '*', fields[4] == '*')
+
+def nextCronTime(cron, after):
+    # Returns timestamp of the first minute after 'after' matching parsed cron expression
+    import datetime
+    (minutes, hours, days, months, weekdays), anyDay, anyWeekday = cron
+    oneDay = datetime.timedelta(days = 1)
+    moment = datetime.datetime.fromtimestamp(after).replace(second = 0, microsecond = 0)
+    moment += datetime.timedelta(minutes = 1)
+    limit = moment + datetime.timedelta(days = 5 * 366)
+    while moment < limit:
+        if moment.month not in months:
+            moment = (moment.replace(day = 1, hour = 0, minute = 0) +
+                        datetime.timedelta(days = 32)).replace(day = 1)
+            continue
+        dayMatched = moment.day in days
+        weekdayMatched = (moment.weekday() + 1) % 7 in weekdays
+        if anyDay and anyWeekday:
+            dayMatched = True
+        elif anyDay or anyWeekday:
+            dayMatched = weekdayMatched if anyDay else dayMatched
+        else:
+            # as in cron, restricted day of month and day of week are combined by 'or'
+            dayMatched = dayMatched or weekdayMatched
+        if not dayMatched:
+            moment = moment.replace(hour = 0, minute = 0) + oneDay
+            continue
+        if moment.hour not in hours:
+            moment = moment.replace(minute = 0) + datetime.timedelta(hours = 1)
+            continue
+        if moment.minute not in minutes:
+            moment += datetime.timedelta(minutes = 1)
+            continue
+        return time.mktime(moment.timetuple())
+    raise KeyError("Cron expression never matches")
+
+def waitProcess(proc):
+    # Wait for the process with os.wait4 to get its resource usage.
+    # Returns rusage or None if it is not available.
+    try:
+        pid, status, rusage = os.wait4(proc.pid, 0)
+    except (AttributeError, OSError):
+        proc.wait()
+        return None
+    if os.WIFSIGNALED(status):
+        proc.returncode = -os.WTERMSIG(status)
+    else:
+        proc.returncode = os.WEXITSTATUS(status)
+    return rusage
+
+def killProcessGroup(proc, gracePeriod):
+    # Process should be started as leader of new process group
+    import signal
+    for sig in (signal.SIGTERM, signal.SIGKILL):
+        try:
+            os.killpg(proc.pid, sig)
+        except OSError:
+            return
+        deadline = time.time() + gracePeriod
+        while time.time() < deadline:
+            if proc.poll() is not None:
+                return
+            time.sleep(0.1)
 
 class ToolResultException(Exception):
+    # 'rc' and 'output' are exit code and output of the tool if it was run
+
+    def __init__(self, message, rc = None, output = None):
+        Exception.__init__(self, message)
+        self.rc     = rc
+        self.output = output
+
+def isRepoMissingError(exc):
+    # Error of borg which can mean that repository was removed: borg exits with code 2
+    # on errors (1 is warning only, killed process has negative code) or the message
+    # about missing repository is found in output
+    import re
+    rc = getattr(exc, 'rc', None)
+    if rc is not None and rc >= 2:
+        return True
+    text = '%s\n%s' % (exc, getattr(exc, 'output', None) or '')
+    return bool(re.search(r"repository\s+.*\s+does\s+not\s+exist|"
+                            r"is\s+not\s+a\s+valid\s+repository", text, re.IGNORECASE))
+
+class CommandTimeout(Exception):
     pass
 
+def iterLinesWithTimeouts(stream, timeout, idleTimeout, tickInterval = None):
+    # Generator of lines from the pipe 'stream' which raises CommandTimeout if there is
+    # no end of output after 'timeout' seconds or no new output during 'idleTimeout' seconds.
+    # With 'tickInterval' it also yields None when there was nothing to yield during
+    # this interval, so the caller can do periodic work while the pipe is idle.
+    import select
+    import codecs
+
+    fd = stream.fileno()
+    decoder = codecs.getincrementaldecoder('utf-8')('replace')
+    start = lastOutput = lastYield = time.time()
+    pending = ''
+    while True:
+        now = time.time()
+        waits = []
+        if timeout:
+            waits.append((start + timeout - now,
+                            'timeout of %s seconds has expired' % timeout))
+        if idleTimeout:
+            waits.append((lastOutput + idleTimeout - now,
+                            'no output during %s seconds' % idleTimeout))
+        if tickInterval:
+            waits.append((lastYield + tickInterval - now, None))
+        wait, reason = min(waits, key = lambda item: item[0]) if waits else (None, None)
+        if wait is not None and wait <= 0:
+            if reason:
+                raise CommandTimeout(reason)
+            lastYield = now
+            yield None
+            continue
+
+        if not select.select([fd], [], [], wait)[0]:
+            continue
+        data = os.read(fd, 65536)
+        if not data:
+            break
+        lastOutput = time.time()
+        pending += decoder.decode(data).replace('\r\n', '\n').replace('\r', '\n')
+        lines = pending.split('\n')
+        pending = lines.pop()
+        if lines:
+            lastYield = lastOutput
+        for line in lines:
+            yield line + '\n'
+
+    pending += decoder.decode(b'', True)
+    if pending:
+        yield pending
+
+class Profiler(object):
+    # Collects wall and CPU time of phases of the run, see PROFILE in config_test.py.
+    # Records of phase 'command' also have CPU time, peak RSS and output size of
+    # the child process. Each record knows about enclosing phase of the same thread.
+
+    def __init__(self, enabled):
+        self.enabled  = enabled
+        self.records  = []
+        self._lock    = threading.Lock()
+        self._local   = threading.local()
+
+    def current(self):
+        return getattr(self._local, 'current', None)
+
+    def setCurrent(self, record):
+        # Enclosing phase for records of worker thread, it's the phase which started it
+        self._local.current = record
+
+    @contextmanager
+    def measure(self, phase, name, repo = ''):
+        record = { 'phase' : phase, 'name' : name, 'repo' : repo }
+        if not self.enabled:
+            yield record
+            return
+
+        parent = self.current()
+        if parent and not repo:
+            record['repo'] = parent['repo']
+        self._local.current = record
+        startWall  = time.time()
+        startTimes = os.times()
+        try:
+            yield record
+        finally:
+            endTimes = os.times()
+            self._local.current = parent
+            record['wall'] = time.time() - startWall
+            # values of os.times are rounded, so difference can be negative
+            record.setdefault('cpu', max(0.0,
+                            endTimes[0] + endTimes[1] - startTimes[0] - startTimes[1]))
+            record.setdefault('child-cpu', max(0.0,
+                            endTimes[2] + endTimes[3] - startTimes[2] - startTimes[3]))
+            with self._lock:
+                self.records.append(record)
+
+    def formatSummary(self):
+        lines = ['%-8s %-28s %-30s %9s %8s %9s %9s %10s' % ('PHASE', 'NAME', 'REPOSITORY',
+                    'WALL, s', 'CPU, s', 'CHILD, s', 'RSS, MB', 'OUTPUT')]
+        for rec in sorted(self.records, key = lambda r: r['wall'], reverse = True):
+            lines.append('%-8s %-28s %-30s %9.2f %8.2f %9.2f %9s %10s' % (rec['phase'],
+                    rec['name'][:28], rec['repo'][-30:], rec['wall'], rec['cpu'],
+                    rec['child-cpu'],
+                    '%.1f' % (rec['max-rss'] / 1024.0) if 'max-rss' in rec else '-',
+                    formatSize(rec['output-bytes']) if 'output-bytes' in rec else '-'))
+        return '\n'.join(lines)
+
+    def dumpJson(self, path):
+        import json
+        writeFileAtomic(path, json.dumps(self.records, indent = 4))
+
+class ProgressTracker(object):
+    # Progress of long running command: processed bytes and files, average and recent
+    # throughput, ETA from totals of the command (if tool knows them) or from totals of
+    # previous run. 'report' is called with the tracker once per 'interval' seconds,
+    # 'tick' is called periodically by reader of the output, so the report is done and the
+    # recent throughput falls to zero even if the tool stalls. See PROGRESS in config_test.py
+
+    def __init__(self, repo, action, previous, interval, report):
+        self.repo       = repo
+        self.action     = action
+        self.previous   = previous or {}
+        self.interval   = interval
+        self.start      = time.time()
+        self.bytes      = 0
+        self.files      = 0
+        self.totalBytes = None
+        self.slow       = False
+        self._report    = report
+        self._lastReport = self.start
+        # (time, bytes) for last 'interval' seconds and the last one before them
+        self._window    = deque()
+
+    def update(self, processedBytes, files = None, totalBytes = None):
+        now = time.time()
+        self.bytes = processedBytes
+        if files is not None:
+            self.files = files
+        if totalBytes:
+            self.totalBytes = totalBytes
+        self._window.append((now, processedBytes))
+        while len(self._window) > 2 and now - self._window[1][0] >= self.interval:
+            self._window.popleft()
+        if now - self._lastReport >= self.interval:
+            self._lastReport = now
+            self._report(self)
+
+    def tick(self):
+        self.update(self.bytes)
+
+    def status(self):
+        now = time.time()
+        elapsed = now - self.start
+        rate = self.bytes / elapsed if elapsed > 0 else 0.0
+        recentRate = rate
+        if len(self._window) > 1 and self._window[-1][0] > self._window[0][0]:
+            recentRate = float(self._window[-1][1] - self._window[0][1]) / \
+                            (self._window[-1][0] - self._window[0][0])
+        total = self.totalBytes or self.previous.get('bytes')
+        eta = None
+        if total and total > self.bytes and (recentRate or rate):
+            eta = (total - self.bytes) / (recentRate or rate)
+        previousDuration = self.previous.get('duration')
+        return {
+            'repository'    : self.repo,
+            'action'        : self.action,
+            'started'       : self.start,
+            'elapsed'       : elapsed,
+            'bytes'         : self.bytes,
+            'files'         : self.files,
+            'rate'          : rate,
+            'recent-rate'   : recentRate,
+            'total-bytes'   : total,
+            'percent'       : 100.0 * self.bytes / total if total else None,
+            'eta'           : eta,
+            'previous-rate' : self.previous['bytes'] / previousDuration \
+                                if previousDuration and 'bytes' in self.previous else None,
+        }
+
+    def totals(self):
+        return { 'bytes' : self.bytes, 'files' : self.files,
+                'duration' : time.time() - self.start }
+
+class BorgJsonParser(object):
+    # Incremental parser of borg output with options --json and --log-json.
+    # Log messages from --log-json are converted back to plain text to be logged,
+    # the result document of --json is collected to 'result'. Progress messages
+    # (option --progress) are sent to 'tracker'.
+
+    def __init__(self, tracker = None):
+        self.result  = None
+        self.tracker = tracker
+        self._doc    = None
+
+    def tick(self):
+        if self.tracker:
+            self.tracker.tick()
+
+    def __call__(self, line):
+        if self._doc is not None:
+            self._doc.append(line)
+            # borg prints result with indentation, so top level '}' is the end
+            if line == '}':
+                self._parseDoc()
+            return None
+        if line == '{':
+            self._doc = [line]
+            return None
+        if not line.startswith('{'):
+            return line
+
+        import json
+        try:
+            msg = json.loads(line)
+        except ValueError:
+            return line
+        msgType = msg.get('type')
+        if msgType == 'log_message':
+            return '%s %s' % (msg.get('levelname', ''), msg.get('message', ''))
+        if msgType == 'file_status':
+            return '%s %s' % (msg.get('status', ''), msg.get('path', ''))
+        if msgType in ('archive_progress', 'progress_message', 'progress_percent'):
+            if msgType == 'archive_progress' and self.tracker and not msg.get('finished'):
+                self.tracker.update(msg.get('original_size', 0), msg.get('nfiles'))
+            return None
+        return line
+
+    def _parseDoc(self):
+        import json
+        try:
+            self.result = json.loads('\n'.join(self._doc))
+        except ValueError:
+            return
+        finally:
+            self._doc = None
+
+class RcloneJsonParser(object):
+    # Parser of rclone output with option --use-json-log, log messages are converted
+    # back to plain text, statistics (option --stats) are sent to 'tracker'
+
+    def __init__(self, tracker):
+        self.tracker = tracker
+
+    def tick(self):
+        self.tracker.tick()
+
+    def __call__(self, line):
+        if not line.startswith('{'):
+            return line
+        import json
+        try:
+            msg = json.loads(line)
+        except ValueError:
+            return line
+        stats = msg.get('stats')
+        if isinstance(stats, dict):
+            self.tracker.update(stats.get('bytes', 0), stats.get('transfers'),
+                                stats.get('totalBytes'))
+            return None
+        return '%s %s' % (msg.get('level', '').upper(), msg.get('msg', ''))
+
+class RunResult(object):
+    # Result of Backupper.run, it is True if there were no errors.
+    # 'stats' is list of dicts with statistics of each 'borg create',
+    # see BORG_JSON_STATS in config_test.py
+
+    def __init__(self):
+        self.ok    = False
+        self.stats = []
+
+    def __bool__(self):
+        return self.ok
+
+    __nonzero__ = __bool__
+
 class Backupper(object):
 
-    def __init__(self, config, cmdLineActions):
+    def __init__(self, config, cmdLineActions, maxParallel = None, pipeline = None,
+                profileJson = None):
         self._config = config
         self.logger = UnitLogger(config)
         self.logger.enableMail = not cmdLineActions
         self._actions = cmdLineActions or config.DEFAULT_ACTIONS
 
-        self.borgBin = config.BORG_BIN if hasattr(config, 'BORG_BIN') else BORG_BIN
-        self.rcloneBin = config.RCLONE_BIN if hasattr(config, 'RCLONE_BIN') else RCLONE_BIN
+        if maxParallel is None:
+            maxParallel = config.MAX_PARALLEL_ARCHIVES \
+                            if hasattr(config, 'MAX_PARALLEL_ARCHIVES') else 1
+        self._maxParallel = max(1, int(maxParallel))
+
+        if pipeline is None:
+            pipeline = config.PIPELINE_ARCHIVES if hasattr(config, 'PIPELINE_ARCHIVES') else False
+        self._pipeline = pipeline
+
+        resourceLimits = config.RESOURCE_LIMITS if hasattr(config, 'RESOURCE_LIMITS') else {}
+        self._resourceLimits = dict((name, threading.BoundedSemaphore(max(1, int(limit))))
+                                    for name, limit in resourceLimits.items())
+
+        self._result = RunResult()
+        self._statsLock = threading.Lock()
+
+        # see HISTORY_DB in config_test.py
+        self._historyPath = config.HISTORY_DB if hasattr(config, 'HISTORY_DB') else None
+        self._historyBaselineRuns = config.HISTORY_BASELINE_RUNS \
+                        if hasattr(config, 'HISTORY_BASELINE_RUNS') else HISTORY_BASELINE_RUNS
+        self._historyAlertFactor = config.HISTORY_ALERT_FACTOR \
+                        if hasattr(config, 'HISTORY_ALERT_FACTOR') else HISTORY_ALERT_FACTOR
+        self._history = None
+        self._historyRunId = None
+        # record of current action of the thread
+        self._historyLocal = threading.local()
+
+        if profileJson is None and hasattr(config, 'PROFILE_JSON_FILE'):
+            profileJson = config.PROFILE_JSON_FILE
+        self._profileJson = profileJson
+        profile = config.PROFILE if hasattr(config, 'PROFILE') else False
+        self._profiler = Profiler(bool(profile or profileJson))
+
+        self._killGracePeriod = config.KILL_GRACE_PERIOD \
+                            if hasattr(config, 'KILL_GRACE_PERIOD') else KILL_GRACE_PERIOD
+
+        self._stateDir = os.path.realpath(os.path.expanduser(
+                            config.STATE_DIR if hasattr(config, 'STATE_DIR') else STATE_DIR))
+        self._scanThreads = config.SCAN_THREADS if hasattr(config, 'SCAN_THREADS') else SCAN_THREADS
+        self._useRepoState = config.USE_REPO_STATE if hasattr(config, 'USE_REPO_STATE') else False
+        self._repoStates = {}
+        self._stateLock = threading.Lock()
+        self._checkBudget = None
+        self._lockFile = None
+        self._progress = config.PROGRESS if hasattr(config, 'PROGRESS') else False
+        self._progressInterval = config.PROGRESS_INTERVAL \
+                            if hasattr(config, 'PROGRESS_INTERVAL') else PROGRESS_INTERVAL
+        self._progressFile = config.PROGRESS_STATUS_FILE \
+                            if hasattr(config, 'PROGRESS_STATUS_FILE') else None
+        self._progressTrackers = []
+        self._progressLock = threading.Lock()
+        # memoized results of hooks, see 'run-before-cache' in config_test.py
+        self._hookResults = {}
+        self._hookLocks = {}
+        self._hookLock = threading.Lock()
+        # assignment of directories to shards, see 'shards' in config_test.py
+        # wrapper 'systemd-run', see _systemdRunWrapper
+        self._systemdRun = None
+        self._systemdRunLock = threading.Lock()
+        self._shardPlans = {}
+        self._shardScans = {}
+        self._shardLocks = {}
+        self._shardLock = threading.Lock()
+
+        self._streamOutput = config.STREAM_OUTPUT if hasattr(config, 'STREAM_OUTPUT') else False
+        self._outputTailLines = config.OUTPUT_TAIL_LINES \
+                            if hasattr(config, 'OUTPUT_TAIL_LINES') else OUTPUT_TAIL_LINES
 
     def _prepare(self):
 
+        self._config.archives = self._expandShards(self._config.archives)
+
         for archiveConf in self._config.archives:
 
             # fix problem of changing of shallow copies of dicts
@@ -216,11 +1902,6 @@ class Backupper(object):
 
             for name in ('archive-name', 'compression', 'encryption-mode'):
                 borgConf[name] = borgConf[name].strip()
-            for prefix in ('borg', 'rclone'):
-                conf = archiveConf[prefix]
-                for cmd in conf['commands-extra']:
-                    conf['commands-extra'][cmd] = ' ' + conf['commands-extra'][cmd]
-                conf['commands-extra'] = defaultdict(str, conf['commands-extra'])
 
             repo = borgConf['repository']
             # set 'source' as 'repository' from borg config
@@ -229,9 +1910,144 @@ class Backupper(object):
             # to simplify work with borg commands
             borgConf['env-vars']['BORG_REPO'] = repo
 
+            # Environments and arguments are prepared once, tools are run without shell
+            borgConf['env'] = makeEnv(borgConf['env-vars'])
+            rcloneConf['env'] = makeEnv(rcloneConf['env-vars'])
+            # 'rclone' uploads snapshot of repository taken by 'borg with-lock'
+            rcloneConf['snapshot'] = rcloneConf['with-lock'] == 'snapshot'
+            if rcloneConf['snapshot']:
+                rcloneConf['with-lock'] = False
+                if rcloneConf['snapshot-method'] not in ('auto', ) + SNAPSHOT_METHODS:
+                    raise KeyError("Unknown value '%s' of 'snapshot-method', should be one "
+                                "of: auto, %s" % (rcloneConf['snapshot-method'],
+                                ', '.join(SNAPSHOT_METHODS)))
+            # 'rclone' is run by 'borg with-lock'
+            rcloneConf['lock-env'] = makeEnv(rcloneConf['env-vars'], borgConf['env-vars'])
+            for prefix in ('borg', 'rclone'):
+                conf = archiveConf[prefix]
+                conf['commands-extra'] = defaultdict(list, ((cmd, splitArgs(extra, conf['env']))
+                                            for cmd, extra in conf['commands-extra'].items()))
+            rcloneConf['destinations'] = self._prepareDestinations(rcloneConf, borgConf)
+            for prefix in ('borg', 'rclone'):
+                for name in ('run-before-cache', 'run-after-cache'):
+                    policy = archiveConf[prefix][name]
+                    if policy not in (None, 'run', 'archive') and \
+                            not (isinstance(policy, (int, float)) and policy > 0):
+                        raise KeyError("Wrong value '%s' of '%s' in '%s' section, should be "
+                                "None, 'run', 'archive' or number of seconds"
+                                % (policy, name, prefix))
+            for cmdConf in archiveConf.values():
+                if isinstance(cmdConf, dict) and 'command-line' in cmdConf:
+                    # custom shell command
+                    cmdConf['env'] = makeEnv(cmdConf.get('env-vars', {}), { 'BORG_REPO' : repo,
+                                    'BORG_SHARD' : borgConf['env-vars'].get('BORG_SHARD', '') })
+
             if repo.find('@') == -1:
                 # only for local path
-                makeDir(repo)
+                if not self._useRepoState or not self._repoState(repo).isInitialized(repo):
+                    makeDir(repo)
+
+    @property
+    def borgBin(self):
+        # Tools are searched only when they are needed, name is used if tool is not found
+        # to get error about it on start of process
+        config = self._config
+        return config.BORG_BIN if hasattr(config, 'BORG_BIN') else findExecutable('borg') or 'borg'
+
+    @property
+    def rcloneBin(self):
+        config = self._config
+        return config.RCLONE_BIN if hasattr(config, 'RCLONE_BIN') else \
+                findExecutable('rclone') or 'rclone'
+
+    def lock(self):
+        # Lock file guards config from processing by several processes at the same time,
+        # see LOCK_FILE in config_test.py. Returns False if config is already locked.
+        config = self._config
+        path = config.LOCK_FILE if hasattr(config, 'LOCK_FILE') else \
+                os.path.join(self._stateDir, 'lock-%s' % getattr(config, '__name__', 'config'))
+        if not path:
+            return True
+        self._lockFile, owner = acquireLockFile(os.path.expanduser(path))
+        if self._lockFile is None:
+            self.logger.error("Config is already processed by process with PID %s, "
+                                "lock file: %s", owner, path)
+            return False
+        return True
+
+    def unlock(self):
+        if self._lockFile is not None:
+            self._lockFile.close()
+            self._lockFile = None
+
+    def _repoState(self, repo):
+        with self._stateLock:
+            if repo not in self._repoStates:
+                self._repoStates[repo] = RepoState(self._statePath('state', repo))
+            return self._repoStates[repo]
+
+    def _expandShards(self, archives):
+        # Archive with 'shards' is replaced with archives of its shards, each of them has
+        # own repository with suffix '.shardNN' and the same settings
+        result = []
+        for archiveConf in archives:
+            borgConf = archiveConf.get('borg', {})
+            count = borgConf.get('shards') or 1
+            if 'shard' in borgConf or count == 1:
+                result.append(archiveConf)
+                continue
+            if not isinstance(count, int) or count < 1:
+                raise KeyError("Wrong value '%s' of 'shards', should be positive number" % count)
+            repo = borgConf.get('repository')
+            if not repo:
+                raise KeyError("Field 'repository' not found in 'borg' section or empty")
+            for index in range(count):
+                name = 'shard%02d' % index
+                shardConf = deepcopy(archiveConf)
+                shardBorg = shardConf['borg']
+                shardBorg['repository'] = '%s.%s' % (repo, name)
+                shardBorg['shard'] = { 'index' : index, 'count' : count, 'name' : name,
+                                        'repository' : repo }
+                shardBorg['env-vars'] = dict(shardBorg.get('env-vars', {}), BORG_SHARD = name)
+                if 'rclone' in shardConf:
+                    shardConf['rclone']['destination'] = shardDestination(
+                                            shardConf['rclone'].get('destination'), name)
+                result.append(shardConf)
+        return tuple(result)
+
+    def _prepareDestinations(self, rcloneConf, borgConf):
+        # 'destination' is remote, dict with 'remote' and own settings or list of them.
+        # Returns list of copies of 'rclone' section, one per destination, with
+        # 'destination', 'env', 'lock-env', 'commands-extra' and 'bwlimit' of it.
+        destinations = rcloneConf['destination']
+        if not destinations:
+            return []
+        if isinstance(destinations, string_types) or isinstance(destinations, dict):
+            destinations = (destinations, )
+
+        result = []
+        for dest in destinations:
+            if isinstance(dest, string_types):
+                dest = { 'remote' : dest }
+            if not isinstance(dest, dict) or not dest.get('remote'):
+                raise KeyError("Wrong item '%s' of 'destination' for repository '%s', should be "
+                            "remote or dict with 'remote'" % (dest, borgConf['repository']))
+            conf = dict(rcloneConf)
+            conf['destination'] = dest['remote']
+            envVars = dest.get('env-vars')
+            if envVars:
+                conf['env'] = makeEnv(rcloneConf['env-vars'], envVars)
+                conf['lock-env'] = makeEnv(rcloneConf['env-vars'], envVars, borgConf['env-vars'])
+            # args of destination are added after args of the section
+            conf['commands-extra'] = defaultdict(list, rcloneConf['commands-extra'])
+            for cmd, extra in dest.get('commands-extra', {}).items():
+                conf['commands-extra'][cmd] = conf['commands-extra'][cmd] + \
+                                                splitArgs(extra, conf['env'])
+            conf['bwlimit'] = dest.get('bwlimit', rcloneConf['bwlimit'])
+            # throughput of each destination is reported even without PROGRESS
+            conf['track-progress'] = len(destinations) > 1
+            result.append(conf)
+        return result
 
     def _setupDefaultConfigValues(self, archiveConf):
 
@@ -246,15 +2062,43 @@ class Backupper(object):
                 'env-vars'        : dict(),
                 'run-before'      : None,
                 'run-after'       : None,
+                'run-before-cache': None,
+                'run-after-cache' : None,
+                'timeout'         : None,
+                'idle-timeout'    : None,
+                'commands-options': dict(),
+                'json-stats'      : self._config.BORG_JSON_STATS \
+                        if hasattr(self._config, 'BORG_JSON_STATS') else False,
+                'check-schedule'  : None,
+                'auto-compression-interval'  : 30 * 24 * 3600,
+                'auto-compression-min-speed' : 50,
+                'skip-unchanged'  : False,
+                'skip-max-age'    : 7 * 24 * 3600,
+                'shards'          : None,
+                'shard-rebalance-interval' : 30 * 24 * 3600,
+                'mountpoint'      : None,
             },
             'rclone' : {
                 'with-lock'       : False,
+                'snapshot-method' : 'auto',
+                'snapshot-dir'    : None,
                 'destination'     : None,
+                'parallel-destinations' : None,
+                'partial-success' : False,
+                'bwlimit'         : None,
                 'commands-extra'  : dict(),
                 'ignore-commands' : tuple(),
                 'env-vars'        : dict(),
                 'run-before'      : None,
                 'run-after'       : None,
+                'run-before-cache': None,
+                'run-after-cache' : None,
+                'timeout'         : None,
+                'idle-timeout'    : None,
+                'commands-options': dict(),
+                'incremental'     : False,
+                'incremental-hash': False,
+                'full-sync-interval' : 7 * 24 * 3600,
             },
         }
 
@@ -264,7 +2108,7 @@ class Backupper(object):
                 if name not in conf:
                     conf[name] = defaultConfValues[prefix][name]
 
-    def _doAction(self, action):
+    def _resolveAction(self, action):
 
         parts = action.split(':', 2)
         if len(parts) < 2:
@@ -291,41 +2135,311 @@ class Backupper(object):
         else:
             methodCall = getattr(self, methodName)
 
-        for archiveConf in self._config.archives:
+        return (prefix, command, params, methodCall)
 
-            repo = archiveConf['borg']['repository']
-            doCall = True
+    def _doAction(self, action):
 
-            if prefix != 'shell' and command in archiveConf[prefix]['ignore-commands']:
-                self.logger.info("%s command '%s' in list of ignored commands for repo '%s'",
-                                prefix[0].upper() + prefix[1:], command, repo)
-                continue
+        prefix, command, params, methodCall = self._resolveAction(action)
+
+        archives = self._config.archives
+
+        def makeTask(archiveConf):
+            def task():
+                with self.logger.archiveContext('[%s] ' % archiveConf['borg']['repository']):
+                    self._doArchiveAction(archiveConf, prefix, command, params, methodCall)
+            return task
+
+        if self._maxParallel < 2 or len(archives) < 2:
+            for group in self._archiveGroups(archives):
+                if len(group) > 1 and (prefix, command) == ('borg', 'create'):
+                    # shards of the same source are created in parallel
+                    self._runArchiveTasks([makeTask(conf) for conf in group], len(group))
+                    continue
+                for archiveConf in group:
+                    self._doArchiveAction(archiveConf, prefix, command, params, methodCall)
+            return
+
+        self._runArchiveTasks([makeTask(conf) for conf in archives], self._maxParallel)
+
+    def _archiveGroups(self, archives):
+        # List of lists of archives, shards of one archive are in the same list
+        groups = []
+        lastRepo = None
+        for archiveConf in archives:
+            shard = archiveConf['borg'].get('shard')
+            if shard and groups and shard['repository'] == lastRepo:
+                groups[-1].append(archiveConf)
+            else:
+                groups.append([archiveConf])
+            lastRepo = shard['repository'] if shard else None
+        return groups
+
+    def _doPipeline(self):
+        # Archive-major order: each archive runs the whole list of actions by itself,
+        # so different stages of different archives overlap. See PIPELINE_ARCHIVES.
+
+        actions = [self._resolveAction(act) for act in self._actions]
+        archives = self._config.archives
+        failed = threading.Event()
+
+        def makeTask(archiveConf):
+            def task():
+                with self.logger.archiveContext('[%s] ' % archiveConf['borg']['repository']):
+                    for (prefix, command, params, methodCall) in actions:
+                        if failed.is_set():
+                            self.logger.info("Pipeline is stopped because of error, "
+                                            "%s command '%s' won't be run", prefix, command)
+                            return
+                        try:
+                            self._doArchiveAction(archiveConf, prefix, command,
+                                                    params, methodCall)
+                        except Exception:
+                            failed.set()
+                            raise
+            return task
+
+        maxWorkers = self._maxParallel if self._maxParallel > 1 else len(archives)
+        self._runArchiveTasks([makeTask(conf) for conf in archives], maxWorkers)
+
+    def _runArchiveTasks(self, tasks, maxWorkers):
+        results = runInThreads(tasks, maxWorkers, stopOnError = True)
+        for result in results:
+            if result is not None and result[1] is not None:
+                raise result[1][1]
+
+    @contextmanager
+    def _resourceSlot(self, resource):
+        # Limit number of commands of the same kind running at the same time,
+        # see RESOURCE_LIMITS
+        semaphore = self._resourceLimits.get(resource)
+        if semaphore is None:
+            yield
+            return
+        if not semaphore.acquire(False):
+            self.logger.debug("Waiting for free slot of resource '%s'", resource)
+            semaphore.acquire()
+        try:
+            yield
+        finally:
+            semaphore.release()
+
+    def _doArchiveAction(self, archiveConf, prefix, command, params, methodCall):
+
+        repo = archiveConf['borg']['repository']
+        doCall = True
 
-            if prefix != 'shell':
-                runBefore = archiveConf[prefix]['run-before']
-                runAfter  = archiveConf[prefix]['run-after']
-                if runBefore:
-                    doCall = self._doBeforeAfterCall(runBefore, archiveConf[prefix]['env-vars'],
-                                "Param 'run-before' from '%s' section for repo '%s'" % (prefix, repo))
-            if doCall:
-                self.logger.info("Running %s command '%s' for repo '%s'",
-                                prefix, command, repo)
-                methodCall(archiveConf, params)
-                self.logger.info("%s command '%s' for repo '%s' done",
-                                prefix[0].upper() + prefix[1:], command, repo)
-
-            if prefix != 'shell' and runAfter:
-                self._doBeforeAfterCall(runAfter, archiveConf[prefix]['env-vars'],
-                                "Param 'run-after' from '%s' section for repo '%s'" % (prefix, repo))
-
-    def _doBeforeAfterCall(self, callEntity, envVars, paramDesc):
+        if prefix != 'shell' and command in archiveConf[prefix]['ignore-commands']:
+            self.logger.info("%s command '%s' in list of ignored commands for repo '%s'",
+                            prefix[0].upper() + prefix[1:], command, repo)
+            return
+
+        if self._useRepoState and prefix != 'shell':
+            minInterval = self._execOptions(archiveConf[prefix], command).get('min-interval')
+            lastDone = self._repoState(repo).lastDone('%s:%s' % (prefix, command))
+            if minInterval and lastDone and time.time() - lastDone < minInterval:
+                self.logger.info("%s command '%s' for repo '%s' was done %d seconds ago, skipped",
+                                prefix[0].upper() + prefix[1:], command, repo,
+                                time.time() - lastDone)
+                return
+
+        if prefix != 'shell':
+            runBefore = archiveConf[prefix]['run-before']
+            runAfter  = archiveConf[prefix]['run-after']
+            if runBefore:
+                with self._profiler.measure('hook', 'run-before %s:%s' % (prefix, command), repo):
+                    doCall = self._callHook(archiveConf, prefix, 'run-before')
+        if doCall:
+            self.logger.info("Running %s command '%s' for repo '%s'",
+                            prefix, command, repo)
+            with self._resourceSlot(prefix):
+                with self._profiler.measure('action', '%s:%s' % (prefix, command), repo):
+                    record = self._startHistoryAction()
+                    ok = False
+                    try:
+                        methodCall(archiveConf, params)
+                        ok = True
+                    except Exception as exc:
+                        if self._useRepoState and prefix == 'borg' and isRepoMissingError(exc):
+                            # maybe repository was removed, init will be run next time
+                            self._repoState(repo).set(initialized = False)
+                        raise
+                    finally:
+                        self._finishHistoryAction(record, repo, '%s:%s' % (prefix, command), ok)
+            if self._useRepoState:
+                self._repoState(repo).markDone('%s:%s' % (prefix, command))
+            self.logger.info("%s command '%s' for repo '%s' done",
+                            prefix[0].upper() + prefix[1:], command, repo)
+
+        if prefix != 'shell' and runAfter:
+            with self._profiler.measure('hook', 'run-after %s:%s' % (prefix, command), repo):
+                self._callHook(archiveConf, prefix, 'run-after')
+
+    def _openHistory(self):
+        # Database is opened on first use, errors of history don't stop backups
+        if self._history is None and self._historyPath:
+            path = os.path.expanduser(self._historyPath)
+            try:
+                if os.path.dirname(path):
+                    makeDir(os.path.dirname(path))
+                self._history = RunHistory(path)
+            except Exception as exc:
+                self.logger.error("History database '%s' can't be opened: %s", path, exc)
+                self._historyPath = None
+        return self._history
+
+    def _startHistoryRun(self):
+        if not self._openHistory():
+            return None
+        try:
+            return self._history.startRun(getattr(self._config, '__name__', 'config'))
+        except Exception as exc:
+            self.logger.error("Error during writing of history: %s", exc)
+            return None
+
+    def _finishHistoryRun(self, runId, ok):
+        if runId is None:
+            return
+        try:
+            self._history.finishRun(runId, ok)
+        except Exception as exc:
+            self.logger.error("Error during writing of history: %s", exc)
+
+    def _historyRecord(self):
+        # Record of current action of the thread or None, see _startHistoryAction
+        return getattr(self._historyLocal, 'record', None)
+
+    def _startHistoryAction(self):
+        if not self._openHistory():
+            return None
+        record = { 'start' : time.time(), 'rc' : 0, 'output-bytes' : 0, 'stats' : {} }
+        self._historyLocal.record = record
+        return record
+
+    def _skipHistoryAction(self):
+        # Current action did nothing (nothing to do or no section for it), it's saved as
+        # skipped and it's not used as baseline
+        record = self._historyRecord()
+        if record is not None:
+            record['skipped'] = True
+
+    def _finishHistoryAction(self, record, repo, action, ok):
+        # Action is saved to history and compared with baseline of previous runs
+        if record is None:
+            return
+        self._historyLocal.record = None
+        record.update(repository = repo, action = action, end = time.time())
+        record['duration'] = record['end'] - record['start']
+        # exit code of failed tool or -1 if action failed by other reason
+        record['rc'] = 0 if ok else (record['rc'] or -1)
+
+        runId = getattr(self._historyLocal, 'run', None) or self._historyRunId
+        try:
+            alerts = []
+            if ok and not record.get('skipped'):
+                previous = self._history.actions(repo, action, self._historyBaselineRuns,
+                                                onlyOk = True)
+                for name, value, base in findRegressions(record, previous,
+                                                        self._historyAlertFactor):
+                    if name == 'duration':
+                        text = (formatDuration(value), formatDuration(base))
+                    elif name.endswith('size') or name == 'bytes':
+                        text = (formatSize(value), formatSize(base))
+                    else:
+                        text = ('%g' % value, '%g' % base)
+                    self.logger.warning("Regression of %s for repo '%s': %s is %s, "
+                                    "baseline of previous runs is %s", action, repo, name,
+                                    text[0], text[1])
+                    alerts.append({ 'metric' : name, 'value' : value, 'baseline' : base })
+                if alerts:
+                    self.logger.markSubject('REGRESSION')
+            self._history.addAction(runId, record, alerts)
+        except Exception as exc:
+            self.logger.error("Error during writing of history: %s", exc)
+
+    def _addHistoryStats(self, stats):
+        # Numeric stats of tool for current action, values of the same name are summed
+        record = self._historyRecord()
+        if record is None:
+            return
+        with self._statsLock:
+            for name, value in stats.items():
+                record['stats'][name] = record['stats'].get(name, 0) + value
+
+    def _callHook(self, archiveConf, prefix, name):
+        # Call 'run-before' or 'run-after' hook, its result can be memoized according to
+        # policy from 'run-before-cache'/'run-after-cache': once per run for all archives
+        # with the same hook ('run'), once per archive ('archive') or for number of seconds
+        conf = archiveConf[prefix]
+        hook = conf[name]
+        repo = archiveConf['borg']['repository']
+        paramDesc = "Param '%s' from '%s' section for repo '%s'" % (name, prefix, repo)
+        policy = conf[name + '-cache']
+        if not policy:
+            return self._doBeforeAfterCall(hook, conf['env'], paramDesc)
+
+        # command is compared with expanded variables, so the same hook with different
+        # 'env-vars' of archives is run for each of them
+        command = expandVars(hook, conf['env']) if isinstance(hook, string_types) else hook
+        key = (None if policy == 'run' else repo, command)
+        with self._hookLock:
+            keyLock = self._hookLocks.setdefault(key, threading.Lock())
+        # the same hook is run only once even for archives processed at the same time
+        with keyLock:
+            cached = self._hookResults.get(key)
+            if cached and (policy in ('run', 'archive') or time.time() - cached[1] < policy):
+                self.logger.debug("%s has memoized result '%s'", paramDesc, cached[0])
+                return cached[0]
+            result = self._doBeforeAfterCall(hook, conf['env'], paramDesc)
+            self._hookResults[key] = (result, time.time(), policy)
+            return result
+
+    def _dropHookResults(self, repo = None):
+        # Forget results memoized for the run (all or only for archive 'repo' and
+        # for all archives), results with time limit are kept
+        with self._hookLock:
+            for key, cached in list(self._hookResults.items()):
+                if cached[2] in ('run', 'archive') and (repo is None or key[0] in (None, repo)):
+                    del self._hookResults[key]
+
+    def _probeHooks(self):
+        # Run memoized 'run-before' hooks of all archives at the same time before actions,
+        # so, for example, checks of availability of remote hosts don't wait each other.
+        # See PROBE_HOOKS in config_test.py
+        config = self._config
+        threadsNum = config.PROBE_HOOKS if hasattr(config, 'PROBE_HOOKS') else 0
+        if not threadsNum:
+            return
+
+        def makeTask(archiveConf, prefix):
+            def task():
+                with self.logger.archiveContext('[%s] ' % archiveConf['borg']['repository']):
+                    return self._callHook(archiveConf, prefix, 'run-before')
+            return task
+
+        tasks = []
+        for archiveConf in config.archives:
+            for prefix in ('borg', 'rclone'):
+                conf = archiveConf[prefix]
+                if conf['run-before'] and conf['run-before-cache'] and \
+                        (prefix != 'rclone' or conf['use']):
+                    tasks.append(makeTask(archiveConf, prefix))
+        if not tasks:
+            return
+
+        self.logger.debug("Probing of %d 'run-before' hooks", len(tasks))
+        with self._profiler.measure('hook', 'probe'):
+            results = runInThreads(tasks, threadsNum)
+        for result in results:
+            if result[1] is not None:
+                self.logger.warning("Error during probing of 'run-before' hook: %s",
+                                    result[1][1])
+
+    def _doBeforeAfterCall(self, callEntity, env, paramDesc):
         result = None
         if callable(callEntity):
             result = callEntity()
             self.logger.debug("%s is function and result is '%s'", paramDesc, result)
         elif isinstance(callEntity, string_types):
-            env = os.environ.copy()
-            env.update(envVars)
             result = self._runCmdInSystem(callEntity, 'shell', env, raiseException = False)
             result = bool(result[0] == 0)
             self.logger.debug("%s is string to run command '%s' and result is '%s'",
@@ -336,16 +2450,44 @@ class Backupper(object):
         self.logger.debug("Default command handler is used for borg command '%s'", cmd)
 
         borgConf = archiveConf['borg']
-        cmd = cmd + borgConf['commands-extra'][cmd]
-        self._runBorgCmd(archiveConf, cmd + ' ' + params)
+        args = [cmd] + borgConf['commands-extra'][cmd]
+        mountpoint = borgConf['mountpoint']
+        if mountpoint and cmd in ('mount', 'umount'):
+            # shards are mounted to subdirectories of mount point, so all files of
+            # the archive are under it together
+            mountpoint = os.path.expanduser(expandVars(mountpoint, borgConf['env']))
+            if borgConf.get('shard'):
+                mountpoint = os.path.join(mountpoint, borgConf['shard']['name'])
+            if cmd == 'mount':
+                makeDir(mountpoint)
+                args.append(borgConf['repository'])
+            args.append(mountpoint)
+        args += splitArgs(params, borgConf['env'])
+        self._runBorgCmd(archiveConf, args)
 
     def _doBorgInit(self, archiveConf, params):
         borgConf = archiveConf['borg']
+        repo = borgConf['repository']
+
+        if self._useRepoState:
+            state = self._repoState(repo)
+            if state.isInitialized(repo) and not params:
+                self.logger.info("Repo '%s' is initialized already according to saved state",
+                                repo)
+                return
+            self._runBorgInit(archiveConf, params)
+            state.update({ 'initialized' : True, 'repo-id' : readRepoId(repo) })
+            return
+
+        self._runBorgInit(archiveConf, params)
+
+    def _runBorgInit(self, archiveConf, params):
+        borgConf = archiveConf['borg']
 
-        cmd = 'init --encryption=%s %s' % (borgConf['encryption-mode'], borgConf['repository'])
-        cmd = cmd + borgConf['commands-extra']['init']
+        args = ['init', '--encryption=' + borgConf['encryption-mode'], borgConf['repository']]
+        args += borgConf['commands-extra']['init'] + splitArgs(params, borgConf['env'])
 
-        (rc, stdout, stderr) = self._runBorgCmd(archiveConf, cmd + ' ' + params, raiseException = False)
+        (rc, stdout, stderr) = self._runBorgCmd(archiveConf, args, raiseException = False)
         if rc == 0:
             return
         if rc == 2:
@@ -355,20 +2497,457 @@ class Backupper(object):
             if m:
                 return
 
-        raise ToolResultException("BORG process terminated with error code %s" % rc)
+        raise ToolResultException("BORG process terminated with error code %s" % rc,
+                                    rc, stdout)
 
-    def _doBorgCreate(self, archiveConf, params):
+    def _doBorgCheck(self, archiveConf, params):
+        # Scheduled check: '--repository-only --max-duration' checks are resumed by borg
+        # from the place where previous one was stopped, so the whole repository is
+        # checked during several runs. Full check with '--verify-data' is done once
+        # per 'verify-period'. See 'check-schedule' in config_test.py
         borgConf = archiveConf['borg']
+        schedule = borgConf['check-schedule']
+        if not schedule or params:
+            return self._doBorgDefault(archiveConf, 'check', params)
+
+        repo  = borgConf['repository']
+        state = self._repoState(repo)
+        check = state.get('check', {})
+        now   = time.time()
+        extra = borgConf['commands-extra']['check']
+
+        budget = self._checkBudgetOfRun()
+        verifyPeriod = schedule.get('verify-period')
+        if verifyPeriod and now - check.get('last-verify', 0) >= verifyPeriod:
+            # full check isn't limited by budget but its time is charged to it
+            self.logger.info("Full check with data verification of repo '%s'", repo)
+            reserved = budget.take() if budget else 0
+            try:
+                self._runBorgCmd(archiveConf, ['check', '--verify-data'] + extra)
+            finally:
+                if budget:
+                    budget.settle(reserved, time.time() - now)
+            check.update({ 'last-verify' : now, 'last-complete' : now, 'in-progress' : False })
+            state.set(check = check)
+            return
+
+        if not check.get('in-progress') and \
+                now - check.get('last-complete', 0) < schedule.get('period', 7 * 24 * 3600):
+            self.logger.info("Check of repo '%s' is not needed yet, last complete check "
+                            "was %d seconds ago", repo, now - check.get('last-complete', 0))
+            return
+
+        reserved = budget.take() if budget else None
+        maxDuration = reserved
+        if schedule.get('max-duration'):
+            maxDuration = min(maxDuration, schedule['max-duration']) \
+                            if maxDuration is not None else schedule['max-duration']
+        if maxDuration == 0:
+            self.logger.warning("Time budget for checks is exhausted, check of repo '%s' "
+                                "is postponed", repo)
+            return
 
-        cmd = 'create --compression %s ::%s' % \
-            (borgConf['compression'], borgConf['archive-name'])
+        args = ['check', '--repository-only', '--info']
+        if maxDuration:
+            args += ['--max-duration', str(maxDuration)]
+        start = time.time()
+        try:
+            rc, stdout, _ = self._runBorgCmd(archiveConf, args + extra)
+        finally:
+            if budget:
+                budget.settle(reserved, time.time() - start)
+
+        import re
+        m = re.search(r"finished\s+(partial|full)\s+repository\s+check", stdout or '',
+                        re.IGNORECASE)
+        partial = bool(maxDuration) and (not m or m.group(1).lower() == 'partial')
+        check.update({ 'in-progress' : partial, 'last-partial' : time.time() })
+        if not partial:
+            check['last-complete'] = time.time()
+            self.logger.info("Repository check of repo '%s' is complete", repo)
+        else:
+            self.logger.info("Repository check of repo '%s' is partial, it will be "
+                            "continued next time", repo)
+        state.set(check = check)
+
+    def _checkBudgetOfRun(self):
+        # Returns CheckBudget of current run (cycle of jobs in daemon mode) or None
+        # if there is no CHECK_TIME_BUDGET
+        config = self._config
+        if not hasattr(config, 'CHECK_TIME_BUDGET') or not config.CHECK_TIME_BUDGET:
+            return None
+        with self._stateLock:
+            if not self._checkBudget:
+                scheduled = [conf for conf in config.archives
+                                if conf['borg']['check-schedule'] and
+                                'check' not in conf['borg']['ignore-commands']]
+                self._checkBudget = CheckBudget(config.CHECK_TIME_BUDGET, len(scheduled))
+            return self._checkBudget
+
+    def _createSources(self, borgConf):
+        # Returns sources and excludes for 'borg create' of the archive
+        sources = self._expandSources(borgConf)
+        excludes = list(borgConf['exclude'])
+        if borgConf.get('shard'):
+            sources, shardExcludes = self._shardSources(borgConf, sources)
+            excludes += shardExcludes
+        return sources, excludes
+
+    def _expandSources(self, borgConf):
+        sources = []
         for src in borgConf['source']:
-            cmd = cmd + ' ' + src
-        for exclude in borgConf['exclude']:
-            cmd = cmd + " --exclude '%s'" % exclude
-        cmd = cmd + borgConf['commands-extra']['create']
+            sources += expandPath(src, borgConf['env'])
+        return sources
+
+    def _doBorgCreate(self, archiveConf, params):
+        borgConf = archiveConf['borg']
+
+        env = borgConf['env']
+        sources, excludes = self._createSources(borgConf)
+        if not sources and borgConf.get('shard'):
+            self.logger.info("No directories for shard '%s' of repo '%s', borg create "
+                            "is skipped", borgConf['shard']['name'],
+                            borgConf['shard']['repository'])
+            self._skipHistoryAction()
+            return
+
+        sourcesIndex = None
+        if borgConf['skip-unchanged']:
+            sourcesIndex = SourcesIndex(self._statePath('sources', borgConf['repository']),
+                                        borgConf['source'], self._scanThreads)
+            if self._isSourcesUnchanged(borgConf, sourcesIndex):
+                self._skipHistoryAction()
+                return
+
+        compression = borgConf['compression']
+        if compression == 'auto':
+            compression = self._autoCompression(borgConf, sources)
+
+        args = ['create', '--compression', compression]
+        args += splitArgs('::' + borgConf['archive-name'], env)
+        args += sources
+        for exclude in excludes:
+            args += ['--exclude', exclude]
+        args += borgConf['commands-extra']['create']
+        params = splitArgs(params, env)
+
+        tracker = self._startProgress(archiveConf, 'borg', 'create')
+        parser = None
+        if borgConf['json-stats'] or tracker:
+            parser = BorgJsonParser(tracker)
+            args.append('--log-json')
+            if borgConf['json-stats']:
+                args.append('--json')
+            if tracker:
+                args.append('--progress')
+
+        ok = False
+        try:
+            self._runBorgCmd(archiveConf, args + params, outputFilter = parser)
+            ok = True
+        finally:
+            if tracker:
+                self._finishProgress(tracker, ok)
+
+        if borgConf['json-stats']:
+            if parser.result is None:
+                self.logger.warning("No JSON result in output of borg create for repo '%s'",
+                                    borgConf['repository'])
+            else:
+                self._addCreateStats(borgConf['repository'], parser.result, compression)
+
+        if sourcesIndex:
+            sourcesIndex.save()
+
+    def _doBorgAnalyze(self, archiveConf, params):
+        # Find the biggest, the most populated and the most changed subtrees of sources
+        # and known junk, it's not borg command. 'params' is number of reported paths.
+        borgConf = archiveConf['borg']
+        repo = borgConf['repository']
+        top = int(params) if params.strip() else ANALYZE_TOP
+        sources, excludes = self._createSources(borgConf)
+        excluded = excludeMatcher(excludes)
+
+        statePath = self._statePath('analyze', repo)
+        previous = loadJsonFile(statePath, {})
+        since = previous.get('time') or self._repoState(repo).lastDone('borg:create') or \
+                    time.time() - 24 * 3600
+
+        # top level directories of sources are walked in parallel
+        tasks = []
+        for source in sources:
+            # paths are kept as borg gets them to match them with excludes
+            root = os.path.normpath(source)
+            if excluded(root) or not os.path.isdir(root) or os.path.islink(root):
+                continue
+            # files of root itself, its subdirectories are separate tasks
+            tasks.append(lambda root = root: analyzeTree(root, 0, excluded, since,
+                                                        recursive = False))
+            for entryPath, st, isDir in listDirEntries(root):
+                if isDir and not excluded(entryPath):
+                    tasks.append(lambda path = entryPath: analyzeTree(path, 1, excluded, since))
+
+        with self._profiler.measure('scan', 'analyze', repo):
+            results = runInThreads(tasks, self._scanThreads)
+        subtrees = {}
+        junk = {}
+        for (result, excInfo) in results:
+            if excInfo:
+                raise excInfo[1]
+            subtrees.update(result[0])
+            junk.update(result[1])
+
+        # how many scans found changes in subtree, it's kept for previous scans
+        scans = previous.get('scans', 0) + 1
+        prevSubtrees = previous.get('subtrees', {})
+        changes = dict((path, (prevSubtrees[path][2] if path in prevSubtrees else 0) +
+                        (1 if counters[3] else 0)) for path, counters in subtrees.items())
+
+        def table(title, key):
+            paths = sorted((path for path in subtrees if key(subtrees[path]) > 0),
+                            key = lambda path: (-key(subtrees[path]), path))[:top]
+            lines = ['%12s %10s %12s %8s  %s' % ('SIZE', 'FILES', 'CHANGED', 'SCANS', 'PATH')]
+            for path in paths:
+                size, files, changedBytes, changedFiles = subtrees[path]
+                growth = ''
+                if path in prevSubtrees and size != prevSubtrees[path][0]:
+                    growth = ' (%s%s since previous scan)' % ('+' if size >= prevSubtrees[path][0]
+                                else '-', formatSize(abs(size - prevSubtrees[path][0])))
+                lines.append('%12s %10d %12s %8s  %s%s' % (formatSize(size), files,
+                            formatSize(changedBytes), '%d/%d' % (changes[path], scans),
+                            path, growth))
+            return "%s of sources of repo '%s':\n%s" % (title, repo, '\n'.join(lines))
+
+        self.logger.info(table('The biggest subtrees', lambda c: c[0]))
+        self.logger.info(table('Subtrees with the most files', lambda c: c[1]))
+        self.logger.info(table('Subtrees with the most changed data since %s' %
+                        time.strftime('%Y-%m-%d %H:%M', time.localtime(since)), lambda c: c[2]))
+
+        if junk:
+            lines = ['%12s %10s  %-16s %s' % ('SIZE', 'FILES', 'REASON', 'PATH')]
+            for path in sorted(junk, key = lambda path: (-junk[path][1], path))[:top]:
+                reason, size, files = junk[path]
+                lines.append('%12s %10d  %-16s %s' % (formatSize(size), files, reason, path))
+            self.logger.info("Junk in sources of repo '%s' (%s in %d paths):\n%s", repo,
+                            formatSize(sum(item[1] for item in junk.values())), len(junk),
+                            '\n'.join(lines))
+            self._suggestExcludes(borgConf, junk)
+        else:
+            self.logger.info("No known junk in sources of repo '%s'", repo)
+
+        saveJsonFile(statePath, { 'time' : time.time(), 'scans' : scans,
+                        'subtrees' : dict((path, [counters[0], counters[1], changes[path]])
+                                        for path, counters in subtrees.items()) })
+
+    def _suggestExcludes(self, borgConf, junk):
+        # Config lines with current and new excludes for junk found by _doBorgAnalyze
+        reasons = set(item[0] for item in junk.values())
+        excludes = ['*/%s' % name for name in ANALYZE_JUNK_DIRS if name in reasons]
+        excludes += [pattern for pattern in ANALYZE_JUNK_FILES if pattern in reasons]
+        suggestions = []
+        if excludes:
+            suggestions.append("'exclude' : (\n%s),"
+                    % ''.join('    %r,\n' % str(pattern)
+                            for pattern in list(borgConf['exclude']) + excludes))
+        if 'CACHEDIR.TAG' in reasons and \
+                '--exclude-caches' not in borgConf['commands-extra']['create']:
+            suggestions.append("'commands-extra' : { 'create' : '--exclude-caches' },")
+        if suggestions:
+            self.logger.info("Suggested additions to 'borg' section of repo '%s':\n%s",
+                            borgConf['repository'], '\n'.join(suggestions))
+
+    def _shardSources(self, borgConf, sources):
+        # Returns sources and excludes of the shard. Shard 0 backs up roots of sources
+        # without directories of other shards, so new directories are never missed.
+        # Paths are kept as borg gets them (relative sources stay relative), so user
+        # excludes and excludes of shards match the same paths.
+        shard = borgConf['shard']
+        roots = [os.path.normpath(src) for src in sources]
+        units = self._shardUnits(borgConf, roots)
+        if shard['index'] == 0:
+            return roots, ['pp:' + path for path, index in sorted(units.items()) if index != 0]
+        return [path for path, index in sorted(units.items())
+                if index == shard['index'] and os.path.lexists(path)], []
+
+    def _shardUnits(self, borgConf, roots):
+        # Assignment of directories to shards, it's computed once per run for all shards
+        # (once per cycle of jobs in daemon mode, see flushReports)
+        repo = borgConf['shard']['repository']
+        with self._shardLock:
+            repoLock = self._shardLocks.setdefault(repo, threading.Lock())
+        with repoLock:
+            if repo not in self._shardPlans:
+                self._shardPlans[repo] = self._planShards(borgConf, roots)
+            return self._shardPlans[repo]
+
+    def _shardSignatures(self, borgConf):
+        # Sources are scanned once per run for all shards (see _shardUnits), each shard
+        # gets signatures of its directories, shard 0 also gets signatures of roots
+        # and of directories which are not assigned yet
+        shard = borgConf['shard']
+        repo = shard['repository']
+        roots = [os.path.normpath(src) for src in self._expandSources(borgConf)]
+        units = self._shardUnits(borgConf, roots)
+        with self._shardLock:
+            repoLock = self._shardLocks.setdefault(repo, threading.Lock())
+        with repoLock:
+            if repo not in self._shardScans:
+                self._shardScans[repo] = scanSourceSignatures(roots, self._scanThreads)
+            signatures = self._shardScans[repo]
+        return dict((name, signature) for name, signature in signatures.items()
+                    if units.get(name, 0) == shard['index'])
+
+    def _planShards(self, borgConf, roots):
+        # Saved assignment is used until 'shard-rebalance-interval' is passed, then
+        # directories are scanned again and moved between shards if they're unbalanced
+        shard = borgConf['shard']
+        repo = shard['repository']
+        state = self._repoState(repo)
+        saved = state.get('shards') or {}
+        if saved.get('roots') != roots or saved.get('exclude') != list(borgConf['exclude']):
+            saved = {}
+        if saved.get('count') == shard['count'] and \
+                time.time() - saved.get('time', 0) < borgConf['shard-rebalance-interval']:
+            self.logger.debug("Saved assignment of shards of repo '%s' is used", repo)
+            return saved['units']
+
+        with self._profiler.measure('scan', 'shards', repo):
+            weights, rootWeight = scanShardUnits(roots, excludeMatcher(borgConf['exclude']),
+                                                self._scanThreads)
+        units, loads, moved = assignShards(weights, rootWeight, shard['count'],
+                                            saved.get('units', {}))
+        self.logger.info("%d directories of repo '%s' are assigned to %d shards (%d moved): %s",
+                        len(units), repo, shard['count'], moved,
+                        ', '.join(formatSize(load) for load in loads))
+        state.set(shards = { 'count' : shard['count'], 'roots' : roots,
+                            'exclude' : list(borgConf['exclude']), 'time' : time.time(),
+                            'units' : units, 'loads' : loads })
+        return units
+
+    def _autoCompression(self, borgConf, sources):
+        # Compression is chosen by benchmark of sample of source files, result is saved
+        # in state of repository and it's evaluated again after 'auto-compression-interval'
+        repo = borgConf['repository']
+        state = self._repoState(repo)
+        saved = state.get('auto-compression')
+        if saved and time.time() - saved['time'] < borgConf['auto-compression-interval']:
+            self.logger.debug("Compression '%s' was chosen for repo '%s' before",
+                            saved['spec'], repo)
+            return saved['spec']
+
+        with self._profiler.measure('scan', 'compression', repo):
+            chunks = sampleFiles(sources, borgConf['exclude'])
+            results = benchmarkCompression(chunks)
+        if not chunks:
+            self.logger.warning("No files to choose compression for repo '%s', 'lz4' is used",
+                                repo)
+            return 'lz4'
+
+        spec = chooseCompression(results, borgConf['auto-compression-min-speed'])
+        self.logger.info("Compression '%s' is chosen for repo '%s' by %d samples (%s): %s",
+                        spec, repo, len(chunks), formatSize(sum(len(c) for c in chunks)),
+                        ', '.join('%s ratio %.2f, %.0f MB/s' % (name, results[name]['ratio'],
+                            results[name]['speed']) if name in results else
+                            '%s is not measured' % name for name in AUTO_COMPRESSION_CANDIDATES))
+        state.set(**{ 'auto-compression' : {
+                        'spec' : spec, 'time' : time.time(), 'results' : results } })
+        return spec
+
+    def _isSourcesUnchanged(self, borgConf, sourcesIndex):
+        with self._profiler.measure('scan', 'sources'):
+            if borgConf.get('shard'):
+                sourcesIndex.signatures = self._shardSignatures(borgConf)
+            else:
+                sourcesIndex.scan()
+        age = sourcesIndex.unchangedAge()
+        if age is None:
+            self.logger.debug("Sources of repo '%s' are changed", borgConf['repository'])
+            return False
+        if age >= borgConf['skip-max-age']:
+            self.logger.info("Sources of repo '%s' are not changed but last archive is "
+                            "too old (%d seconds)", borgConf['repository'], age)
+            return False
+        self.logger.info("Sources of repo '%s' are not changed since last archive "
+                        "(%d seconds ago), borg create is skipped", borgConf['repository'], age)
+        return True
 
-        self._runBorgCmd(archiveConf, cmd + ' ' + params)
+    def _statePath(self, name, repo):
+        return os.path.join(self._stateDir, stateFileName(name, repo))
+
+    def _addCreateStats(self, repo, result, compression):
+        archive = result.get('archive', {})
+        archiveStats = archive.get('stats', {})
+        stats = {
+            'repository' : repo,
+            'archive'    : archive.get('name', ''),
+            'start'      : archive.get('start', ''),
+            'duration'   : float(archive.get('duration', 0)),
+            'compression': compression,
+        }
+        for name in ('original_size', 'compressed_size', 'deduplicated_size', 'nfiles'):
+            stats[name] = archiveStats.get(name, 0)
+        stats['throughput'] = stats['original_size'] / stats['duration'] / 1e6 \
+                                if stats['duration'] else 0.0
+
+        self.logger.info("Stats of archive '%s' for repo '%s': original %s, compressed %s,"
+                        " deduplicated %s, %d files, %.1f s, %.2f MB/s", stats['archive'], repo,
+                        formatSize(stats['original_size']), formatSize(stats['compressed_size']),
+                        formatSize(stats['deduplicated_size']), stats['nfiles'],
+                        stats['duration'], stats['throughput'])
+        with self._statsLock:
+            self._result.stats.append(stats)
+        self._addHistoryStats(dict((name, stats[name]) for name in
+                    ('original_size', 'compressed_size', 'deduplicated_size', 'nfiles')))
+
+    def _reportStats(self):
+        stats = self._result.stats
+        if not stats:
+            return
+
+        lines = ['%-40s %12s %12s %12s %10s %9s %9s  %s' % ('REPOSITORY', 'ORIGINAL',
+                    'COMPRESSED', 'DEDUP', 'FILES', 'SECONDS', 'MB/S', 'COMPRESSION')]
+        for item in stats:
+            lines.append('%-40s %12s %12s %12s %10d %9.1f %9.2f  %s' % (item['repository'],
+                    formatSize(item['original_size']), formatSize(item['compressed_size']),
+                    formatSize(item['deduplicated_size']), item['nfiles'],
+                    item['duration'], item['throughput'], item['compression']))
+        self.logger.info("Statistics of created archives:\n%s", '\n'.join(lines))
+
+        config = self._config
+        if hasattr(config, 'STATS_JSON_FILE') and config.STATS_JSON_FILE:
+            import json
+            writeFileAtomic(config.STATS_JSON_FILE, json.dumps({
+                'ok'    : self._result.ok,
+                'time'  : time.time(),
+                'stats' : stats,
+            }, indent = 4))
+        if hasattr(config, 'STATS_PROMETHEUS_FILE') and config.STATS_PROMETHEUS_FILE:
+            writeFileAtomic(config.STATS_PROMETHEUS_FILE, self._formatPrometheusStats(stats))
+
+    def _formatPrometheusStats(self, stats):
+        metrics = (
+            ('original_size_bytes',     'original_size',     'Original size of archive'),
+            ('compressed_size_bytes',   'compressed_size',   'Compressed size of archive'),
+            ('deduplicated_size_bytes', 'deduplicated_size', 'Deduplicated size of archive'),
+            ('files',                   'nfiles',            'Number of files in archive'),
+            ('duration_seconds',        'duration',          'Duration of borg create'),
+            ('throughput_mbps',         'throughput',        'Throughput of borg create, MB/s'),
+        )
+        lines = []
+        for name, key, desc in metrics:
+            name = 'backupomatic_borg_create_' + name
+            lines.append('# HELP %s %s' % (name, desc))
+            lines.append('# TYPE %s gauge' % name)
+            for item in stats:
+                repo = item['repository'].replace('\\', '\\\\').replace('"', '\\"')
+                lines.append('%s{repository="%s"} %s' % (name, repo, item[key]))
+        lines.append('# HELP backupomatic_last_run_timestamp_seconds Time of last run')
+        lines.append('# TYPE backupomatic_last_run_timestamp_seconds gauge')
+        lines.append('backupomatic_last_run_timestamp_seconds %d' % time.time())
+        lines.append('# HELP backupomatic_last_run_success Result of last run')
+        lines.append('# TYPE backupomatic_last_run_success gauge')
+        lines.append('backupomatic_last_run_success %d' % self._result.ok)
+        return '\n'.join(lines) + '\n'
 
     def _doRcloneDefault(self, archiveConf, cmd, params):
         self.logger.debug("Default command handler is used for rclone command '%s'", cmd)
@@ -379,33 +2958,393 @@ class Backupper(object):
         if not rcloneConf['use']:
             self.logger.info("No section 'rclone' for repository '%s', command '%s' won't be run",
                                 borgConf['repository'], cmd)
+            self._skipHistoryAction()
             return
 
         requireSource      = ('sync', 'copy', 'move', 'check', 'copyto')
         requireDestination = ('sync', 'copy', 'move', 'delete', 'purge',
                             'mkdir', 'rmdir', 'rmdirs', 'check', 'ls',
                             'lsd', 'lsl', 'size', 'cleanup', 'dedupe', 'copyto')
-        cmdLine = cmd
 
-        if cmd in requireSource:
-            cmdLine = cmdLine + ' ' + rcloneConf['source']
-        if cmd in requireDestination:
-            if not rcloneConf['destination']:
-                self.logger.error("No 'destination' for repository '%s', command '%s' won't be run",
-                                borgConf['repository'], cmd)
+        destinations = rcloneConf['destinations']
+        if cmd in requireDestination and not destinations:
+            self.logger.error("No 'destination' for repository '%s', command '%s' won't be run",
+                            borgConf['repository'], cmd)
+            return
+
+        # one snapshot is uploaded to all destinations
+        with self._rcloneSource(archiveConf, cmd in requireSource) as source:
+            if cmd not in requireSource:
+                source = None
+            if cmd not in requireDestination:
+                self._doRcloneDestination(archiveConf, rcloneConf, cmd, source, params,
+                                        withDestination = False)
+            elif len(destinations) == 1:
+                self._doRcloneDestination(archiveConf, destinations[0], cmd, source, params)
+            else:
+                self._doRcloneDestinations(archiveConf, destinations, cmd, source, params)
+
+    def _doRcloneDestinations(self, archiveConf, destinations, cmd, source, params):
+        # Run the command for all destinations at once, no more than
+        # 'parallel-destinations' of them at the same time
+        rcloneConf = archiveConf['rclone']
+        repo = archiveConf['borg']['repository']
+        maxWorkers = rcloneConf['parallel-destinations'] or len(destinations)
+        # records of destinations go to the report of the archive, their output
+        # and stats go to history record of the action
+        report = self.logger.contextReport()
+        historyRecord = self._historyRecord()
+        profileRecord = self._profiler.current()
+
+        def makeTask(destConf):
+            def task():
+                self._historyLocal.record = historyRecord
+                self._profiler.setCurrent(profileRecord)
+                with self.logger.archiveContext('[%s -> %s] ' % (repo, destConf['destination']),
+                                                report):
+                    try:
+                        return self._doRcloneDestination(archiveConf, destConf, cmd,
+                                                        source, params)
+                    except ToolResultException as exc:
+                        self.logger.error("Error: %s", exc)
+                        raise
+                    except Exception as exc:
+                        self.logger.error("Error: %s\n%s", exc, traceback.format_exc())
+                        raise
+                    finally:
+                        self._historyLocal.record = None
+                        self._profiler.setCurrent(None)
+            return task
+
+        start = time.time()
+        results = runInThreads([makeTask(conf) for conf in destinations], maxWorkers)
+
+        lines = []
+        failed = []
+        for destConf, (result, excInfo) in zip(destinations, results):
+            state = 'ok'
+            if excInfo is not None:
+                state = 'FAILED'
+                failed.append(destConf['destination'])
+            line = '%-6s %s' % (state, destConf['destination'])
+            if result:
+                line += ': %s in %s, %s/s' % (formatSize(result['bytes']),
+                            formatDuration(result['elapsed']), formatSize(result['rate']))
+            lines.append(line)
+        self.logger.info("Command '%s' for %d destinations is finished in %s:\n  %s", cmd,
+                        len(destinations), formatDuration(time.time() - start),
+                        '\n  '.join(lines))
+
+        if not failed:
+            return
+        if len(failed) < len(destinations) and rcloneConf['partial-success']:
+            self.logger.warning("Command '%s' failed for destinations: %s, it's succeeded for "
+                                "others", cmd, ', '.join(failed))
+            return
+        raise ToolResultException("Command '%s' failed for destinations: %s" %
+                                    (cmd, ', '.join(failed)))
+
+    def _doRcloneDestination(self, archiveConf, destConf, cmd, source, params,
+                            withDestination = True):
+        # 'destConf' is 'rclone' section of one destination, see _prepareDestinations,
+        # 'source' is None for commands without source. Returns status of
+        # ProgressTracker for upload commands.
+        archiveConf = dict(archiveConf)
+        archiveConf['rclone'] = destConf
+
+        args = [cmd]
+        if source:
+            args.append(source)
+        if withDestination:
+            args.append(destConf['destination'])
+        args += destConf['commands-extra'][cmd]
+        if destConf['bwlimit']:
+            args += ['--bwlimit', str(destConf['bwlimit'])]
+        params = splitArgs(params, destConf['env'])
+
+        if cmd == 'sync' and destConf['incremental']:
+            return self._doRcloneIncrementalSync(archiveConf, source, args, params)
+        return self._runRcloneArgs(archiveConf, cmd, args + params)
+
+    @contextmanager
+    def _rcloneSource(self, archiveConf, needSource):
+        # Source for rclone: repository itself or its snapshot, see 'with-lock' in
+        # config_test.py. Snapshot is removed when upload is done.
+        rcloneConf = archiveConf['rclone']
+        source = rcloneConf['source']
+        if not needSource or not rcloneConf['snapshot']:
+            yield source
+            return
+        if source.find('@') != -1 or not os.path.isdir(source):
+            self.logger.warning("Repository '%s' is not local directory, snapshot can't be "
+                                "taken, it is uploaded as is", source)
+            yield source
+            return
+
+        repoPath = os.path.realpath(os.path.expanduser(source))
+        snapshotDir = repoPath + '.rclone-snapshot'
+        if rcloneConf['snapshot-dir']:
+            # it can be shared by archives, each repository has own subdirectory
+            baseDir = os.path.realpath(os.path.expanduser(rcloneConf['snapshot-dir']))
+            makeDir(baseDir)
+            snapshotDir = os.path.join(baseDir, repoFileName('snapshot', repoPath))
+        self._takeSnapshot(archiveConf, repoPath, snapshotDir)
+        try:
+            yield snapshotDir
+        finally:
+            self._dropSnapshot(snapshotDir)
+
+    def _takeSnapshot(self, archiveConf, repoPath, snapshotDir):
+        # Snapshot is taken under borg lock, so it's consistent and the lock is held only
+        # for seconds instead of the whole upload. Hardlinks are safe because borg never
+        # changes files of repository in place, it writes new files and renames them.
+        rcloneConf = archiveConf['rclone']
+        borgConf   = archiveConf['borg']
+
+        # leftover of interrupted run
+        self._dropSnapshot(snapshotDir)
+
+        methods = SNAPSHOT_METHODS if rcloneConf['snapshot-method'] == 'auto' else \
+                    (rcloneConf['snapshot-method'], )
+        for method in methods:
+            if method == 'btrfs':
+                btrfs = findExecutable('btrfs')
+                if not btrfs or callQuietly([btrfs, 'subvolume', 'show', repoPath]) != 0:
+                    self.logger.debug("Repo '%s' is not btrfs subvolume", repoPath)
+                    continue
+                copyArgs = [btrfs, 'subvolume', 'snapshot', '-r', repoPath, snapshotDir]
+            elif method == 'reflink':
+                copyArgs = ['cp', '-a', '--reflink=always', repoPath, snapshotDir]
+            else:
+                copyArgs = ['cp', '-al', repoPath, snapshotDir]
+
+            start = time.time()
+            with self._profiler.measure('action', 'snapshot', repoPath):
+                rc = self._runCmdInSystem([self.borgBin, 'with-lock', borgConf['repository']] +
+                                copyArgs, 'borg', borgConf['env'], raiseException = False)[0]
+            if rc == 0:
+                self.logger.info("Snapshot '%s' of repo '%s' is taken with method '%s', "
+                                "repository was locked for %.1f seconds", snapshotDir,
+                                borgConf['repository'], method, time.time() - start)
                 return
-            cmdLine = cmdLine + ' ' + rcloneConf['destination']
-        cmdLine = cmdLine + rcloneConf['commands-extra'][cmd]
-
-        if rcloneConf['with-lock']:
-            env = os.environ.copy()
-            env.update(rcloneConf['env-vars'])
-            env.update(borgConf['env-vars'])
-            cmdLine = '%s with-lock %s %s %s' % (self.borgBin, borgConf['repository'],
-                                                self.rcloneBin, cmdLine)
-            self._runCmdInSystem(cmdLine + ' ' + params, 'borg', env)
+            self.logger.info("Snapshot of repo '%s' can't be taken with method '%s'",
+                            borgConf['repository'], method)
+            self._dropSnapshot(snapshotDir)
+
+        raise ToolResultException("Snapshot of repo '%s' can't be taken" % borgConf['repository'])
+
+    def _dropSnapshot(self, snapshotDir):
+        if not os.path.lexists(snapshotDir):
+            return
+        btrfs = findExecutable('btrfs')
+        # root of btrfs subvolume always has inode 256
+        if btrfs and os.stat(snapshotDir).st_ino == 256 and \
+                callQuietly([btrfs, 'subvolume', 'delete', snapshotDir]) == 0:
+            return
+        import shutil
+        shutil.rmtree(snapshotDir)
+        self.logger.debug("Snapshot '%s' is removed", snapshotDir)
+
+    def _runRcloneArgs(self, archiveConf, cmd, args):
+        rcloneConf = archiveConf['rclone']
+        borgConf   = archiveConf['borg']
+
+        tracker = None
+        parser  = None
+        if cmd in ('sync', 'copy', 'move'):
+            tracker = self._startProgress(archiveConf, 'rclone', cmd,
+                                        force = rcloneConf.get('track-progress', False))
+        if tracker:
+            parser = RcloneJsonParser(tracker)
+            args = args + ['--use-json-log', '--stats', '%ds' % max(1, self._progressInterval),
+                            '--stats-log-level', 'NOTICE']
+
+        ok = False
+        try:
+            if rcloneConf['with-lock']:
+                args = [self.borgBin, 'with-lock', borgConf['repository'], self.rcloneBin] + args
+                self._runCmdInSystem(args, 'borg', rcloneConf['lock-env'],
+                                    outputFilter = parser,
+                                    options = self._execOptions(rcloneConf, cmd))
+            else:
+                self._runRcloneCmd(archiveConf, args, outputFilter = parser, command = cmd)
+            ok = True
+        finally:
+            if tracker:
+                self._finishProgress(tracker, ok)
+        return tracker.status() if tracker else None
+
+    def _startProgress(self, archiveConf, prefix, command, force = False):
+        # Returns ProgressTracker for the command or None if PROGRESS is disabled.
+        # With 'force' the tracker is returned anyway but progress is not reported.
+        if not self._progress and not force:
+            return None
+        repo = archiveConf['borg']['repository']
+        action = '%s:%s' % (prefix, command)
+        if prefix == 'rclone' and archiveConf['rclone']['destination']:
+            # each destination has own totals
+            action += ' ' + archiveConf['rclone']['destination']
+        report = self._reportProgress if self._progress else lambda tracker: None
+        tracker = ProgressTracker(repo, action, self._repoState(repo).totals(action),
+                                    self._progressInterval, report)
+        with self._progressLock:
+            self._progressTrackers.append(tracker)
+        self._writeProgressStatus()
+        return tracker
+
+    def _finishProgress(self, tracker, ok):
+        with self._progressLock:
+            self._progressTrackers.remove(tracker)
+        # totals of successful run are used for ETA next time
+        if ok and tracker.bytes:
+            self._repoState(tracker.repo).setTotals(tracker.action, tracker.totals())
+        if ok:
+            self._addHistoryStats({ 'bytes' : tracker.bytes, 'files' : tracker.files })
+        if not self._progress:
+            return
+        status = tracker.status()
+        self.logger.progress("Progress of %s for repo '%s' is finished: %s, %d files in %s, %s/s",
+                        tracker.action, tracker.repo, formatSize(status['bytes']),
+                        status['files'], formatDuration(status['elapsed']),
+                        formatSize(status['rate']))
+        self._writeProgressStatus()
+
+    def _reportProgress(self, tracker):
+        # It's called by tracker once per PROGRESS_INTERVAL
+        status = tracker.status()
+        eta = ''
+        if status['percent'] is not None and status['eta'] is not None:
+            eta = ', %.1f%%, ETA %s' % (status['percent'], formatDuration(status['eta']))
+        self.logger.progress("Progress of %s for repo '%s': %s, %d files in %s, "
+                        "%s/s (last %ds: %s/s)%s", tracker.action, tracker.repo,
+                        formatSize(status['bytes']), status['files'],
+                        formatDuration(status['elapsed']), formatSize(status['rate']),
+                        self._progressInterval, formatSize(status['recent-rate']), eta)
+
+        # throughput collapse: recent throughput is less than quarter of previous run's one
+        previousRate = status['previous-rate']
+        slow = bool(previousRate and status['elapsed'] > 2 * self._progressInterval and
+                    status['recent-rate'] < previousRate / 4)
+        if slow and not tracker.slow:
+            self.logger.warning("Throughput of %s for repo '%s' is %s/s, it was %s/s "
+                            "during previous run", tracker.action, tracker.repo,
+                            formatSize(status['recent-rate']), formatSize(previousRate))
+        tracker.slow = slow
+        self._writeProgressStatus()
+
+    def _writeProgressStatus(self):
+        # Status of all running commands for other tools, see PROGRESS_STATUS_FILE
+        if not self._progressFile:
+            return
+        import json
+        with self._progressLock:
+            data = {
+                'pid'      : os.getpid(),
+                'time'     : time.time(),
+                'commands' : [tracker.status() for tracker in self._progressTrackers],
+            }
+            try:
+                writeFileAtomic(self._progressFile, json.dumps(data, indent = 4))
+            except Exception as exc:
+                self.logger.error("Error during writing of progress status: %s", exc)
+
+    def _doRcloneIncrementalSync(self, archiveConf, source, syncArgs, params):
+        # Upload only files which are new or changed since last upload with 'rclone copy',
+        # borg repository is append-only mostly. Full 'rclone sync' is run
+        # once per 'full-sync-interval' seconds to delete old files on remote side.
+        # 'source' is repository or its snapshot, repository itself is scanned under the
+        # lock with 'with-lock'.
+        rcloneConf = archiveConf['rclone']
+        if source.find('@') != -1 or not os.path.isdir(source):
+            self.logger.warning("Source '%s' is not local directory, full sync is used", source)
+            return self._runRcloneArgs(archiveConf, 'sync', syncArgs + params)
+
+        manifest = UploadManifest(self._statePath('rclone-manifest',
+                        '%s|%s' % (rcloneConf['source'], rcloneConf['destination'])),
+                        source, rcloneConf['incremental-hash'])
+        if not rcloneConf['with-lock']:
+            return self._syncManifestFiles(archiveConf, manifest, syncArgs, params)
+
+        # files are scanned and uploaded under the same lock, so borg can't change
+        # repository between them
+        archiveConf = dict(archiveConf)
+        archiveConf['rclone'] = dict(rcloneConf)
+        archiveConf['rclone']['with-lock'] = False
+        with self._holdBorgLock(archiveConf['borg'], rcloneConf['lock-env']):
+            return self._syncManifestFiles(archiveConf, manifest, syncArgs, params)
+
+    def _syncManifestFiles(self, archiveConf, manifest, syncArgs, params):
+        # Files of 'manifest' are scanned and changed ones are uploaded
+        rcloneConf = archiveConf['rclone']
+        source = manifest.source
+        manifest.scan()
+
+        if manifest.isFullSyncDue(rcloneConf['full-sync-interval']):
+            self.logger.info("Full sync of '%s' to '%s'", source, rcloneConf['destination'])
+            status = self._runRcloneArgs(archiveConf, 'sync', syncArgs + params)
+            manifest.save(fullSync = True)
+            return status
+
+        changed = manifest.changedFiles()
+        # borg rewrites index, hints and integrity files in the top level directory,
+        # they are small, so they are always uploaded with changed segments
+        topFiles = [relPath for relPath in manifest.current if os.sep not in relPath]
+        changed = sorted(set(changed).union(topFiles))
+        self.logger.info("Incremental upload of %d files from '%s' to '%s'",
+                        len(changed), source, rcloneConf['destination'])
+
+        import tempfile
+        fd, filesFrom = tempfile.mkstemp(prefix = 'rclone-files-', suffix = '.txt')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write('\n'.join(changed) + '\n')
+            args = ['copy', source, rcloneConf['destination'], '--files-from', filesFrom,
+                    '--no-traverse'] + rcloneConf['commands-extra']['sync'] + params
+            if rcloneConf['bwlimit']:
+                args += ['--bwlimit', str(rcloneConf['bwlimit'])]
+            status = self._runRcloneArgs(archiveConf, 'sync', args)
+        finally:
+            os.remove(filesFrom)
+        manifest.save(changed)
+        return status
+
+    @contextmanager
+    def _holdBorgLock(self, borgConf, env):
+        # Repository is locked by 'borg with-lock' while the block runs: the command of
+        # borg reports that the lock is taken and waits for the end of its input
+        args = [self.borgBin, 'with-lock', borgConf['repository'],
+                '/bin/sh', '-c', 'echo %s; exec cat >/dev/null' % BORG_LOCKED_MARK]
+        self.logger.debug("BORG command line: `%s`", formatArgs(args))
+        try:
+            proc = subprocess.Popen(args, stdin = subprocess.PIPE, stdout = subprocess.PIPE,
+                                    stderr = subprocess.STDOUT, env = env,
+                                    universal_newlines = True)
+        except OSError as exc:
+            raise ToolResultException("BORG process can't be started: %s" % exc)
+        output = []
+        for line in iter(proc.stdout.readline, ''):
+            if line.rstrip('\n') == BORG_LOCKED_MARK:
+                break
+            output.append(line)
         else:
-            self._runRcloneCmd(archiveConf, cmdLine + ' ' + params)
+            proc.stdout.close()
+            proc.stdin.close()
+            raise ToolResultException("BORG can't lock repo '%s', error code %s:\n%s" %
+                        (borgConf['repository'], proc.wait(), ''.join(output).rstrip()))
+
+        start = time.time()
+        try:
+            yield
+        finally:
+            proc.stdin.close()
+            output.append(proc.stdout.read())
+            proc.stdout.close()
+            rc = proc.wait()
+            self.logger.debug("Repo '%s' was locked for %.1f seconds", borgConf['repository'],
+                            time.time() - start)
+            if rc != 0:
+                self.logger.warning("BORG lock of repo '%s' is finished with error code %s:\n%s",
+                                    borgConf['repository'], rc, ''.join(output).rstrip())
 
     def _doShell(self, archiveConf, cmdLable, params):
         repo = archiveConf['borg']['repository']
@@ -418,63 +3357,580 @@ class Backupper(object):
         self.logger.debug("Command handler for custom shell command has been labeled as '%s': '%s'",
             cmdLable, cmdConf['command-line'])
 
-        if 'env-vars' not in cmdConf:
-            cmdConf['env-vars'] = dict()
-        cmdConf['env-vars']['BORG_REPO'] = repo
-
-        # We must do copy here otherwise we will show all our env variables in current process
-        env = os.environ.copy()
-        env.update(cmdConf['env-vars'])
+        # custom commands are the only ones which are run by shell
+        return self._runCmdInSystem(cmdConf['command-line'], 'shell', cmdConf['env'],
+                                    options = self._execOptions(cmdConf, None))
 
-        return self._runCmdInSystem(cmdConf['command-line'], 'shell', env)
+    def _execOptions(self, conf, cmd):
+        # Options of tool process for the command, values from 'commands-options'
+        # override values of the section
+        options = dict((name, conf.get(name)) for name in EXEC_OPTIONS)
+        if cmd and 'commands-options' in conf:
+            options.update(conf['commands-options'].get(cmd, {}))
+        return options
 
-    def _runBorgCmd(self, archiveConf, cmdLine, raiseException = True):
-        # We must do copy here otherwise we will show all our env variables in current process
-        env = os.environ.copy()
-        env.update(archiveConf['borg']['env-vars'])
-        return self._runCmdInSystem(self.borgBin + ' ' + cmdLine, 'borg', env, raiseException)
+    def _runBorgCmd(self, archiveConf, args, raiseException = True, outputFilter = None):
+        borgConf = archiveConf['borg']
+        options = self._execOptions(borgConf, args[0])
+        return self._runCmdInSystem([self.borgBin] + args, 'borg', borgConf['env'],
+                                    raiseException, outputFilter, options)
 
-    def _runRcloneCmd(self, archiveConf, cmdLine, raiseException = True):
-        # We must do copy here otherwise we will show all our env variables in current process
-        env = os.environ.copy()
-        env.update(archiveConf['rclone']['env-vars'])
-        return self._runCmdInSystem(self.rcloneBin + ' ' + cmdLine, 'rclone', env, raiseException)
+    def _runRcloneCmd(self, archiveConf, args, raiseException = True, outputFilter = None,
+                        command = None):
+        # 'command' is name of command for 'commands-options', it's the first arg by default
+        rcloneConf = archiveConf['rclone']
+        options = self._execOptions(rcloneConf, command or args[0])
+        return self._runCmdInSystem([self.rcloneBin] + args, 'rclone', rcloneConf['env'],
+                                    raiseException, outputFilter, options)
 
-    def _runCmdInSystem(self, cmdLine, prefix, env, raiseException = True):
+    def _runCmdInSystem(self, cmdLine, prefix, env, raiseException = True, outputFilter = None,
+                        options = None):
+        # 'cmdLine' is list of arguments to run the tool directly or string to run it
+        # with shell. 'env' is not changed, so it can be shared between calls.
 
         appLogName = prefix.upper()
-        self.logger.debug("%s command line: `%s`", appLogName, cmdLine)
-
-        # Redirect stderr to stdout, see also:
-        # https://github.com/borgbackup/borg/issues/520
-        proc = subprocess.Popen(
-            cmdLine, stdout = subprocess.PIPE, stderr = subprocess.STDOUT,
-            env = env, universal_newlines = True, shell = True)
-
-        stdout, stderr = proc.communicate()
-        if stderr:
-            self.logger.error(appLogName + ' ERRORS:\n' + stderr)
-        if stdout:
-            self.logger.info(appLogName + ' OUTPUT:\n' + stdout)
+        self.logger.debug("%s command line: `%s`", appLogName, formatArgs(cmdLine))
+
+        parent = self._profiler.current()
+        with self._profiler.measure('command', parent['name'] if parent else appLogName) \
+                as record:
+            options = options or {}
+            timeouts = (options.get('timeout'), options.get('idle-timeout'))
+            cmdLine, popenArgs = self._applyPriority(cmdLine, options,
+                                                    newSession = any(timeouts))
+
+            # Redirect stderr to stdout, see also:
+            # https://github.com/borgbackup/borg/issues/520
+            try:
+                proc = subprocess.Popen(
+                    cmdLine, stdout = subprocess.PIPE, stderr = subprocess.STDOUT,
+                    env = env, universal_newlines = True,
+                    shell = isinstance(cmdLine, string_types), **popenArgs)
+            except OSError as exc:
+                # there is no shell to report about missing tool
+                raise ToolResultException("%s process can't be started: %s" % (appLogName, exc))
+
+            if self._streamOutput or outputFilter or any(timeouts):
+                stdout, outputBytes, rusage = self._readProcOutput(proc, appLogName,
+                                                                    outputFilter, timeouts)
+            else:
+                stdout = proc.stdout.read()
+                proc.stdout.close()
+                rusage = waitProcess(proc)
+                outputBytes = len(stdout)
+                if stdout:
+                    self.logger.info(appLogName + ' OUTPUT:\n' + stdout)
+            stderr = None
+            record['output-bytes'] = outputBytes
+            if rusage:
+                record['child-cpu'] = rusage.ru_utime + rusage.ru_stime
+                record['max-rss']   = rusage.ru_maxrss
+
+        record = self._historyRecord()
+        if record is not None:
+            with self._statsLock:
+                record['output-bytes'] += outputBytes
+                if proc.returncode:
+                    record['rc'] = proc.returncode
+
         if proc.returncode != 0 and raiseException:
             raise ToolResultException("%s process terminated with error code %s" \
-                                    % (appLogName, proc.returncode))
+                                    % (appLogName, proc.returncode), proc.returncode, stdout)
         return (proc.returncode, stdout, stderr)
 
+    def _applyPriority(self, cmdLine, options, newSession):
+        # Returns command line and extra args for Popen to apply options 'nice',
+        # 'ionice-class', 'ionice-level', 'cpu-quota' and 'memory-max'.
+        # New session is needed to kill the whole tree of processes by timeout.
+        # Priorities are set by wrappers 'nice' and 'ionice' instead of preexec_fn
+        # which is unsafe with threads. Wrappers run the string command line with shell.
+        popenArgs = {}
+        if newSession:
+            if PY3:
+                popenArgs['start_new_session'] = True
+            else:
+                # python 2 has no start_new_session, setsid is the only call in child
+                popenArgs['preexec_fn'] = os.setsid
+        elif PY3:
+            # Without preexec_fn, new session and closing of fds (all fds are not
+            # inheritable in python 3) subprocess can use posix_spawn or vfork
+            popenArgs['close_fds'] = False
+
+        wrapper = []
+        nice = options.get('nice')
+        if nice:
+            niceBin = findExecutable('nice')
+            if niceBin:
+                wrapper += [niceBin, '-n', str(nice)]
+            else:
+                self.logger.warning("Tool 'nice' not found, 'nice' is ignored")
+
+        ioClass = options.get('ionice-class')
+        ioLevel = options.get('ionice-level')
+        if ioClass:
+            ioClass = IONICE_CLASSES.get(ioClass, ioClass)
+            try:
+                ioClass = int(ioClass)
+            except ValueError:
+                raise KeyError("Unknown value '%s' of 'ionice-class', should be one of: %s"
+                                % (ioClass, ', '.join(sorted(IONICE_CLASSES))))
+            ionice = findExecutable('ionice')
+            if ionice:
+                wrapper += [ionice, '-c', str(ioClass)]
+                if ioLevel is not None:
+                    wrapper += ['-n', str(ioLevel)]
+            else:
+                self.logger.warning("Tool 'ionice' not found, 'ionice-class' is ignored")
+        if wrapper:
+            cmdLine = wrapper + self._shellArgs(cmdLine)
+
+        limits = []
+        if options.get('cpu-quota'):
+            limits.append('CPUQuota=%s' % options['cpu-quota'])
+        if options.get('memory-max'):
+            limits.append('MemoryMax=%s' % options['memory-max'])
+        if limits:
+            wrapper = self._systemdRunWrapper()
+            if wrapper:
+                for limit in limits:
+                    wrapper += ['-p', limit]
+                cmdLine = wrapper + ['--'] + self._shellArgs(cmdLine)
+            else:
+                self.logger.warning("Systemd scope can't be created, 'cpu-quota' and "
+                                    "'memory-max' are ignored")
+
+        return (cmdLine, popenArgs)
+
+    def _systemdRunWrapper(self):
+        # Command line of 'systemd-run --scope' or None if it can't be used. Not root user
+        # needs its own systemd instance (option --user), so it's checked once by test run.
+        with self._systemdRunLock:
+            if self._systemdRun is None:
+                self._systemdRun = []
+                systemdRun = findExecutable('systemd-run')
+                # the same check as sd_booted() does
+                if systemdRun and os.path.isdir('/run/systemd/system'):
+                    wrapper = [systemdRun, '--scope', '--quiet', '--collect']
+                    if os.geteuid() != 0:
+                        wrapper.append('--user')
+                    try:
+                        rc = callQuietly(wrapper + ['--', 'true'])
+                    except OSError:
+                        rc = None
+                    if rc == 0:
+                        self._systemdRun = wrapper
+                    else:
+                        self.logger.debug("Test run of `%s` is failed with code %s",
+                                        formatArgs(wrapper + ['--', 'true']), rc)
+            return list(self._systemdRun) or None
+
+    def _shellArgs(self, cmdLine):
+        # Arguments to run command line by wrapper
+        if isinstance(cmdLine, string_types):
+            return ['/bin/sh', '-c', cmdLine]
+        return list(cmdLine)
+
+    def _readProcOutput(self, proc, appLogName, outputFilter = None, timeouts = (None, None)):
+        # Read output of the process line by line while it is running. With STREAM_OUTPUT
+        # it is sent to the logger in small batches and only the last lines of the output
+        # are kept in memory and returned as result. Otherwise the whole output is logged
+        # at the end. 'outputFilter' can change a line or drop it by returning None.
+        # 'timeouts' are total and idle timeouts, the process is killed if one is expired.
+        # If 'outputFilter' has method 'tick' it's called once per OUTPUT_BATCH_INTERVAL.
+
+        live  = self._streamOutput
+        tick  = getattr(outputFilter, 'tick', None)
+        tail  = deque(maxlen = self._outputTailLines if live else None)
+        batch = []
+        lastLogTime = lastTickTime = time.time()
+        outputBytes = 0
+
+        def logBatch():
+            if batch:
+                self.logger.info(appLogName + ' OUTPUT:\n' + '\n'.join(batch))
+                del batch[:]
+
+        if any(timeouts) or live or tick:
+            # while the pipe is idle the pending batch is logged by ticks of the reader
+            lines = iterLinesWithTimeouts(proc.stdout, *timeouts,
+                        tickInterval = OUTPUT_BATCH_INTERVAL if live or tick else None)
+        else:
+            lines = iter(proc.stdout.readline, '')
+
+        timeoutError = None
+        try:
+            for line in lines:
+                if tick and time.time() - lastTickTime >= OUTPUT_BATCH_INTERVAL:
+                    lastTickTime = time.time()
+                    tick()
+                if line is None:
+                    logBatch()
+                    lastLogTime = time.time()
+                    continue
+                outputBytes += len(line)
+                line = line.rstrip('\n')
+                if outputFilter:
+                    line = outputFilter(line)
+                    if line is None:
+                        continue
+                tail.append(line)
+                if not live:
+                    continue
+                batch.append(line)
+                now = time.time()
+                if len(batch) >= OUTPUT_BATCH_LINES or \
+                        now - lastLogTime >= OUTPUT_BATCH_INTERVAL:
+                    logBatch()
+                    lastLogTime = now
+        except CommandTimeout as exc:
+            timeoutError = exc
+            killProcessGroup(proc, self._killGracePeriod)
+
+        if not live:
+            batch = list(tail)
+        logBatch()
+        proc.stdout.close()
+        rusage = waitProcess(proc)
+
+        if timeoutError:
+            self.logger.error("%s process was killed: %s", appLogName, timeoutError)
+
+        return ('\n'.join(tail), outputBytes, rusage)
+
     def run(self):
+        self._result = RunResult()
+        self._checkBudget = None
+        self._historyRunId = self._startHistoryRun()
         try:
-            self._prepare()
-            for act in self._actions:
-                self._doAction(act)
+            with self._profiler.measure('prepare', 'prepare'):
+                self._prepare()
+            self._dropHookResults()
+            self._probeHooks()
+            if self._pipeline:
+                self._doPipeline()
+            else:
+                for act in self._actions:
+                    self._doAction(act)
+            self._result.ok = True
         except ToolResultException as exc:
             self.logger.error("Error: %s", exc)
-            return False
         except Exception as exc:
             self.logger.error("Error: %s\n%s", exc, traceback.format_exc())
-            return False
+        self._finishHistoryRun(self._historyRunId, self._result.ok)
+
+        try:
+            self._reportStats()
+        except Exception as exc:
+            self.logger.error("Error during stats reporting: %s", exc)
+
+        # email is sent at the end of the run with profile or without it
+        with self._profiler.measure('email', 'flush'):
+            self.logger.flushMail()
+        self._reportProfile()
+
+        return self._result
+
+    def prepareJobs(self):
+        # Daemon mode: config is prepared once and archives are run by schedule
+        self._prepare()
+        self._result.ok = True
+
+    def jobs(self):
+        # Returns list of tuples (archiveConf, schedule entry) for daemon mode,
+        # see SCHEDULE in config_test.py
+        config = self._config
+        defaultSchedule = config.SCHEDULE if hasattr(config, 'SCHEDULE') else DEFAULT_SCHEDULE
+        result = []
+        for archiveConf in config.archives:
+            schedule = archiveConf.get('schedule', defaultSchedule)
+            if not schedule:
+                continue
+            if isinstance(schedule, dict):
+                schedule = (schedule, )
+            for entry in schedule:
+                if not entry.get('interval') and not entry.get('cron'):
+                    raise KeyError("Field 'interval' or 'cron' not found in schedule of "
+                                    "repo '%s'" % archiveConf['borg']['repository'])
+                entry = dict(entry)
+                entry['actions'] = tuple(entry.get('actions') or self._actions)
+                result.append((archiveConf, entry))
+        return result
+
+    def runJob(self, archiveConf, actions):
+        # Run list of actions for one archive, it's used by daemon mode.
+        # Returns False if some action failed.
+        self._dropHookResults(archiveConf['borg']['repository'])
+        runId = self._historyLocal.run = self._startHistoryRun()
+        ok = False
+        with self.logger.archiveContext('[%s] ' % archiveConf['borg']['repository']):
+            try:
+                for action in actions:
+                    prefix, command, params, methodCall = self._resolveAction(action)
+                    self._doArchiveAction(archiveConf, prefix, command, params, methodCall)
+                ok = True
+            except ToolResultException as exc:
+                self.logger.error("Error: %s", exc)
+            except Exception as exc:
+                self.logger.error("Error: %s\n%s", exc, traceback.format_exc())
+        self._finishHistoryRun(runId, ok)
+        self._historyLocal.run = None
+        if ok:
+            return True
+        with self._statsLock:
+            self._result.ok = False
+        return False
+
+    def flushReports(self):
+        # Daemon mode: report stats collected since previous call and send email
+        try:
+            self._reportStats()
+        except Exception as exc:
+            self.logger.error("Error during stats reporting: %s", exc)
+        with self._statsLock:
+            self._result = RunResult()
+            self._result.ok = True
+        # shards are assigned again by the next jobs, saved assignment is used until
+        # 'shard-rebalance-interval' is passed
+        with self._shardLock:
+            self._shardPlans = {}
+            self._shardScans = {}
+        # time budget of checks is given to each cycle of jobs
+        with self._stateLock:
+            self._checkBudget = None
+        self.logger.flushMail()
+
+    def _reportProfile(self):
+        profiler = self._profiler
+        if not profiler.enabled:
+            return
 
+        # email is already sent, so sending of it is in the profile
+        self.logger.info("Profile of the run:\n%s", profiler.formatSummary(), toMail = False)
+        if self._profileJson:
+            try:
+                profiler.dumpJson(self._profileJson)
+            except Exception as exc:
+                self.logger.error("Error during saving of profile: %s", exc)
+
+class ScheduledJob(object):
+    # Actions of one archive run by schedule in daemon mode
+
+    def __init__(self, backupper, archiveConf, schedule, lastRuns):
+        self.backupper   = backupper
+        self.archiveConf = archiveConf
+        self.actions     = schedule['actions']
+        self.repo        = archiveConf['borg']['repository']
+        self.key         = '%s %s' % (self.repo, ' '.join(self.actions))
+        self.interval    = schedule.get('interval')
+        self.cron        = parseCron(schedule['cron']) if schedule.get('cron') else None
+        self.lastRun     = lastRuns.get(self.key)
+        self.active      = False
+        self.updateNextTime(time.time())
+
+    def updateNextTime(self, now):
+        # Cron job missed while daemon was not running is run once at start
+        if self.cron:
+            self.nextTime = nextCronTime(self.cron, self.lastRun or now)
+        else:
+            self.nextTime = self.lastRun + self.interval if self.lastRun else now
+
+class Daemon(object):
+    # Daemon mode: configs are loaded once, archives are run by their schedules.
+    # Due jobs are queued and run by 'maxJobs' workers, jobs of the same repository
+    # are never run at the same time. SIGHUP reloads configs, SIGTERM/SIGINT stops
+    # daemon after running jobs are finished. Config is locked (see LOCK_FILE in
+    # config_test.py) only while its jobs are run, so ad-hoc runs are possible between.
+
+    def __init__(self, configs, maxJobs):
+        self._configs   = configs
+        self._maxJobs   = max(1, maxJobs)
+        self._log       = logging.getLogger(__name__)
+        self._lock      = threading.Lock()
+        self._wake      = threading.Event()
+        self._stop      = False
+        self._reload    = False
+        self._running   = 0
+        self._dirty     = False
+        self._units     = []
+        self._jobs      = []
+        self._locked    = set()
+
+    def _statePath(self, backupper):
+        return os.path.join(backupper._stateDir,
+                            'daemon-%s.json' % getattr(backupper._config, '__name__', 'config'))
+
+    def _load(self):
+        # Returns list of tuples (backupper, jobs) for all configs or raises exception
+        units = []
+        try:
+            for config in self._configs:
+                backupper = Backupper(config, [])
+                if len(self._configs) > 1:
+                    backupper.logger.consolePrefix = '[%s] ' % config.__name__
+                units.append((backupper, []))
+                backupper.prepareJobs()
+                lastRuns = loadJsonFile(self._statePath(backupper), {})
+                for archiveConf, schedule in backupper.jobs():
+                    units[-1][1].append(ScheduledJob(backupper, archiveConf, schedule, lastRuns))
+        except Exception:
+            for backupper, _ in units:
+                backupper.logger.close()
+            raise
+        return units
+
+    def _doReload(self):
+        # It's called only when there are no running jobs
+        self._log.info("Reloading of configs")
+        for backupper, _ in self._units:
+            backupper.flushReports()
+        self._unlockUnits()
+        oldConfigs = self._configs
+        try:
+            reloadModule = reload if PY2 else __import__('importlib').reload
+            self._configs = [reloadModule(config) for config in self._configs]
+            units = self._load()
+        except Exception as exc:
+            self._log.error("Error during reloading of configs, previous configs are "
+                            "used: %s\n%s", exc, traceback.format_exc())
+            self._configs = oldConfigs
+            return
+        for backupper, _ in self._units:
+            backupper.logger.close()
+        self._setUnits(units)
+
+    def _lockUnit(self, backupper):
+        # Config is locked before the first job of cycle, returns False if it's locked
+        # by other process
+        if backupper in self._locked:
+            return True
+        if not backupper.lock():
+            return False
+        self._locked.add(backupper)
         return True
 
+    def _unlockUnits(self):
+        for backupper in self._locked:
+            backupper.unlock()
+        self._locked = set()
+
+    def _setUnits(self, units):
+        self._units = units
+        self._jobs = [job for _, jobs in units for job in jobs]
+        for job in self._jobs:
+            self._log.info("Job '%s' is scheduled, next run at %s", job.key,
+                            time.strftime('%Y-%m-%d %H:%M', time.localtime(job.nextTime)))
+
+    def _onSignal(self, signum, frame):
+        import signal
+        if signum == signal.SIGHUP:
+            self._reload = True
+        else:
+            self._stop = True
+        self._wake.set()
+
+    def _worker(self, queue):
+        while True:
+            job = queue.get()
+            if job is None:
+                return
+            start = time.time()
+            self._log.info("Job '%s' is started", job.key)
+            ok = job.backupper.runJob(job.archiveConf, job.actions)
+            self._log.info("Job '%s' is finished %s in %d seconds", job.key,
+                            'successfully' if ok else 'with errors', time.time() - start)
+            with self._lock:
+                job.lastRun = start
+                job.updateNextTime(time.time())
+                job.active = False
+                self._running -= 1
+                self._dirty = True
+                statePath = self._statePath(job.backupper)
+                lastRuns = loadJsonFile(statePath, {})
+                lastRuns[job.key] = start
+                try:
+                    saveJsonFile(statePath, lastRuns)
+                except Exception as exc:
+                    self._log.error("Error during saving of daemon state: %s", exc)
+            self._wake.set()
+
+    def run(self):
+        import signal
+        try:
+            from queue import Queue
+        except ImportError:
+            from Queue import Queue
+
+        try:
+            self._setUnits(self._load())
+        except Exception as exc:
+            self._log.error("Error: %s\n%s", exc, traceback.format_exc())
+            return 1
+
+        for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, self._onSignal)
+
+        queue = Queue()
+        workers = [threading.Thread(target = self._worker, args = (queue, ))
+                    for _ in range(self._maxJobs)]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+
+        self._log.info("Daemon is started with %d jobs", len(self._jobs))
+        while not self._stop:
+            self._wake.clear()
+            now = time.time()
+            with self._lock:
+                idle = self._running == 0
+                if self._reload and idle:
+                    self._reload = False
+                    self._doReload()
+                    continue
+                if not self._reload:
+                    busy = set(job.repo for job in self._jobs if job.active)
+                    refused = set()
+                    for job in sorted(self._jobs, key = lambda job: job.nextTime):
+                        # job is queued only for free worker, so jobs waiting in queue
+                        # are not run after stop
+                        if self._running >= self._maxJobs:
+                            break
+                        if job.active or job.nextTime > now or job.repo in busy:
+                            continue
+                        if job.backupper in refused or not self._lockUnit(job.backupper):
+                            refused.add(job.backupper)
+                            job.nextTime = now + DAEMON_LOCK_RETRY
+                            continue
+                        job.active = True
+                        busy.add(job.repo)
+                        self._running += 1
+                        queue.put(job)
+                    idle = self._running == 0
+                dirty = idle and self._dirty
+                if dirty:
+                    self._dirty = False
+                # when all workers are busy, finished job wakes the loop
+                waiting = [job.nextTime for job in self._jobs if not job.active] \
+                            if self._running < self._maxJobs else []
+            if dirty:
+                # email report is sent when there are no running jobs
+                for backupper, _ in self._units:
+                    backupper.flushReports()
+            if idle:
+                self._unlockUnits()
+            timeout = min(waiting) - time.time() if waiting else 60
+            self._wake.wait(min(max(timeout, 0.1), 60))
+
+        self._log.info("Daemon is stopping, waiting for %d running jobs", self._running)
+        for worker in workers:
+            queue.put(None)
+        for worker in workers:
+            while worker.is_alive():
+                worker.join(1)
+        for backupper, _ in self._units:
+            backupper.flushReports()
+        self._unlockUnits()
+        return 0
+
 def main():
 
     parser = argparse.ArgumentParser(
@@ -482,6 +3938,30 @@ def main():
     parser.add_argument('-a', '--action', nargs = '?', default='', \
         help = "action, optional, format:\nprefix:command[:\"command params\"]"
                 "\nprefix is one of: %s" % str(ALLOWED_PREFIXES)[1:-1])
+    parser.add_argument('-p', '--parallel', type = int, default = None, metavar = 'N', \
+        help = "max number of archives processed at the same time,\n"
+                "overrides MAX_PARALLEL_ARCHIVES from config files")
+    parser.add_argument('--pipeline', action = 'store_true', default = None, \
+        help = "run the whole list of actions for each archive separately,\n"
+                "see PIPELINE_ARCHIVES in config_test.py")
+    parser.add_argument('--profile-json', dest = 'profileJson', default = None, \
+        metavar = 'FILE', help = "collect timings of the run and save them to JSON file,\n"
+                "see also PROFILE in config_test.py")
+    parser.add_argument('-j', '--jobs', type = int, default = 1, metavar = 'N', \
+        help = "max number of config files processed at the same time, 1 by default,\n"
+                "in daemon mode it's max number of jobs run at the same time")
+    parser.add_argument('-k', '--keep-going', action = 'store_true', dest = 'keepGoing', \
+        help = "don't stop on failed config file, process the rest of config files")
+    parser.add_argument('-d', '--daemon', action = 'store_true', \
+        help = "run archives by schedules from config files until SIGTERM,\n"
+                "SIGHUP reloads config files, see SCHEDULE in config_test.py")
+    parser.add_argument('--profile-startup', dest = 'profileStartup', action = 'store_true', \
+        help = "report time of start: imports of modules and loading of config files")
+    parser.add_argument('--history', action = 'store_true', \
+        help = "show trends of durations and sizes of actions from HISTORY_DB")
+    parser.add_argument('--history-filter', dest = 'historyFilter', default = '', \
+        metavar = 'FILTER', help = "show history only for repositories or actions\n"
+                "containing FILTER, see --history")
     parser.add_argument("configFiles", nargs = '+', metavar = 'configfile', \
         help = "path to config file, file should have python format")
 
@@ -498,15 +3978,68 @@ def main():
     sys.path.insert(0, os.getcwd())
 
     # load all configs as python files
-    configs = map(lambda m: __import__(m[:-3]),
-            filter(lambda f: f.endswith(".py"), configFiles))
-
-    for cfg in configs:
-        backupper = Backupper(cfg, args.action.split())
-        if not backupper.run():
-            return 1
-
-    return 0
+    loadStart = time.time()
+    configs = list(map(lambda m: __import__(m[:-3]),
+            filter(lambda f: f.endswith(".py"), configFiles)))
+
+    if args.profileStartup:
+        logging.getLogger(__name__).info("Startup: imports of modules %.1f ms, loading of "
+            "config files %.1f ms, total %.1f ms, %d modules are loaded",
+            IMPORT_DURATION * 1000, (time.time() - loadStart) * 1000,
+            (time.time() - STARTUP_TIME) * 1000, len(sys.modules))
+
+    if args.history:
+        results = [printHistory(cfg, args.historyFilter) for cfg in configs]
+        return 0 if all(results) else 1
+
+    if args.daemon:
+        return Daemon(configs, args.jobs).run()
+
+    def makeTask(cfg):
+        def task():
+            profileJson = args.profileJson
+            if profileJson and len(configs) > 1:
+                name, ext = os.path.splitext(profileJson)
+                profileJson = '%s-%s%s' % (name, cfg.__name__, ext)
+            backupper = Backupper(cfg, args.action.split(), args.parallel, args.pipeline,
+                                    profileJson)
+            if args.jobs > 1:
+                backupper.logger.consolePrefix = '[%s] ' % cfg.__name__
+            # ad-hoc actions given by '-a' don't lock config, only default actions do
+            if args.action:
+                return backupper.run()
+            if not backupper.lock():
+                return RunResult()
+            try:
+                return backupper.run()
+            finally:
+                backupper.unlock()
+        return task
+
+    tasks = [makeTask(cfg) for cfg in configs]
+    if args.jobs > 1:
+        results = runInThreads(tasks, args.jobs, stopOnError = not args.keepGoing,
+                                failOnFalse = True)
+    else:
+        results = []
+        for task in tasks:
+            results.append((task(), None))
+            if not results[-1][0] and not args.keepGoing:
+                break
+
+    log = logging.getLogger(__name__)
+    rc = 0
+    for cfg, result in zip(configs, results + [None] * (len(configs) - len(results))):
+        if result is None:
+            if len(configs) > 1:
+                log.info("Config '%s' was skipped because of previous errors", cfg.__name__)
+            rc = 1
+        elif result[1] is not None or not result[0]:
+            if len(configs) > 1:
+                log.error("Config '%s' finished with errors", cfg.__name__)
+            rc = 1
+
+    return rc
 
 if __name__ == '__main__':
     sys.exit(main())
@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+# coding=utf8
+#
+# Benchmarks of overhead of backup.py itself. Real borg and rclone are replaced
+# with fake_tool.py, so it can be run offline on any linux box.
+#
+# Each scenario is run in a separate python process to measure its peak memory.
+# Results can be saved with --json and compared with saved results with --baseline.
+#
+# Examples:
+#   bench/benchmark.py
+#   bench/benchmark.py --archives 500 --lines 1000000 --json bench_output.json
+#   bench/benchmark.py --baseline bench_output.json --threshold 1.3
+
+import sys, os
+import time
+import json
+import types
+import shutil
+import logging
+import argparse
+import resource
+import tempfile
+import subprocess
+
+BENCH_DIR = os.path.dirname(os.path.realpath(__file__))
+FAKE_TOOL = os.path.join(BENCH_DIR, 'fake_tool.py')
+
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+import backup
+
+# name -> (function, description), filled by decorator 'scenario'
+SCENARIOS = {}
+SCENARIOS_ORDER = []
+
+def scenario(description):
+    def decorator(func):
+        SCENARIOS[func.__name__] = (func, description)
+        SCENARIOS_ORDER.append(func.__name__)
+        return func
+    return decorator
+
+def makeConfig(workDir, archivesNum, **attrs):
+    # Synthetic config with 'archivesNum' archives, attrs override any config value
+    config = types.ModuleType('bench_config')
+    config.archives = tuple({
+        'borg' : {
+            'repository'     : os.path.join(workDir, 'repo%04d' % i),
+            'source'         : (workDir, ),
+            'exclude'        : ('*.tmp', '*/cache'),
+            'commands-extra' : { 'create' : '--stats', 'prune' : '--keep-daily=7' },
+            'env-vars'       : { 'BENCH_ARCHIVE' : str(i) },
+        },
+        'rclone' : {
+            'destination'    : 'remote:bench/%d' % i,
+        },
+    } for i in range(archivesNum))
+    config.BORG_BIN   = FAKE_TOOL
+    config.RCLONE_BIN = FAKE_TOOL
+    config.LOG_LEVEL  = logging.INFO
+    config.DEFAULT_ACTIONS = ('borg:create', )
+    for name, value in attrs.items():
+        setattr(config, name, value)
+    return config
+
+def silenceConsole():
+    # Output of backup.py goes to /dev/null but it is still formatted and written
+    devnull = open(os.devnull, 'w')
+    for handler in logging.getLogger(backup.__name__).handlers:
+        handler.stream = devnull
+
+def timeIt(func, repeat = 1):
+    start = time.time()
+    for _ in range(repeat):
+        func()
+    return time.time() - start
+
+def rawToolTime(env, calls, args = ('prune', )):
+    # Time of running of fake tool without backup.py, it is subtracted from results
+    devnull = open(os.devnull, 'w')
+    return timeIt(lambda: subprocess.call((FAKE_TOOL, ) + args, env = env,
+                    stdout = devnull, stderr = subprocess.STDOUT), calls)
+
+@scenario("overhead of one _runCmdInSystem call without output, ms")
+def runCmd(opts, workDir):
+    calls = opts.calls
+    backupper = backup.Backupper(makeConfig(workDir, 1), ['borg:prune'])
+    env = os.environ.copy()
+    args = [FAKE_TOOL, 'prune']
+    wrapped = timeIt(lambda: backupper._runCmdInSystem(args, 'borg', env), calls)
+    raw = rawToolTime(env, calls)
+    return { 'value' : (wrapped - raw) / calls * 1000.0 }
+
+@scenario("wall time of command with big output without STREAM_OUTPUT, s")
+def outputBuffered(opts, workDir):
+    return _bigOutput(opts, workDir, False)
+
+@scenario("wall time of command with big output with STREAM_OUTPUT, s")
+def outputStream(opts, workDir):
+    return _bigOutput(opts, workDir, True)
+
+def _bigOutput(opts, workDir, stream):
+    os.environ['FAKE_TOOL_LINES'] = str(opts.lines)
+    backupper = backup.Backupper(makeConfig(workDir, 1, STREAM_OUTPUT = stream), ['borg:prune'])
+    backupper._prepare()
+    return { 'value' : timeIt(lambda: backupper._doAction('borg:prune')) }
+
+@scenario("time of _prepare for all archives, ms")
+def prepare(opts, workDir):
+    repeat = 5
+    total = 0.0
+    for _ in range(repeat):
+        backupper = backup.Backupper(makeConfig(workDir, opts.archives), ['borg:create'])
+        total += timeIt(backupper._prepare)
+    return { 'value' : total / repeat * 1000.0 }
+
+@scenario("time of BufferingSMTPHandler.flush of big report, s")
+def mailFlush(opts, workDir):
+    # fake sendmail in PATH
+    binDir = os.path.join(workDir, 'bin')
+    os.makedirs(binDir)
+    sendmail = os.path.join(binDir, 'sendmail')
+    with open(sendmail, 'w') as f:
+        f.write('#!/bin/sh\ncat > /dev/null\n')
+    os.chmod(sendmail, 0o755)
+    os.environ['PATH'] = binDir + os.pathsep + os.environ['PATH']
+
+    handler = backup.BufferingSMTPHandler({
+        'from' : 'bench', 'to' : 'bench', 'subject' : 'bench',
+        'spill-dir' : os.path.join(workDir, 'spill'),
+    })
+    handler.setFormatter(backup.LOG_FORMATTER)
+    bigText = '\n'.join('line %d of big output' % i for i in range(opts.lines // 10))
+    for i in range(opts.archives * 10):
+        msg = bigText if i % 100 == 0 else 'record %d' % i
+        handler.handle(logging.makeLogRecord({ 'msg' : msg, 'levelno' : logging.INFO,
+                                                'levelname' : 'INFO' }))
+    return { 'value' : timeIt(handler.flush) }
+
+@scenario("overhead of _doAction per archive without output, ms")
+def action(opts, workDir):
+    return _action(opts, workDir, 1)
+
+@scenario("wall time of _doAction per archive with 8 parallel archives, ms")
+def actionParallel(opts, workDir):
+    return _action(opts, workDir, 8)
+
+def _action(opts, workDir, parallel):
+    archives = opts.archives
+    backupper = backup.Backupper(makeConfig(workDir, archives), ['borg:prune'], parallel)
+    backupper._prepare()
+    # raw time is measured first to have the same warm caches for both
+    raw = rawToolTime(os.environ.copy(), archives) if parallel == 1 else 0.0
+    wrapped = timeIt(lambda: backupper._doAction('borg:prune'))
+    return { 'value' : (wrapped - raw) / archives * 1000.0 }
+
+def runScenario(name, opts):
+    # it is run in child process, see main
+    silenceConsole()
+    workDir = tempfile.mkdtemp(prefix = 'backup-bench-')
+    try:
+        result = SCENARIOS[name][0](opts, workDir)
+    finally:
+        shutil.rmtree(workDir, ignore_errors = True)
+    # ru_maxrss is in kilobytes on linux
+    result['max-rss-mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    print(json.dumps(result))
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Benchmarks of backup.py overhead')
+    parser.add_argument('--archives', type = int, default = 200,
+                        help = 'number of archives in synthetic config, 200 by default')
+    parser.add_argument('--lines', type = int, default = 200000,
+                        help = 'number of output lines for big output, 200000 by default')
+    parser.add_argument('--calls', type = int, default = 100,
+                        help = 'number of calls for call overhead, 100 by default')
+    parser.add_argument('--scenario', action = 'append', choices = SCENARIOS_ORDER,
+                        help = 'run only this scenario, can be used several times')
+    parser.add_argument('--json', metavar = 'FILE', help = 'save results to JSON file')
+    parser.add_argument('--baseline', metavar = 'FILE',
+                        help = 'compare results with results saved with --json')
+    parser.add_argument('--threshold', type = float, default = 1.25,
+                        help = 'max allowed ratio to baseline, 1.25 by default')
+    parser.add_argument('--run-scenario', dest = 'runScenario', help = argparse.SUPPRESS)
+    opts = parser.parse_args()
+
+    if opts.runScenario:
+        runScenario(opts.runScenario, opts)
+        return 0
+
+    baseline = {}
+    if opts.baseline:
+        with open(opts.baseline) as f:
+            baseline = json.load(f)
+
+    results = {}
+    regressions = []
+    print('%-16s %12s %12s   %s' % ('SCENARIO', 'VALUE', 'MAX RSS, MB', 'DESCRIPTION'))
+    for name in opts.scenario or SCENARIOS_ORDER:
+        args = [sys.executable, os.path.realpath(__file__), '--run-scenario', name,
+                '--archives', str(opts.archives), '--lines', str(opts.lines),
+                '--calls', str(opts.calls)]
+        output = subprocess.check_output(args, universal_newlines = True)
+        result = json.loads(output.strip().splitlines()[-1])
+        results[name] = result
+
+        mark = ''
+        if name in baseline:
+            for key in ('value', 'max-rss-mb'):
+                base = baseline[name][key]
+                if base > 0 and result[key] > base * opts.threshold:
+                    regressions.append('%s %s: %.2f -> %.2f' % (name, key, base, result[key]))
+                    mark = '  REGRESSION'
+        print('%-16s %12.2f %12.1f   %s%s' % (name, result['value'], result['max-rss-mb'],
+                                            SCENARIOS[name][1], mark))
+
+    if opts.json:
+        with open(opts.json, 'w') as f:
+            json.dump(results, f, indent = 4)
+
+    if regressions:
+        print('\nRegressions:\n  ' + '\n  '.join(regressions))
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
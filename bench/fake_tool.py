@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# coding=utf8
+#
+# Stand-in for borg and rclone to benchmark backup.py without real tools.
+# Behaviour is set by environment variables, each variable can be set for
+# one command only with suffix, for example FAKE_TOOL_RC_CREATE=2:
+#
+#   FAKE_TOOL_LINES      number of output lines, 0 by default
+#   FAKE_TOOL_LINE_SIZE  size of each output line in chars, 80 by default
+#   FAKE_TOOL_RATE       output lines per second, 0 (as fast as possible) by default
+#   FAKE_TOOL_SLEEP      seconds to sleep before exit, 0 by default
+#   FAKE_TOOL_RC         exit code, 0 by default
+#
+# 'init' prints 'A repository already exists' and exits with code 2 if
+# FAKE_TOOL_RC_INIT is 2. 'create' with --json prints result document like borg.
+
+import sys, os, time
+
+def option(name, default, command):
+    value = os.environ.get('FAKE_TOOL_%s_%s' % (name, command.upper().replace('-', '_')))
+    if value is None:
+        value = os.environ.get('FAKE_TOOL_' + name, default)
+    return type(default)(value)
+
+def main():
+    args = sys.argv[1:]
+    command = args[0] if args else ''
+
+    lines    = option('LINES', 0, command)
+    lineSize = option('LINE_SIZE', 80, command)
+    rate     = option('RATE', 0.0, command)
+    sleep    = option('SLEEP', 0.0, command)
+    rc       = option('RC', 0, command)
+
+    out = sys.stdout
+    payload = 'x' * max(0, lineSize - 12)
+    start = time.time()
+    for i in range(lines):
+        out.write('%10d %s\n' % (i, payload))
+        if rate:
+            out.flush()
+            delay = start + (i + 1) / rate - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+    if command == 'init' and rc == 2:
+        out.write('A repository already exists at %s.\n' % os.environ.get('BORG_REPO', ''))
+    if command == 'create' and '--json' in args:
+        duration = max(time.time() - start + sleep, 0.001)
+        out.write('{\n    "archive": {\n        "duration": %f,\n        "name": "fake",\n'
+                '        "stats": {\n            "compressed_size": %d,\n'
+                '            "deduplicated_size": %d,\n            "nfiles": %d,\n'
+                '            "original_size": %d\n        }\n    }\n}\n' %
+                (duration, lines * lineSize // 2, lines * lineSize // 10, lines,
+                lines * lineSize))
+    out.flush()
+
+    if sleep:
+        time.sleep(sleep)
+    return rc
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -33,4 +33,16 @@ email = {
     'from'   : 'root',
     'to'     : 'root',
     'subject': 'My backups (%s)' % platform.node(),
+
+    # Limits of report size in chars, optional. Too long records (for example big output
+    # of some command) are cut in the middle and if the whole report is still too big
+    # only its beginning and ending are sent. Cut text is saved in gzipped file in
+    # 'spill-dir' (temp dir by default), this file can be attached to the email.
+    # Attached file is removed after the email is sent, otherwise only 'spill-keep'
+    # last files (10 by default) are kept in 'spill-dir'.
+    #'max-size'        : 2 * 1024 * 1024,
+    #'max-record-size' : 256 * 1024,
+    #'spill-dir'       : '/var/log/backup-o-matic',
+    #'attach-spill'    : True,
+    #'spill-keep'      : 10,
 }
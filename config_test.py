@@ -13,11 +13,64 @@ default = {
     'borg' : {
         'archive-name'    : '"{now:%Y-%m-%d.%H:%M:%S}"', # optional, default '"{now:%Y-%m-%d.%H:%M}"',
         #'compression'     : 'zlib,4',                 # optional, default 'lz4'
+        # Compression 'auto': sample of source files (up to 128 chunks of 64 kB) is compressed
+        # with candidates 'lz4', 'zstd,3', 'zlib,6', 'zstd,10' and 'lzma,6' and the strongest
+        # one which makes data 10% smaller than the previous chosen candidate and whose speed
+        # is not less than 'auto-compression-min-speed' MB/s is chosen: 'lz4' or borg's
+        # 'auto,<spec>'. Only candidates available in python are measured: 'lz4' and 'zstd'
+        # need python modules 'lz4' and 'zstandard', without them the choice is between
+        # 'zlib' and 'lzma' and 'lz4' is used if they are too slow. The choice is saved in
+        # STATE_DIR and evaluated again after 'auto-compression-interval' seconds (30 days
+        # by default).
+        #'compression'     : 'auto',
+        #'auto-compression-min-speed' : 50,
+        #'auto-compression-interval'  : 30 * 24 * 3600,
+        #'json-stats'      : True, # optional, default is BORG_JSON_STATS, see below
+
+        # Schedule for command 'check' (without command line params). Repository is checked
+        # with '--repository-only --max-duration', so borg continues check from the place
+        # where it was stopped last time, until whole repository is checked. Next complete
+        # check is started after 'period' seconds. 'max-duration' is limit for one run, see
+        # also CHECK_TIME_BUDGET below. Check with '--verify-data' (without time limit) is run
+        # once per 'verify-period' seconds. Progress is saved in STATE_DIR.
+        # It is None by default, so 'check' is run as any other borg command.
+        #'check-schedule'  : {
+        #    'period'        : 7 * 24 * 3600,
+        #    'max-duration'  : 3600,
+        #    'verify-period' : 90 * 24 * 3600,
+        #},
+
+        # Skip 'borg create' if nothing was changed in sources since last archive.
+        # Signatures of source trees (paths, sizes, inodes, mtimes and ctimes) are saved
+        # in STATE_DIR (see below). Excludes are not taken into account, so changes
+        # in excluded paths are treated as changes too. Archive is created anyway if last
+        # one is older than 'skip-max-age' seconds (one week by default). With 'shards'
+        # sources are scanned once for all shards and each shard checks its own directories.
+        # It is False by default.
+        #'skip-unchanged'  : True,
+        #'skip-max-age'    : 7 * 24 * 3600,
+
+        # Split sources to 'shards' parts which are backed up to separate repositories
+        # 'repository' + '.shard00', '.shard01' etc. by parallel 'borg create', it's for
+        # very big sources because borg uses one core only. Top level subdirectories of
+        # sources are assigned to shards by their size and number of files, assignment is
+        # saved in STATE_DIR and it's kept to not break deduplication. Once per
+        # 'shard-rebalance-interval' seconds (30 days by default) sources are scanned again
+        # and some directories are moved if shards are unbalanced. Shard 0 backs up sources
+        # without directories of other shards, so new directories are in it until rebalance.
+        # All other commands are run for each shard, variable BORG_SHARD has name of shard
+        # ('shard00' etc.), rclone destination gets suffix of shard too. Shards are mounted
+        # by 'borg:mount' to subdirectories of 'mountpoint' (see below).
+        #'shards'          : 4,
+        #'shard-rebalance-interval' : 30 * 24 * 3600,
         'encryption-mode' : 'repokey-blake2',            # optional, default 'repokey'
 
         # Backup script already knows and uses some commands and its base args such as
         # 'repository' and etc, but here some extra args can be set. See borg manual for details.
         # It can be added args to any borg command even if it is new borg command.
+        # Borg and rclone are run without shell: args are split as shell does it and
+        # variables like ${VAR} are expanded from 'env-vars' and environment, other shell
+        # features don't work here. Use custom shell commands (see below) for them.
         'commands-extra'  : {
             #'init'   : '',
             'create' : '--show-rc --stats -v --exclude-caches',
@@ -27,6 +80,36 @@ default = {
             'umount' : '${MY_BORG_REPO_MNTPNT}',
         },
 
+        # Optional mount point for 'borg:mount' and 'borg:umount', repository and mount point
+        # are added to args of them instead of 'commands-extra'. Each shard is mounted to
+        # its subdirectory ('shard00' etc.), the directory is created if it doesn't exist.
+        #'mountpoint'      : '${MY_BORG_REPO_MNTPNT}',
+
+        # Max time in seconds for each borg process and max time without any output from it.
+        # Process is killed (the whole process group) if any of them is expired and the
+        # command is failed. Optional, no timeouts by default.
+        #'timeout'         : 6 * 3600,
+        #'idle-timeout'    : 1800,
+        # CPU and IO priority of borg processes, see 'man nice' and 'man ionice'.
+        # 'ionice-class' is one of 'realtime', 'best-effort', 'idle'.
+        # Optional, priorities are not changed by default.
+        #'nice'            : 10,
+        #'ionice-class'    : 'best-effort',
+        #'ionice-level'    : 7,
+        # Limits of CPU and memory for borg processes, see CPUQuota and MemoryMax in
+        # 'man systemd.resource-control'. They are applied with 'systemd-run --scope'
+        # ('--user' for not root user) and ignored with warning if systemd is not
+        # available or the scope can't be created. Optional, no limits by default.
+        #'cpu-quota'       : '50%',
+        #'memory-max'      : '2G',
+        # Options above can be set for any command separately. Also 'min-interval' can be
+        # set here to skip the command if it was done successfully less than 'min-interval'
+        # seconds ago, it is used with USE_REPO_STATE only (see below).
+        #'commands-options' : {
+        #    'check' : { 'timeout' : 12 * 3600, 'idle-timeout' : None, 'ionice-class' : 'idle',
+        #                'min-interval' : 7 * 24 * 3600 },
+        #},
+
         # Enviroment variables for borg. See borg manual for details.
         # Using of BORG_PASSPHRASE is not recommended by security reason. Use BORG_PASSCOMMAND
         'env-vars' : {
@@ -37,11 +120,57 @@ default = {
     },
     'rclone' : {
         #'with-lock' : True, # Run rclone with borg command 'with-lock', 'False' by default
+        # With 'snapshot' borg lock is held only while snapshot of local repository is taken,
+        # then rclone uploads the snapshot and it's removed, so new backups are not blocked
+        # by upload. 'snapshot-method' is 'btrfs' (repository is btrfs subvolume),
+        # 'reflink' (copy-on-write filesystem), 'hardlink' (the same filesystem) or 'auto'
+        # to use the first suitable one. Snapshot is created in subdirectory of 'snapshot-dir'
+        # named by repository (so the directory can be shared by archives) or as directory
+        # with suffix '.rclone-snapshot' next to repository by default.
+        #'with-lock'       : 'snapshot',
+        #'snapshot-method' : 'auto',
+        #'snapshot-dir'    : '/var/tmp/borg-snapshots',
+
+        # Command 'sync' uploads only files which are new or changed (size or mtime) since
+        # last upload with 'rclone copy --files-from ... --no-traverse', so remote side is not
+        # listed. List of uploaded files is saved in STATE_DIR. Full 'rclone sync' is run once
+        # per 'full-sync-interval' seconds (one week by default) to delete old files on
+        # remote side. With 'incremental-hash' files with changed mtime are not uploaded if
+        # their content is not changed. With 'with-lock' files are listed and uploaded under
+        # the same borg lock, with snapshot they are listed in the snapshot. Works for local
+        # repositories only, False by default.
+        #'incremental'        : True,
+        #'full-sync-interval' : 7 * 24 * 3600,
+        #'incremental-hash'   : True,
+
+        # Destination can be list of destinations, each of them is remote or dict with
+        # 'remote' and its own 'commands-extra' (added after the ones of section),
+        # 'env-vars' and 'bwlimit'. Repository (or its snapshot) is uploaded to all of them
+        # at once, no more than 'parallel-destinations' at the same time (all by default).
+        # Result and throughput of each destination are reported. Command fails if it's
+        # failed for any destination, with 'partial-success' it fails only if it's failed
+        # for all of them.
+        #'destination' : (
+        #    'remote:backup',
+        #    { 'remote' : 'b2:backup', 'bwlimit' : '10M',
+        #      'env-vars' : { 'RCLONE_CONFIG' : '~/b2.conf' },
+        #      'commands-extra' : { 'sync' : '--fast-list' } },
+        #),
+        #'parallel-destinations' : 2,
+        #'partial-success'       : True,
+        #'bwlimit'               : '20M', # for all destinations
 
         'commands-extra'  : {
             'dedupe'  : '--dedupe-mode newest',
         },
 
+        # See the same params in borg section above
+        #'idle-timeout'    : 600,
+        #'nice'            : 10,
+        #'commands-options' : {
+        #    'sync' : { 'timeout' : 8 * 3600 },
+        #},
+
         # Enviroment variables for rclone. See rclone manual for details.
         'env-vars' : {
             'RCLONE_DRIVE_USE_TRASH' : 'false',
@@ -86,6 +215,13 @@ archives = (
             #'run-before'   : doIf,
             'run-before'   : 'ping -c 1 localhost &> /dev/null; mkdir -p ${MY_BORG_REPO_MNTPNT}',
             #'run-after'    : None,
+            # Result of 'run-before'/'run-after' can be memoized, so the hook is not run
+            # again for next commands: 'run' - once per run for all archives with the same
+            # hook (variables from 'env-vars' are expanded to compare it), 'archive' - once
+            # per archive, number - for this number of seconds.
+            # It is None by default, so hook is run for each command. See also PROBE_HOOKS.
+            #'run-before-cache' : 'archive',
+            #'run-after-cache'  : None,
             # Commands from this list will be ignored for current archive. Optional. Empty by default
             'ignore-commands' : ( 'serve', ),
         }),
@@ -106,7 +242,17 @@ archives = (
             'env-vars' : {
                 'MY_EXTRA_VAR' : 'this is my extra variable',
             },
+            # See the same params in borg section above
+            #'timeout'      : 60,
+            #'idle-timeout' : 30,
+            #'nice'         : 19,
         },
+        # Schedule of this archive in daemon mode (command line option -d/--daemon),
+        # it overrides SCHEDULE below. See SCHEDULE for details.
+        #'schedule' : (
+        #    { 'interval' : 3600, 'actions' : ( 'borg:create', 'borg:prune', ) },
+        #    { 'cron' : '0 4 * * 0', 'actions' : ( 'borg:check', ) },
+        #),
     },
     # one more archive and etc
     {
@@ -152,6 +298,119 @@ LOG_LEVEL = logging.DEBUG
 CONSOLE_LOG_LEVEL = logging.DEBUG
 EMAIL_LOG_LEVEL   = logging.INFO
 
+# Send output of borg/rclone/shell commands to the log line by line while the command
+# is running instead of one big message after the end of the command.
+# Only last OUTPUT_TAIL_LINES lines of output are kept in memory. It is False by default.
+#STREAM_OUTPUT     = True
+#OUTPUT_TAIL_LINES = 1000
+
+# Max number of archives processed at the same time by each action. Actions from
+# DEFAULT_ACTIONS are still run one after another. It is 1 by default.
+# Can be overridden with command line option -p/--parallel.
+#MAX_PARALLEL_ARCHIVES = 4
+
+# Default schedule of archives in daemon mode (command line option -d/--daemon).
+# It is dict or list of dicts, each of them has 'interval' in seconds or 'cron' expression
+# 'minute hour day-of-month month day-of-week' and optional list of 'actions' (it is
+# DEFAULT_ACTIONS by default). Each archive can have own 'schedule', see above, archive
+# with empty schedule is not run by daemon. Jobs of the same archive are never run at
+# the same time, number of jobs run at the same time is limited with command line
+# option -j/--jobs, see also RESOURCE_LIMITS. Times of last runs are saved in STATE_DIR.
+# SIGHUP reloads config files. It is { 'interval' : 24 * 3600 } by default.
+#SCHEDULE = { 'cron' : '45 5 * * *' }
+
+# Lock file to prevent processing of the same config by several processes at the same
+# time. It is 'lock-<name of config>' in STATE_DIR by default, None disables it.
+# It's taken by runs of default actions only, not by actions given with option -a.
+# Daemon takes it while jobs of the config are run and tries again in a minute if
+# the config is locked.
+#LOCK_FILE = '/run/backup-o-matic/config_test.lock'
+
+# Directory for files with state saved between runs. It is '~/.backup-o-matic' by default.
+#STATE_DIR = '/var/lib/backup-o-matic'
+
+# Save state of each repository in STATE_DIR: if it is initialized, its id and times
+# of last successful commands. With it 'borg init' and creating of directory for local
+# repository are not run for initialized repository (id of local repository is checked,
+# any failed borg command resets the state) and 'min-interval' can be used.
+# It is False by default.
+#USE_REPO_STATE = True
+
+# Total time in seconds for scheduled checks (see 'check-schedule') of all archives in one
+# run (in one cycle of jobs in daemon mode). It is shared equally between archives with
+# scheduled checks, unused time is given to next archives and time of checks with
+# '--verify-data' is charged to it. No limit by default.
+#CHECK_TIME_BUDGET = 2 * 3600
+
+# Number of threads to run memoized 'run-before' hooks (see 'run-before-cache') of all
+# archives at the same time before the first action, so, for example, unavailable remote
+# hosts are detected at once instead of waiting of timeouts one after another.
+# It is 0 (disabled) by default.
+#PROBE_HOOKS = 8
+
+# Number of threads to scan sources for 'skip-unchanged' and 'shards'. It is 4 by default.
+#SCAN_THREADS = 8
+
+# Seconds between SIGTERM and SIGKILL for processes killed by 'timeout' or 'idle-timeout'.
+# It is 10 by default.
+#KILL_GRACE_PERIOD = 10
+
+# Run the whole list of actions for each archive by itself instead of running each action
+# for all archives before the next action. So, for example, 'rclone:sync' for the first
+# archive can be run at the same time as 'borg:create' for the second one.
+# All archives are processed at the same time if MAX_PARALLEL_ARCHIVES is not set.
+# It is False by default. Can be enabled with command line option --pipeline.
+#PIPELINE_ARCHIVES = True
+
+# Max number of commands with the same prefix running at the same time.
+# It is useful with MAX_PARALLEL_ARCHIVES and PIPELINE_ARCHIVES. No limits by default.
+#RESOURCE_LIMITS = {
+#    'borg'   : 2,
+#    'rclone' : 1,
+#}
+
+# Run 'borg create' with options --json and --log-json to collect statistics of each
+# archive: sizes, number of files, duration and throughput. Statistics are added to the
+# report and can be saved as JSON and/or as Prometheus textfile (for node_exporter).
+# It is False by default, can be set for each archive with 'json-stats' in 'borg' section.
+#BORG_JSON_STATS       = True
+#STATS_JSON_FILE       = '/var/lib/backup-o-matic/stats.json'
+#STATS_PROMETHEUS_FILE = '/var/lib/node_exporter/textfile_collector/backup.prom'
+
+# Report progress of 'borg create' (options --progress --log-json) and 'rclone sync', 'copy'
+# and 'move' (options --use-json-log --stats): processed bytes and files, throughput and
+# ETA (from totals of the same command of previous run if tool doesn't know them) are
+# printed to console once per PROGRESS_INTERVAL seconds (60 by default), also when the
+# tool stalls without output. Warning is logged if throughput (zero for stalled tool)
+# falls below quarter of throughput of previous run. Totals are saved in
+# STATE_DIR. PROGRESS_STATUS_FILE is JSON file with progress of running commands for
+# other tools, it's updated with the same interval. It is False by default.
+#PROGRESS             = True
+#PROGRESS_INTERVAL    = 60
+#PROGRESS_STATUS_FILE = '/run/backup-o-matic/progress.json'
+
+# Save history of runs to sqlite database: start and end of each action for each
+# archive, exit code of failed tool, size of output and statistics of tools (see
+# BORG_JSON_STATS and PROGRESS). Duration and statistics of successful action are compared
+# with median of HISTORY_BASELINE_RUNS (10 by default) previous successful ones and if
+# they differ more than HISTORY_ALERT_FACTOR (2.0 by default) times in any direction
+# warning is logged and subject of email gets '[REGRESSION]'. Actions which did nothing
+# ('rclone' command without 'rclone' section, 'borg create' skipped for unchanged sources)
+# are saved as skipped and they are not used as baseline. Command line option --history
+# shows trends of actions. It is not used by default.
+#HISTORY_DB            = '/var/lib/backup-o-matic/history.sqlite'
+#HISTORY_BASELINE_RUNS = 10
+#HISTORY_ALERT_FACTOR  = 2.0
+
+# Collect wall and CPU time of each phase of the run: preparing of config, each command,
+# 'run-before'/'run-after', each tool process (with its CPU time, peak RSS and size
+# of output) and sending of email. Summary table is printed to console at the end of
+# the run after email is sent, so it is not in the email.
+# It is False by default. PROFILE_JSON_FILE (or command line option --profile-json)
+# saves all timings to JSON file and enables profiling.
+#PROFILE           = True
+#PROFILE_JSON_FILE = '/var/lib/backup-o-matic/profile.json'
+
 """
 ======================= DEFAULT LIST OF ACTIONS IN ORDER OF RUNNING
 """
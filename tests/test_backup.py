@@ -0,0 +1,596 @@
+# coding=utf8
+#
+# Unit tests of helpers of backup.py, run from the root of repository:
+#   python -m pytest tests
+# or
+#   python -m unittest discover tests
+
+import sys, os
+import shutil, tempfile, time, datetime
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import backup
+
+class ExcludeMatcherTest(unittest.TestCase):
+
+    def testRelativePattern(self):
+        excluded = backup.excludeMatcher(['test-src/exclude'])
+        self.assertTrue(excluded('test-src/exclude'))
+        self.assertTrue(excluded('test-src/exclude/file'))
+        self.assertTrue(excluded('./test-src/exclude'))
+        self.assertFalse(excluded('test-src/include'))
+        self.assertFalse(excluded('test-src/excluded'))
+
+    def testLeadingSlashIsStripped(self):
+        # borg strips leading slash of paths and of patterns
+        excluded = backup.excludeMatcher(['/home/user/cache', 'pp:/var/tmp'])
+        self.assertTrue(excluded('/home/user/cache/data'))
+        self.assertTrue(excluded('/var/tmp/x'))
+        excluded = backup.excludeMatcher(['home/user/cache'])
+        self.assertTrue(excluded('/home/user/cache'))
+
+    def testFnmatchPattern(self):
+        excluded = backup.excludeMatcher(['*.tmp', 'fm:*/node_modules'])
+        self.assertTrue(excluded('/src/a.tmp'))
+        self.assertTrue(excluded('src/proj/node_modules/lib/x.js'))
+        self.assertFalse(excluded('src/proj/main.c'))
+
+    def testShellPattern(self):
+        # '*' doesn't cross '/' in 'sh:' patterns
+        excluded = backup.excludeMatcher(['sh:*/build', 'sh:src/*.o'])
+        self.assertTrue(excluded('src/build'))
+        self.assertTrue(excluded('src/build/x.c'))
+        self.assertFalse(excluded('src/proj/build'))
+        self.assertTrue(excluded('src/a.o'))
+        self.assertFalse(excluded('src/lib/a.o'))
+
+    def testShellPatternAnyDirectories(self):
+        excluded = backup.excludeMatcher(['sh:**/cache', 'sh:src/**/*.o'])
+        self.assertTrue(excluded('cache'))
+        self.assertTrue(excluded('home/user/cache/x'))
+        self.assertFalse(excluded('home/user/cache2'))
+        self.assertTrue(excluded('src/a.o'))
+        self.assertTrue(excluded('src/lib/sub/a.o'))
+        self.assertFalse(excluded('src/lib/a.oo'))
+
+    def testPathPrefixAndFullPath(self):
+        excluded = backup.excludeMatcher(['pp:src/cache', 'pf:src/one'])
+        self.assertTrue(excluded('src/cache'))
+        self.assertTrue(excluded('src/cache/x'))
+        self.assertFalse(excluded('src/cachex'))
+        self.assertTrue(excluded('src/one'))
+        self.assertFalse(excluded('src/one/two'))
+
+    def testRegex(self):
+        excluded = backup.excludeMatcher(['re:^home/[^/]+/\\.cache/'])
+        self.assertTrue(excluded('/home/user/.cache/x'))
+        self.assertFalse(excluded('/home/user/cache/x'))
+
+    def testNoPatterns(self):
+        self.assertFalse(backup.excludeMatcher([])('/anything'))
+
+class ExpandArgsTest(unittest.TestCase):
+
+    env = { 'HOME' : '/home/user', 'NAME' : 'my archive', 'EMPTY' : '' }
+
+    def testSplitQuotingAndEscaping(self):
+        self.assertEqual(backup.splitArgs('a  "b c" \'d e\' f\\ g', {}),
+                        ['a', 'b c', 'd e', 'f g'])
+        self.assertEqual(backup.splitArgs('--glob "*.tmp" \\"x\\"', {}),
+                        ['--glob', '*.tmp', '"x"'])
+        self.assertEqual(backup.splitArgs('', {}), [])
+        self.assertRaises(ValueError, backup.splitArgs, '"unclosed', {})
+
+    def testSplitExpandsVariablesAfterSplitting(self):
+        # value with spaces remains one argument
+        self.assertEqual(backup.splitArgs('--name $NAME ${HOME}/x', self.env),
+                        ['--name', 'my archive', '/home/user/x'])
+        self.assertEqual(backup.splitArgs('--comment "$NAME"', self.env),
+                        ['--comment', 'my archive'])
+
+    def testExpandVars(self):
+        self.assertEqual(backup.expandVars('$HOME/a/${NAME}.b', self.env),
+                        '/home/user/a/my archive.b')
+        self.assertEqual(backup.expandVars('x${EMPTY}y', self.env), 'xy')
+        self.assertEqual(backup.expandVars('no variables', self.env), 'no variables')
+
+    def testUnsetVariablesAreLeft(self):
+        self.assertEqual(backup.expandVars('$UNSET/${UNSET}/$', self.env), '$UNSET/${UNSET}/$')
+        self.assertEqual(backup.splitArgs('$UNSET', self.env), ['$UNSET'])
+
+    def testExpandPathHome(self):
+        import pwd
+        user = pwd.getpwuid(os.getuid())
+        self.assertEqual(backup.expandPath('~' + user.pw_name + '/data', {}),
+                        [os.path.join(user.pw_dir, 'data')])
+        self.assertEqual(backup.expandPath('~no-such-user-xyz/data', {}),
+                        ['~no-such-user-xyz/data'])
+        self.assertEqual(backup.expandPath('$UNSET/data', {}), ['$UNSET/data'])
+
+    def testExpandPathWildcards(self):
+        tmpDir = tempfile.mkdtemp()
+        try:
+            for name in ('b', 'a', 'c.txt'):
+                os.mkdir(os.path.join(tmpDir, name))
+            env = { 'DIR' : tmpDir }
+            self.assertEqual(backup.expandPath('$DIR/?', env),
+                            [os.path.join(tmpDir, 'a'), os.path.join(tmpDir, 'b')])
+            # pattern without matches is returned as it is, borg reports about it
+            self.assertEqual(backup.expandPath('$DIR/*.log', env),
+                            [os.path.join(tmpDir, '*.log')])
+        finally:
+            shutil.rmtree(tmpDir)
+
+class CheckBudgetTest(unittest.TestCase):
+
+    def testShareIsReserved(self):
+        budget = backup.CheckBudget(600, 2)
+        self.assertEqual(budget.take(), 300)
+        self.assertEqual(budget.remaining, 300)
+        self.assertEqual(budget.take(), 300)
+        self.assertEqual(budget.remaining, 0)
+
+    def testUnusedTimeIsReturned(self):
+        budget = backup.CheckBudget(600, 3)
+        reserved = budget.take()
+        budget.settle(reserved, 50)
+        self.assertEqual(budget.take(), 275)
+
+    def testOverrunIsCharged(self):
+        budget = backup.CheckBudget(600, 2)
+        reserved = budget.take()
+        budget.settle(reserved, 590)
+        self.assertEqual(budget.take(), 0)
+
+class RunInThreadsTest(unittest.TestCase):
+
+    def testFalseResultStopsTasks(self):
+        tasks = [lambda: False, lambda: True, lambda: True]
+        results = backup.runInThreads(tasks, 1, stopOnError = True, failOnFalse = True)
+        self.assertEqual(results, [(False, None), None, None])
+
+    def testFalseResultIsNotFailureByDefault(self):
+        tasks = [lambda: False, lambda: True]
+        results = backup.runInThreads(tasks, 1, stopOnError = True)
+        self.assertEqual(results, [(False, None), (True, None)])
+
+class ReportBuilderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.spillDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.spillDir)
+
+    def testReportOfArchiveIsLimited(self):
+        main = backup.ReportBuilder(1000, 100, self.spillDir)
+        report = backup.ReportBuilder(1000, 100, self.spillDir, spillTo = main)
+        for i in range(100):
+            report.add('record %03d %s' % (i, 'x' * 40))
+        parts = report.parts()
+        self.assertTrue(sum(len(part) for part in parts) <= 1000 + 200)
+        self.assertTrue(parts[0].startswith('record 000'))
+        self.assertTrue(parts[-1].startswith('record 099'))
+        # omitted records are written to the spill file of the main report
+        self.assertEqual(report.spillPath, main.spillPath)
+        self.assertEqual(os.listdir(self.spillDir), [os.path.basename(main.spillPath)])
+
+        main.extend(parts)
+        self.assertEqual(main.parts()[0], parts[0])
+        self.assertEqual(main.parts()[-1], parts[-1])
+        main.closeSpill()
+
+    def testSpillIsRemoved(self):
+        report = backup.ReportBuilder(1000, 100, self.spillDir)
+        report.add('x' * 300)
+        self.assertTrue(os.path.exists(report.spillPath))
+        spillPath = report.spillPath
+        report.removeSpill()
+        self.assertFalse(os.path.exists(spillPath))
+        self.assertEqual(report.spillPath, None)
+
+    def testOldSpillsAreRotated(self):
+        old = ['report-20240101-00000%d-1.log.gz' % i for i in range(5)]
+        for name in old + ['other-20240101-000000-1.log.gz', 'report-x.txt']:
+            open(os.path.join(self.spillDir, name), 'w').close()
+        report = backup.ReportBuilder(1000, 100, self.spillDir, spillKeep = 3)
+        report.add('x' * 300)
+        report.closeSpill()
+        self.assertEqual(sorted(os.listdir(self.spillDir)),
+                        sorted(old[-2:] + [os.path.basename(report.spillPath),
+                                'other-20240101-000000-1.log.gz', 'report-x.txt']))
+
+class ChooseCompressionTest(unittest.TestCase):
+
+    def testOnlyMeasuredCandidates(self):
+        results = { 'zlib,6' : { 'ratio' : 0.5, 'speed' : 80 },
+                    'lzma,6' : { 'ratio' : 0.4, 'speed' : 5 } }
+        self.assertEqual(backup.chooseCompression(results, 50), 'auto,zlib,6')
+        self.assertEqual(backup.chooseCompression(results, 100), 'lz4')
+        self.assertEqual(backup.chooseCompression({}, 50), 'lz4')
+
+    def testStrongerCandidateNeedsGain(self):
+        results = { 'lz4'     : { 'ratio' : 0.60, 'speed' : 500 },
+                    'zstd,3'  : { 'ratio' : 0.50, 'speed' : 200 },
+                    'zlib,6'  : { 'ratio' : 0.48, 'speed' : 60 },
+                    'zstd,10' : { 'ratio' : 0.40, 'speed' : 20 } }
+        self.assertEqual(backup.chooseCompression(results, 50), 'auto,zstd,3')
+        self.assertEqual(backup.chooseCompression(results, 10), 'auto,zstd,10')
+        results['zstd,3']['ratio'] = 0.58
+        self.assertEqual(backup.chooseCompression(results, 50), 'auto,zlib,6')
+
+    def testBenchmarkMeasuresZlib(self):
+        results = backup.benchmarkCompression([b'abc' * 10000])
+        self.assertTrue(results['zlib,6']['ratio'] < 0.1)
+
+def localTime(*args):
+    return time.mktime(datetime.datetime(*args).timetuple())
+
+class ProgressTrackerTest(unittest.TestCase):
+
+    def testStalledToolHasZeroRecentRate(self):
+        reports = []
+        tracker = backup.ProgressTracker('repo', 'borg:create', None, 0.2, reports.append)
+        tracker.update(1000, 10)
+        time.sleep(0.1)
+        tracker.update(2000, 20)
+        self.assertTrue(tracker.status()['recent-rate'] > 0)
+        # no output from the tool, only ticks of the reader
+        for i in range(4):
+            time.sleep(0.1)
+            tracker.tick()
+        status = tracker.status()
+        self.assertEqual(status['recent-rate'], 0)
+        self.assertEqual(status['bytes'], 2000)
+        self.assertEqual(status['files'], 20)
+        self.assertTrue(reports)
+
+class AssignShardsTest(unittest.TestCase):
+
+    def assertAllAssigned(self, weights, units, loads, rootWeight = 0):
+        self.assertEqual(sorted(units), sorted(weights))
+        self.assertEqual(sum(loads), sum(weights.values()) + rootWeight)
+        for index in range(len(loads)):
+            self.assertEqual(loads[index], sum(weights[path] for path in units
+                                                if units[path] == index) +
+                                            (rootWeight if index == 0 else 0))
+
+    def testEvenDistribution(self):
+        weights = dict((name, 10) for name in 'abcdef')
+        units, loads, moved = backup.assignShards(weights, 0, 3, {})
+        self.assertAllAssigned(weights, units, loads)
+        self.assertEqual(loads, [20, 20, 20])
+        self.assertEqual(moved, 0)
+
+    def testSkewedDistribution(self):
+        # the biggest unit can't be split, small ones go to other shards
+        weights = { 'big' : 100, 's1' : 10, 's2' : 10, 's3' : 10, 's4' : 5 }
+        units, loads, moved = backup.assignShards(weights, 0, 3, {})
+        self.assertAllAssigned(weights, units, loads)
+        self.assertEqual(loads, [100, 20, 15])
+        self.assertEqual([path for path in units if units[path] == 0], ['big'])
+
+    def testRootWeightIsInFirstShard(self):
+        weights = { 'a' : 10, 'b' : 10, 'c' : 10 }
+        units, loads, moved = backup.assignShards(weights, 10, 2, {})
+        self.assertAllAssigned(weights, units, loads, 10)
+        self.assertEqual(loads, [20, 20])
+
+    def testMoreShardsThanSources(self):
+        weights = { 'a' : 10, 'b' : 5 }
+        units, loads, moved = backup.assignShards(weights, 1, 4, {})
+        self.assertAllAssigned(weights, units, loads, 1)
+        self.assertEqual(len(set(units.values())), 2)
+        self.assertEqual(loads.count(0), 1)
+        self.assertEqual(moved, 0)
+
+    def testPreviousAssignmentIsKept(self):
+        weights = dict((name, 10) for name in 'abcd')
+        previous = { 'a' : 1, 'b' : 0, 'c' : 0, 'd' : 1, 'removed' : 1, 'e' : 7 }
+        units, loads, moved = backup.assignShards(weights, 0, 2, previous)
+        self.assertEqual(units, { 'a' : 1, 'b' : 0, 'c' : 0, 'd' : 1 })
+        self.assertEqual(moved, 0)
+
+    def testUnbalancedPreviousAssignmentIsRebalanced(self):
+        weights = dict((name, 10) for name in 'abcd')
+        previous = dict((name, 0) for name in 'abcd')
+        units, loads, moved = backup.assignShards(weights, 0, 2, previous)
+        self.assertAllAssigned(weights, units, loads)
+        self.assertEqual(loads, [20, 20])
+        self.assertEqual(moved, 2)
+        # imbalance within the limit is kept
+        weights = { 'a' : 11, 'b' : 9 }
+        units, loads, moved = backup.assignShards(weights, 0, 2, { 'a' : 0, 'b' : 1 })
+        self.assertEqual(moved, 0)
+
+    def testScanShardUnits(self):
+        tmpDir = tempfile.mkdtemp()
+        try:
+            for name, size in (('one/x', 1000), ('one/sub/y', 500), ('two/z', 10),
+                                ('skip/w', 10), ('file', 100)):
+                path = os.path.join(tmpDir, name)
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                with open(path, 'wb') as f:
+                    f.write(b'x' * size)
+            excluded = backup.excludeMatcher(['pp:' + os.path.join(tmpDir, 'skip')])
+            weights, rootWeight = backup.scanShardUnits([tmpDir], excluded, 2)
+            self.assertEqual(weights, {
+                os.path.join(tmpDir, 'one') : backup.shardWeight(1500, 2),
+                os.path.join(tmpDir, 'two') : backup.shardWeight(10, 1) })
+            self.assertEqual(rootWeight, backup.shardWeight(100, 1))
+        finally:
+            shutil.rmtree(tmpDir)
+
+class CommandTimeoutTest(unittest.TestCase):
+
+    def startProcess(self, script):
+        # started as leader of new process group as Backupper does it for timeouts
+        import subprocess
+        proc = subprocess.Popen(['/bin/sh', '-c', script], stdout = subprocess.PIPE,
+                                stderr = subprocess.STDOUT, universal_newlines = True,
+                                preexec_fn = os.setsid)
+        self.addCleanup(self.cleanup, proc)
+        return proc
+
+    def cleanup(self, proc):
+        import signal
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        proc.stdout.close()
+        proc.wait()
+
+    def isAlive(self, pid):
+        # process is alive if it exists and it's not zombie
+        try:
+            with open('/proc/%d/stat' % pid) as f:
+                return f.read().rsplit(')', 1)[1].split()[0] != 'Z'
+        except (IOError, OSError):
+            return False
+
+    def readLines(self, proc, timeout, idleTimeout, tickInterval = None):
+        lines = []
+        try:
+            for line in backup.iterLinesWithTimeouts(proc.stdout, timeout, idleTimeout,
+                                                    tickInterval):
+                lines.append(line)
+        except backup.CommandTimeout as exc:
+            return lines, exc
+        return lines, None
+
+    def testIdleTimeout(self):
+        proc = self.startProcess('echo started; sleep 30')
+        start = time.time()
+        lines, exc = self.readLines(proc, None, 0.3)
+        self.assertTrue(0.3 <= time.time() - start < 5)
+        self.assertEqual(lines, ['started\n'])
+        self.assertTrue('no output during' in str(exc))
+
+    def testTotalTimeout(self):
+        # output doesn't stop, so only total timeout expires
+        proc = self.startProcess('while true; do echo line; sleep 0.05; done')
+        start = time.time()
+        lines, exc = self.readLines(proc, 0.5, 0.3)
+        self.assertTrue(0.5 <= time.time() - start < 5)
+        self.assertTrue(len(lines) > 2)
+        self.assertTrue('timeout of' in str(exc))
+
+    def testNoTimeout(self):
+        proc = self.startProcess('echo one; sleep 0.2; printf two')
+        lines, exc = self.readLines(proc, 5, 5)
+        self.assertEqual(lines, ['one\n', 'two'])
+        self.assertEqual(exc, None)
+
+    def testTicksWhileIdle(self):
+        proc = self.startProcess('echo one; sleep 0.5; echo two')
+        lines, exc = self.readLines(proc, None, None, 0.1)
+        self.assertEqual([line for line in lines if line], ['one\n', 'two\n'])
+        self.assertTrue(lines.count(None) >= 2)
+
+    def testKillProcessGroup(self):
+        proc = self.startProcess('sleep 30 & echo $!; wait')
+        lines, exc = self.readLines(proc, None, 0.3)
+        self.assertTrue(isinstance(exc, backup.CommandTimeout))
+        child = int(lines[0])
+        self.assertTrue(self.isAlive(child))
+        backup.killProcessGroup(proc, 2)
+        self.assertNotEqual(proc.poll(), None)
+        time.sleep(0.1)
+        self.assertFalse(self.isAlive(child))
+
+    def testKillEscalation(self):
+        # SIGTERM is ignored by all processes of the group, so SIGKILL is sent after
+        # grace period
+        import signal
+        proc = self.startProcess('trap "" TERM; sleep 30 & echo $!; wait')
+        lines, exc = self.readLines(proc, None, 0.3)
+        child = int(lines[0])
+        start = time.time()
+        backup.killProcessGroup(proc, 0.3)
+        self.assertTrue(time.time() - start >= 0.3)
+        self.assertEqual(proc.poll(), -signal.SIGKILL)
+        time.sleep(0.1)
+        self.assertFalse(self.isAlive(child))
+
+class UploadManifestTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.repo = os.path.join(self.tmpDir, 'repo')
+        self.statePath = os.path.join(self.tmpDir, 'manifest.json')
+        self.write('config', b'config')
+        self.write('data/0/1', b'segment 1')
+        self.write('data/0/2', b'segment 2')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def write(self, relPath, data, mtime = None):
+        path = os.path.join(self.repo, relPath)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write(data)
+        mtime = mtime or 1000000000
+        os.utime(path, (mtime, mtime))
+
+    def manifest(self, useHash = False):
+        manifest = backup.UploadManifest(self.statePath, self.repo, useHash)
+        manifest.scan()
+        return manifest
+
+    def testFirstUploadHasAllFiles(self):
+        manifest = self.manifest()
+        self.assertEqual(sorted(manifest.current), ['config', os.path.join('data', '0', '1'),
+                                                    os.path.join('data', '0', '2')])
+        self.assertEqual(manifest.changedFiles(), sorted(manifest.current))
+
+    def testChangedFiles(self):
+        self.manifest().save()
+        self.write('data/0/2', b'segment 2 is longer')
+        self.write('data/0/3', b'segment 3')
+        self.write('config', b'config', 1000000001)
+        os.remove(os.path.join(self.repo, 'data', '0', '1'))
+        self.assertEqual(self.manifest().changedFiles(),
+                        ['config', os.path.join('data', '0', '2'),
+                        os.path.join('data', '0', '3')])
+
+    def testOnlyUploadedFilesAreSaved(self):
+        manifest = self.manifest()
+        manifest.save([os.path.join('data', '0', '1')])
+        self.assertEqual(self.manifest().changedFiles(),
+                        ['config', os.path.join('data', '0', '2')])
+
+    def testHashSkipsFilesWithChangedMtime(self):
+        manifest = self.manifest(True)
+        manifest.changedFiles()
+        manifest.save()
+        self.write('config', b'config', 1000000001)
+        self.write('data/0/1', b'segment X', 1000000001)
+        manifest = self.manifest(True)
+        self.assertEqual(manifest.changedFiles(), [os.path.join('data', '0', '1')])
+        # new mtime of not changed file is saved, so it's not hashed next time
+        manifest.save(manifest.changedFiles())
+        self.assertEqual(self.manifest(True).changedFiles(), [])
+
+    def testFullSyncInterval(self):
+        manifest = self.manifest()
+        self.assertEqual(manifest.lastFullSync, 0)
+        self.assertTrue(manifest.isFullSyncDue(3600))
+        manifest.save(fullSync = True)
+        manifest = self.manifest()
+        self.assertFalse(manifest.isFullSyncDue(3600))
+        self.assertTrue(manifest.isFullSyncDue(0))
+        # incremental upload doesn't change time of last full sync
+        lastFullSync = manifest.lastFullSync
+        manifest.save(['config'])
+        self.assertEqual(self.manifest().lastFullSync, lastFullSync)
+        self.assertEqual(self.manifest().changedFiles(), [])
+
+class SourceSignaturesTest(unittest.TestCase):
+
+    def testChangeAffectsOnlyItsDirectory(self):
+        # signatures are divided between shards, so a change of one directory shouldn't
+        # change signature of the root or of other directories
+        tmpDir = tempfile.mkdtemp()
+        try:
+            for name in ('one', 'two'):
+                os.mkdir(os.path.join(tmpDir, name))
+            with open(os.path.join(tmpDir, 'top.txt'), 'w') as f:
+                f.write('top')
+            before = backup.scanSourceSignatures([tmpDir], 2)
+            self.assertEqual(sorted(before), [tmpDir, os.path.join(tmpDir, 'one'),
+                                            os.path.join(tmpDir, 'two')])
+            time.sleep(0.01)
+            with open(os.path.join(tmpDir, 'one', 'new'), 'w') as f:
+                f.write('new')
+            after = backup.scanSourceSignatures([tmpDir], 2)
+            self.assertEqual([name for name in sorted(before) if before[name] != after[name]],
+                            [os.path.join(tmpDir, 'one')])
+        finally:
+            shutil.rmtree(tmpDir)
+
+class RepoMissingErrorTest(unittest.TestCase):
+
+    def testErrorCode(self):
+        error = backup.ToolResultException
+        self.assertTrue(backup.isRepoMissingError(error('error', 2, '')))
+        self.assertFalse(backup.isRepoMissingError(error('warning', 1, 'file changed')))
+        # killed by timeout
+        self.assertFalse(backup.isRepoMissingError(error('killed', -9, '')))
+
+    def testMessage(self):
+        self.assertTrue(backup.isRepoMissingError(backup.ToolResultException('failed', None,
+                                    'Repository /backup/repo does not exist.')))
+        self.assertTrue(backup.isRepoMissingError(Exception(
+                                    '/backup/repo is not a valid repository. Check repo config.')))
+        self.assertFalse(backup.isRepoMissingError(Exception('Connection closed by remote host')))
+        self.assertFalse(backup.isRepoMissingError(ValueError('wrong value')))
+
+class CronTest(unittest.TestCase):
+
+    def nextTime(self, expr, *after):
+        moment = backup.nextCronTime(backup.parseCron(expr), localTime(*after))
+        return datetime.datetime.fromtimestamp(moment)
+
+    def testFields(self):
+        fields, anyDay, anyWeekday = backup.parseCron('*/15 1-3,5 1 */6 1-5/2')
+        self.assertEqual(fields[0], set([0, 15, 30, 45]))
+        self.assertEqual(fields[1], set([1, 2, 3, 5]))
+        self.assertEqual(fields[2], set([1]))
+        self.assertEqual(fields[3], set([1, 7]))
+        self.assertEqual(fields[4], set([1, 3, 5]))
+        self.assertFalse(anyDay)
+        self.assertFalse(anyWeekday)
+
+    def testStepFromNumber(self):
+        self.assertEqual(backup.parseCron('10/20 * * * *')[0][0], set([10, 30, 50]))
+
+    def testSundayIsZeroAndSeven(self):
+        self.assertEqual(backup.parseCron('0 0 * * 7')[0][4], set([0]))
+
+    def testWrongExpressions(self):
+        for expr in ('* * * *', '60 * * * *', '* 24 * * *', '* * 0 * *', '* * * 13 *',
+                    'x * * * *', '5-1 * * * *'):
+            self.assertRaises(KeyError, backup.parseCron, expr)
+
+    def testNextMinuteAndHour(self):
+        self.assertEqual(self.nextTime('* * * * *', 2024, 3, 10, 12, 30, 20),
+                        datetime.datetime(2024, 3, 10, 12, 31))
+        self.assertEqual(self.nextTime('45 5 * * *', 2024, 3, 10, 5, 45),
+                        datetime.datetime(2024, 3, 11, 5, 45))
+        self.assertEqual(self.nextTime('0 */6 * * *', 2024, 3, 10, 13, 0),
+                        datetime.datetime(2024, 3, 10, 18, 0))
+
+    def testRolloverOfMonthAndYear(self):
+        self.assertEqual(self.nextTime('0 3 1 * *', 2024, 1, 31, 4, 0),
+                        datetime.datetime(2024, 2, 1, 3, 0))
+        self.assertEqual(self.nextTime('30 0 1 1 *', 2024, 6, 1, 0, 0),
+                        datetime.datetime(2025, 1, 1, 0, 30))
+        self.assertEqual(self.nextTime('0 0 29 2 *', 2023, 3, 1, 0, 0),
+                        datetime.datetime(2024, 2, 29, 0, 0))
+
+    def testDayOfWeek(self):
+        # 2024-03-10 is Sunday
+        self.assertEqual(self.nextTime('0 6 * * 1', 2024, 3, 10, 12, 0),
+                        datetime.datetime(2024, 3, 11, 6, 0))
+        self.assertEqual(self.nextTime('0 6 * * 0', 2024, 3, 11, 0, 0),
+                        datetime.datetime(2024, 3, 17, 6, 0))
+
+    def testDayOfMonthOrDayOfWeek(self):
+        # restricted day of month and day of week are combined by 'or' as in cron
+        self.assertEqual(self.nextTime('0 0 15 * 5', 2024, 3, 10, 12, 0),
+                        datetime.datetime(2024, 3, 15, 0, 0))
+        self.assertEqual(self.nextTime('0 0 13 * 5', 2024, 3, 10, 12, 0),
+                        datetime.datetime(2024, 3, 13, 0, 0))
+        self.assertEqual(self.nextTime('0 0 13 * 5', 2024, 3, 13, 12, 0),
+                        datetime.datetime(2024, 3, 15, 0, 0))
+
+    def testNeverMatches(self):
+        self.assertRaises(KeyError, self.nextTime, '0 0 31 2 *', 2024, 1, 1, 0, 0)
+
+if __name__ == '__main__':
+    unittest.main()